@@ -0,0 +1,173 @@
+"""Async versions of the views that spend their time waiting: the feed on
+the database, google login and ingestion on other hosts. urls.py serves
+them instead of the sync views when ASYNC_VIEWS is on, which only pays
+under an ASGI worker (see gunicorn.conf.py).
+
+Django 3.1 has no async ORM, so database work runs on executor threads
+through ``in_thread``; outbound HTTP goes through httpx and holds a
+coroutine rather than a thread or a worker.
+"""
+import asyncio, os, tempfile
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.http import HttpResponse, HttpResponseNotAllowed
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from .dbviews import UpdateNews, ingest, opener, sheet_articles
+from .googleviews import GoogleLogin, GoogleTokenVerifier, finish_login, google_user
+from .metrics import cache_lookup
+from .models import News
+from .renderers import ORJSONRenderer
+from .views import NewsView
+
+
+def in_thread(func):
+    """``func`` as a coroutine function run on the default executor. Each call
+    recycles its thread's connections like a sync request does, so one
+    request's queries don't wait behind another's on a single thread."""
+    def run(*args, **kwargs):
+        close_old_connections()
+        try: return func(*args, **kwargs)
+        finally: close_old_connections()
+    return sync_to_async(run, thread_sensitive=False)
+
+
+def json_response(data, status=200):
+    return HttpResponse(ORJSONRenderer().render(data), status=status, content_type='application/json')
+
+
+def request_data(request):
+    return Request(request, parsers=[parser() for parser in api_settings.DEFAULT_PARSER_CLASSES]).data
+
+
+def request_user(request):
+    return Request(request, authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES]).user
+
+
+_news = in_thread(NewsView.as_view())
+
+
+async def news(request):
+    return await _news(request)
+
+# query budgets and the performance log know these by their sync view
+news.view_class = NewsView
+
+
+class AsyncGoogleTokenVerifier(GoogleTokenVerifier):
+    """GoogleTokenVerifier over an httpx.AsyncClient, one per event loop."""
+
+    def __init__(self, url=None, timeout=None, ttl=None, pool_size=100):
+        self.url = url or settings.GOOGLE_USERINFO_URL
+        connect, read = timeout or settings.GOOGLE_HTTP_TIMEOUT
+        self.timeout = httpx.Timeout(read, connect=connect)
+        self.ttl = settings.GOOGLE_TOKEN_CACHE_TTL if ttl is None else ttl
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.loop = self.client = None
+
+    def session(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            transport = httpx.AsyncHTTPTransport(retries=1, limits=self.limits)
+            self.loop, self.client = loop, httpx.AsyncClient(timeout=self.timeout, transport=transport)
+        return self.client
+
+    async def verify(self, token):
+        key = self.cache_key(token)
+        data = await in_thread(cache.get)(key)
+        cache_lookup('google_token', data is not None)
+        if data is not None: return data
+
+        try:
+            r = await self.session().get(self.url, params={'access_token': token})
+            data = r.json()
+        except (httpx.HTTPError, ValueError) as e:
+            return {'error': str(e)}
+
+        if 'error' not in data and self.ttl: await in_thread(cache.set)(key, data, self.ttl)
+        return data
+
+    async def fetch(self, url):
+        r = await self.session().get(url)
+        r.raise_for_status()
+        return r.content
+
+
+verifier = AsyncGoogleTokenVerifier()
+
+
+async def google_login(request):
+    if request.method != 'POST': return HttpResponseNotAllowed(['POST'])
+    data = request_data(request)
+    token = data.get("token")
+    info = await verifier.verify(token) if token else {'error': 'missing token'}
+
+    if 'error' in info:
+        return json_response({'message': 'wrong google token / this google token is already expired.'})
+
+    version = data.get("version", 0)
+    user, new_user = await in_thread(google_user)(info, version)
+    if user is None: return json_response({'message': 'email is not verified'})
+
+    image = await verifier.fetch(info.get('picture'))
+    return json_response(await in_thread(finish_login)(user, new_user, image, version))
+
+# csrf_exempt() in Django 3.1 would hide that the view is a coroutine
+google_login.csrf_exempt = True
+google_login.view_class = GoogleLogin
+
+
+def known_sources(sources):
+    return set(News.objects.filter(source__in = sources).values_list('source', flat = True))
+
+
+async def download_images(urls):
+    """``{position: url}`` downloaded concurrently to temporary files, as
+    ``{position: file url}``. Failed downloads are left out; add_news tries
+    those again itself and reports the error."""
+    semaphore = asyncio.Semaphore(settings.INGEST_CONCURRENCY)
+
+    async def download(client, url):
+        async with semaphore:
+            r = await client.get(url)
+            r.raise_for_status()
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f: f.write(r.content)
+        return 'file://' + path
+
+    async with httpx.AsyncClient(headers=dict(opener.addheaders), timeout=30, follow_redirects=True) as client:
+        files = await asyncio.gather(*[download(client, url) for url in urls.values()], return_exceptions=True)
+    return {i: f for i, f in zip(urls, files) if isinstance(f, str)}
+
+
+async def update_news(request):
+    try: user = await in_thread(request_user)(request)
+    except APIException as e: return json_response({'detail': str(e.detail)}, e.status_code)
+    if not user.is_superuser: return json_response("FUCK OFF!!")
+
+    n = int(request.GET.get("n", 20))
+    articles = await in_thread(sheet_articles)()
+    known = await in_thread(known_sources)([article[1] for article in articles])
+    response = {'invalid_news': {}, 'total_news': len(articles), 'new': 0, 'old': 0}
+
+    # download images for as many unseen articles as are still wanted, all
+    # at once, then store them; repeat while failures leave us short
+    queue = list(enumerate(articles))
+    while queue and response['new'] < n:
+        batch, wanted = [], n - response['new']
+        while queue and wanted:
+            batch.append(queue.pop(0))
+            if batch[-1][1][1] not in known: wanted -= 1
+        images = await download_images({i: article[2] for i, article in batch if article[1] not in known})
+        try: await in_thread(ingest)(response, batch, n, images)
+        finally:
+            for image in images.values(): os.remove(image[len('file://'):])
+    return json_response(response)
+
+update_news.view_class = UpdateNews
@@ -0,0 +1,82 @@
+import time
+
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from .models import ClaimsUser
+from .metrics import cache_lookup
+from .versions import bump, version
+
+
+def version_key(pk):
+    return 'user-version:%s' % pk
+
+
+class UserCache:
+    """User rows of this process keyed by pk, each kept for ``ttl`` seconds
+    and only while the user's version token in the 'shared' cache is the
+    one it was read under. Saving or deleting a user replaces the token, so
+    every worker reads the row again on its next request for that user."""
+
+    def __init__(self, ttl=60, size=4096):
+        self.ttl, self.size = ttl, size
+        self.fields = [f.attname for f in User._meta.concrete_fields]
+        self.rows = {}
+
+    def get(self, pk):
+        # read before the row: a change in between leaves it under the old token
+        current_version = version(version_key(pk))
+        entry = self.rows.get(pk)
+        hit = entry is not None and entry[0] > time.monotonic() and entry[1] == current_version
+        cache_lookup('user', hit)
+        if hit: return entry[2]
+
+        try: row = User.objects.values(*self.fields).get(pk=pk)
+        except User.DoesNotExist:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+
+        if len(self.rows) >= self.size: self.rows.pop(next(iter(self.rows)), None)
+        self.rows[pk] = (time.monotonic() + self.ttl, current_version, row)
+        return row
+
+    def discard(self, pk):
+        self.rows.pop(pk, None)
+        bump(version_key(pk))
+
+
+user_cache = UserCache()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@receiver(post_save, sender=ClaimsUser)
+@receiver(post_delete, sender=ClaimsUser)
+def drop_cached_user(sender, instance, **kwargs):
+    user_cache.discard(instance.pk)
+
+
+class StatelessJWTAuthentication(JWTAuthentication):
+    """JWT authentication that trusts the token instead of loading the user.
+
+    ``request.user`` is a ``ClaimsUser`` carrying only the pk, which is all
+    that filtering and assigning foreign keys need. Other fields come from
+    ``user_cache`` the first time a view reads them. The cached row is also
+    checked on every request, so a user deleted or deactivated through the
+    ORM is refused by every worker from their next request; one changed by
+    a queryset update or in SQL, within the cache's TTL.
+    """
+
+    def get_user(self, validated_token):
+        try: user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        if not user_cache.get(user_id)['is_active']:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        return ClaimsUser.from_db(DEFAULT_DB_ALIAS, ['id'], [user_id])
@@ -0,0 +1,38 @@
+# Most database queries a request to each view may run. They must not
+# depend on how many rows come back: api.tests exercises every url in
+# newscatcher_backend.urls with a small and a larger dataset and fails when
+# a view goes over its budget or its count grows with the data.
+QUERY_BUDGETS = {
+    'NewsView': 4,
+    'NewsDetailView': 3,
+    'CategoryView': 1,
+    'TagView': 1,
+    'TopicView': 1,
+    'QuoteView': 1,
+    'EventView': 5,
+    'EventRegister': 1,
+    'Stats': 1,
+    'APIRootView': 0,
+    'MyTagViewSet': 2,
+    'MyCategoryViewSet': 2,
+    'MyNewsViewSet': 1,
+    'SaveViewSet': 4,
+    'VoteViewSet': 4,
+    'OrganizationViewSet': 1,
+    'ProfileViewSet': 1,
+    'ProfileInfoViewSet': 1,
+    'CompViewSet': 3,
+    'GoogleLogin': 0,
+    'FacebookLogin': 0,
+    'TwitterLogin': 0,
+    'GithubLogin': 0,
+    'TokenRefreshView': 0,
+    'export': 0,
+    'serve': 0,
+    'rendition': 1,
+}
+
+
+def view_name(callback):
+    view = getattr(callback, 'cls', None) or getattr(callback, 'view_class', None) or callback
+    return view.__name__
@@ -0,0 +1,154 @@
+import random, threading, time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .dbrouters import replica_reads
+from .metrics import cache_lookup
+from .models import Comp, Question
+from .renderers import ORJSONRenderer
+from .scoring import AnswerKey, Leaderboard
+from .serializers import QuestionSerializer
+from .versions import bump, version
+
+
+def version_key(pk):
+    return 'comp-version:%d' % pk
+
+
+def member_key(pk, user_id):
+    return 'comp-member:%d:%d' % (pk, user_id)
+
+
+class Competition:
+    """What the quiz endpoints check and serve for one competition: its
+    window, its participants' ids and its question pool, each question
+    rendered to json once, plus the pool's answer key and the leaderboard
+    graded against it."""
+
+    def __init__(self, pk, version, start_time, end_time, participants, pool, answers):
+        self.pk, self.version = pk, version
+        self.start_time, self.end_time = start_time, end_time
+        self.participants, self.pool = participants, pool
+        self.key = AnswerKey(answers)
+        self.leaderboard = Leaderboard(pk, self.key.top)
+        self.loaded = time.monotonic()
+
+    def is_open(self, now):
+        return self.start_time <= now < self.end_time
+
+    def admits(self, user, now):
+        if not self.is_open(now): return False
+        # joined or left since this was loaded
+        member = caches['shared'].get(member_key(self.pk, user.pk))
+        return member if member is not None else user.pk in self.participants
+
+    def questions_for(self, user):
+        """The participant's QUIZ_QUESTIONS questions as a json array. The
+        pick is seeded by competition and user, so every worker and every
+        retry gives a participant the same set."""
+        picks = random.Random('%d:%d' % (self.pk, user.pk)).sample(
+            range(len(self.pool)), min(settings.QUIZ_QUESTIONS, len(self.pool)))
+        return b'[' + b','.join(self.pool[i] for i in picks) + b']'
+
+
+class CompetitionCache:
+    """Competitions loaded once per process and kept while their version
+    token in the shared cache is unchanged, for at most
+    COMPETITION_CACHE_TTL seconds; the receivers below replace the token
+    whenever a competition or its questions change, and every worker sees
+    the new one. A request costs one cache get instead of the membership
+    and question queries, however many participants open the quiz at once.
+
+    Joining or leaving doesn't replace the token, which would reload the
+    pool and rebuild the leaderboard on every registration. It is kept as
+    a per-user entry in the shared cache instead (``joined``), checked by
+    ``admits`` and outliving any competition loaded before it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, pk):
+        """The competition ``pk``, or None when there is no such competition."""
+        current_version = version(version_key(pk))
+        # a change that bypassed the receivers (a queryset update) is picked up too
+        current = lambda entry: (entry is not None and entry.version == current_version
+                                 and time.monotonic() - entry.loaded < settings.COMPETITION_CACHE_TTL)
+        entry = self.entries.get(pk)
+        cache_lookup('competition', current(entry))
+        if current(entry): return entry
+
+        # one load per process when a quiz opens, not one per request
+        with self.lock:
+            entry = self.entries.get(pk)
+            if not current(entry):
+                entry = self.load(pk, current_version)
+                self.entries[pk] = entry
+        return entry
+
+    def load(self, pk, version):
+        # a lagging replica would keep a change that just happened out of the new entry
+        with replica_reads(False): return self.read(pk, version)
+
+    def read(self, pk, version):
+        window = Comp.objects.filter(pk=pk).values_list('start_time', 'end_time').first()
+        if window is None: return None
+        participants = frozenset(Comp.participants.through.objects.filter(comp_id=pk).values_list('user_id', flat=True))
+        questions = Question.objects.filter(comp=pk).order_by('-created_at')[:settings.QUIZ_POOL_SIZE]
+        render = ORJSONRenderer().render
+        pool = [render(data) for data in QuestionSerializer(questions, many=True).data]
+        # {} is the default: no answer set, so not graded
+        answers = {question.pk: question.answer for question in questions if question.answer != {}}
+        return Competition(pk, version, *window, participants, pool, answers)
+
+
+competitions = CompetitionCache()
+
+
+def changed(*pks):
+    bump(*map(version_key, pks))
+
+
+def joined(pairs, member):
+    """Records that the users of ``(competition, user)`` ``pairs`` joined
+    (``member``) or left their competitions."""
+    # any competition loaded before this expires within the ttl
+    caches['shared'].set_many({member_key(*pair): member for pair in pairs}, settings.COMPETITION_CACHE_TTL * 2)
+
+
+@receiver(post_save, sender=Comp)
+@receiver(post_delete, sender=Comp)
+def comp_changed(sender, instance, **kwargs):
+    changed(instance.pk)
+
+
+@receiver(m2m_changed, sender=Comp.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # by post_clear the rows are gone
+        rows = sender.objects.filter(**{'user_id' if reverse else 'comp_id': instance.pk})
+        instance._cleared_participants = list(rows.values_list('comp_id', 'user_id'))
+    elif action == 'post_clear': joined(instance._cleared_participants, False)
+    elif action in ('post_add', 'post_remove'):
+        pairs = [(pk, instance.pk) for pk in pk_set] if reverse else [(instance.pk, pk) for pk in pk_set]
+        joined(pairs, action == 'post_add')
+
+
+@receiver(m2m_changed, sender=Comp.ques.through)
+def questions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action.startswith('post_'): changed(instance.pk)
+    elif action == 'pre_clear':
+        # by post_clear the question's rows are gone
+        instance._cleared_comps = list(sender.objects.filter(question_id=instance.pk).values_list('comp_id', flat=True))
+    elif action == 'post_clear': changed(*instance._cleared_comps)
+    elif action.startswith('post_'): changed(*pk_set)
+
+
+@receiver(post_save, sender=Question)
+@receiver(pre_delete, sender=Question)
+def question_changed(sender, instance, **kwargs):
+    changed(*Comp.ques.through.objects.filter(question_id=instance.pk).values_list('comp_id', flat=True))
@@ -0,0 +1,92 @@
+import logging, random, time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+_replica_reads = ContextVar('replica_reads', default=False)
+
+# seconds behind the primary; a replica that has replayed everything it
+# received is current even when the primary has been idle for a while
+LAG_SQL = (
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+def replicas():
+    return [alias for alias in settings.DATABASES if alias.startswith('replica')]
+
+
+@contextmanager
+def replica_reads(allowed=True):
+    """Lets the ORM read from a replica inside the block."""
+    token = _replica_reads.set(allowed)
+    try: yield
+    finally: _replica_reads.reset(token)
+
+
+def primary_reads():
+    """Sends the rest of the current ``replica_reads()`` block to the primary."""
+    _replica_reads.set(False)
+
+
+def pin_key(user):
+    return 'primary-pin:%d' % user.pk
+
+
+def pin_to_primary(user):
+    caches['shared'].set(pin_key(user), True, settings.REPLICA_PIN_SECONDS)
+
+
+def pinned(user):
+    """Whether ``user`` wrote recently enough that a replica may not have it yet."""
+    return user.is_authenticated and bool(caches['shared'].get(pin_key(user)))
+
+
+class ReplicaRouter:
+    """Reads inside ``replica_reads()`` go to a random replica that is at
+    most REPLICA_MAX_LAG seconds behind; everything else, and every read
+    when no replica qualifies, goes to ``default``.
+
+    Each replica's lag is measured at most every REPLICA_LAG_CHECK seconds
+    per process. One that can't be reached counts as too far behind until
+    the next check.
+    """
+
+    def __init__(self):
+        self.replicas = replicas()
+        self.lags = {}
+
+    def lag(self, alias):
+        checked, lag = self.lags.get(alias, (None, None))
+        now = time.monotonic()
+        if checked is None or now - checked > settings.REPLICA_LAG_CHECK:
+            try:
+                with connections[alias].cursor() as cursor:
+                    cursor.execute(LAG_SQL)
+                    lag = float(cursor.fetchone()[0])
+            except DatabaseError:
+                logger.warning("replica %s is unreachable", alias, exc_info=True)
+                lag = float('inf')
+            self.lags[alias] = (now, lag)
+        return lag
+
+    def db_for_read(self, model, **hints):
+        if not self.replicas or not _replica_reads.get(): return None
+        current = [alias for alias in self.replicas if self.lag(alias) <= settings.REPLICA_MAX_LAG]
+        return random.choice(current) if current else 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as default
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
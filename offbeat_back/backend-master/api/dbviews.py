@@ -4,9 +4,9 @@ from django.core.files import File
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
-os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
-
 from api.models import *
+from api.images import describe, save_original
+from api.metrics import INGEST_ARTICLES, INGEST_IMAGE_BYTES
 
 import datetime, logging
 from dateutil import parser
@@ -26,6 +26,7 @@ def add_news(headline, source, image, body, agency, tag, category, time, summary
         img = list(urllib.parse.urlsplit(image))
         img[2] = urllib.parse.quote(img[2])
         img = urllib.request.urlretrieve(urllib.parse.urlunsplit(img))
+    INGEST_IMAGE_BYTES.inc(os.path.getsize(img[0]))
     
     if type(time) == list: time = parser.parse(time[0], fuzzy = True)
     elif time: time = parser.parse(time, fuzzy = True)
@@ -45,10 +46,9 @@ def add_news(headline, source, image, body, agency, tag, category, time, summary
     if category: news.category.add(*category)
     if etags: news.etags.add(*etags)
     
-    news.image.save(
-        re.sub(r'[^A-Za-z0-9 ]+', '', headline).lower().replace("'", "").replace('"', '').replace(' ', '_')+".png",
-        File(open(img[0], 'rb'))
-    )
+    name = re.sub(r'[^A-Za-z0-9 ]+', '', headline).lower().replace("'", "").replace('"', '').replace(' ', '_')
+    save_original(news.image_original, img[0], name)
+    news.image.save(name+".png", File(open(img[0], 'rb')))
     
     image = Image.open(news.image.path)
     x, y = image.size
@@ -57,6 +57,7 @@ def add_news(headline, source, image, body, agency, tag, category, time, summary
     image = image.resize((fx, fy), Image.ANTIALIAS)
     image.save(news.image.path, quality = 90, optimize=True)
     
+    describe(news)
     news.save()
     
     return True
@@ -77,80 +78,96 @@ def myeval(s):
     try: return ast.literal_eval(s)
     except: return s
 
+def sheet_articles():
+    """The rows of the 'final' sheet, with tag and category names swapped for
+    ids; unknown names short enough for the models are created first."""
+    creds = ServiceAccountCredentials.from_json_keyfile_name(file_name,scope)
+    client = gspread.authorize(creds)
+
+    sheet = client.open('news').worksheet('final')
+    articles_csv = sheet.get_all_values()
+
+    articles = []
+    for k in articles_csv:
+        articles.append([myeval(i) for i in k])
+
+    all_topics = set()
+    for i in articles:
+        if type(i[5]) == list: all_topics.update(i[5])
+        else: all_topics.add(i[5])
+
+    for i in all_topics:
+        if len(i) > 29 or Tag.objects.filter(name = i): pass
+        else: Tag.objects.create(name = i)
+
+    tags = Tag.objects.all()
+
+    foo = {}
+    for i in tags:
+        foo[i.name] = i.id
+
+    all_cat = set()
+    for i in articles:
+        if type(i[6]) == list: all_cat.update(i[6])
+        else: all_cat.add(i[6])
+
+    for i in all_cat:
+        if len(i) > 30 or Category.objects.filter(name = i): pass
+        else: Category.objects.create(name = i)
+
+    cats = Category.objects.all()
+
+    foo2 = {}
+    for i in cats:
+        foo2[i.name] = i.id
+
+    for article in articles:
+        if type(article[5]) == list: article[5] = [foo[i] for i in article[5] if i in foo]
+        elif article[5] in foo: article[5] = [foo[article[5]]]
+        else: article[5] = []
+
+        if type(article[6]) == list: article[6] = [foo2[i] for i in article[6] if i in foo2]
+        elif article[6] in foo2: article[6] = [foo2[article[6]]]
+        else: article[6] = []
+
+    return articles
+
+
+def ingest(response, articles, n, images=None):
+    """add_news() for each ``(position, article)`` until ``n`` are new,
+    counting the outcome of each in the ``response`` report. ``images``
+    maps positions to already downloaded copies of the article's image."""
+    logger = logging.getLogger(__name__)
+    if images is None: images = {}
+    for i, article in articles:
+        INGEST_ARTICLES.labels('fetched').inc()
+        try:
+            r = add_news(*article[:2], images.get(i, article[2]), *article[3:])
+            INGEST_ARTICLES.labels('added' if r else 'deduped').inc()
+            if r:
+                response['new'] += 1
+                response['last_updated_news'] = {
+                    'headline': article[0],
+                    'body': article[8],
+                    'source': article[1],
+                    'image': article[2],
+                    'agency': article[4]
+                }
+            else: response['old'] += 1
+        except Exception as e:
+            INGEST_ARTICLES.labels('failed').inc()
+            News.objects.filter(source=article[1]).delete()
+            logger.error(e, exc_info=True)
+            response['invalid_news'][i+1] = {"news": article[0], "error": str(e)}
+        if response["new"] == n: break
+    return response
+
+
 class UpdateNews(APIView):
     def get(self, request, format=None):
         if request.user.is_superuser:
-            category = Category.objects.all()
-            tags = Tag.objects.all()
-
-            creds = ServiceAccountCredentials.from_json_keyfile_name(file_name,scope)
-            client = gspread.authorize(creds)
-
-            sheet = client.open('news').worksheet('final')
-            articles_csv = sheet.get_all_values()
-
-            articles = []
-            for k in articles_csv:
-                articles.append([myeval(i) for i in k])
-
-            all_topics = set()
-            for i in articles:
-                if type(i[5]) == list: all_topics.update(i[5])
-                else: all_topics.add(i[5])
-
-            for i in all_topics:
-                if len(i) > 29 or Tag.objects.filter(name = i): pass
-                else: Tag.objects.create(name = i)
-
-            tags = Tag.objects.all()
-
-            foo = {}
-            for i in tags:
-                foo[i.name] = i.id
-
-            all_cat = set()
-            for i in articles:
-                if type(i[6]) == list: all_cat.update(i[6])
-                else: all_cat.add(i[6])
-
-            for i in all_cat:
-                if len(i) > 30 or Category.objects.filter(name = i): pass
-                else: Category.objects.create(name = i)
-
-            cats = Category.objects.all()
-
-            foo2 = {}
-            for i in cats:
-                foo2[i.name] = i.id
-
-            for article in articles:
-                if type(article[5]) == list: article[5] = [foo[i] for i in article[5] if i in foo]
-                elif article[5] in foo: article[5] = [foo[article[5]]]
-                else: article[5] = []
-                
-                if type(article[6]) == list: article[6] = [foo2[i] for i in article[6] if i in foo2]
-                elif article[6] in foo2: article[6] = [foo2[article[6]]]
-                else: article[6] = []
-
+            articles = sheet_articles()
             response = {'invalid_news': {}, 'total_news': len(articles), 'new': 0, 'old': 0}
-            for i, article in enumerate(articles):
-                logger = logging.getLogger(__name__)
-                try:
-                    r = add_news(*article)
-                    if r:
-                        response['new'] += 1
-                        response['last_updated_news'] = {
-                            'headline': article[0],
-                            'body': article[8],
-                            'source': article[1],
-                            'image': article[2],
-                            'agency': article[4]
-                        }
-                    else: response['old'] += 1
-                except Exception as e:
-                    News.objects.filter(source=article[1]).delete()
-                    logger.error(e, exc_info=True)
-                    response['invalid_news'][i+1] = {"news": article[0], "error": str(e)}
-                if response["new"] == int(request.query_params.get("n", 20)): break
+            ingest(response, enumerate(articles), int(request.query_params.get("n", 20)))
         else: response = "FUCK OFF!!"
         return Response(response)
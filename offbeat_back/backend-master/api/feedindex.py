@@ -0,0 +1,201 @@
+import threading, time
+from collections import defaultdict
+from datetime import timedelta
+from functools import reduce
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import News, NewsChange
+
+EMPTY = np.empty(0, dtype=np.int32)
+
+
+def intersect(a, b):
+    """Ids in both ascending arrays: the shorter one binary searched in the
+    longer, or looked up in a mask of it when they are of similar size."""
+    if len(a) > len(b): a, b = b, a
+    if not len(a): return EMPTY
+    if len(a) * 16 < len(b): return a[b[np.minimum(np.searchsorted(b, a), len(b) - 1)] == a]
+    seen = np.zeros(max(a[-1], b[-1]) + 1, dtype=bool)
+    seen[b] = True
+    return a[seen[a]]
+
+
+def union(arrays):
+    """Ids in any of the ascending arrays, by marking them in a mask over the id range."""
+    arrays = [a for a in arrays if len(a)]
+    if len(arrays) < 2: return arrays[0] if arrays else EMPTY
+    seen = np.zeros(max(a[-1] for a in arrays) + 1, dtype=bool)
+    for a in arrays: seen[a] = True
+    return np.flatnonzero(seen).astype(np.int32)
+
+
+def around(ids, anchor, before, after):
+    """Up to ``before`` ids above the anchor and ``after`` below it, out of ascending ``ids``."""
+    start, stop = np.searchsorted(ids, anchor), np.searchsorted(ids, anchor, 'right')
+    return np.concatenate([ids[stop:stop + before], ids[max(start - after, 0):start]])
+
+
+class FeedIndex:
+    """Ascending arrays of visible news ids per independent flag, category
+    and tag, so feed filters are array intersections and unions instead of
+    index scans.
+
+    Built on first use (or by gunicorn's post_worker_init). News created in
+    the last FEED_INDEX_SETTLE seconds are the tail: they're read again on
+    every catch-up, at most every FEED_INDEX_REFRESH seconds, so categories
+    and tags added after the row (as add_news does) and rows committed out
+    of id order are picked up. Older rows are settled: edits to them
+    (visibility, categories, tags) are logged in NewsChange by whichever
+    process makes them, and each catch-up reads those rows again and moves
+    just their ids. Changes are read again while they're younger than
+    FEED_INDEX_SETTLE, so one committed out of order isn't passed over.
+    Only what bypasses the signals (queryset updates) waits for the full
+    rebuild every FEED_INDEX_REBUILD seconds, which runs in a thread while
+    the old arrays keep answering. Callers still filter on visibility when
+    they fetch rows.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings, self.selections, self.high_water = None, {}, 0
+        self.settled, self.tail = {}, []
+        self.changes_seen = 0
+        self.built = self.checked = 0
+        self.rebuilding = False
+
+    @staticmethod
+    def rows(after=0):
+        return News.objects.filter(visibility=True, id__gt=after).order_by('id').values_list(
+            'id', 'independent', 'category_ids', 'tag_ids', 'created_at')
+
+    @staticmethod
+    def add(lists, pk, independent, categories, tags, created_at=None):
+        lists['independent', independent].append(pk)
+        for category in categories: lists['category', category].append(pk)
+        for tag in tags: lists['tag', tag].append(pk)
+
+    @staticmethod
+    def append(postings, lists):
+        postings = dict(postings)
+        for key, ids in lists.items():
+            postings[key] = np.concatenate([postings.get(key, EMPTY), np.array(ids, dtype=np.int32)])
+        return postings
+
+    def replace(self, postings, ids, rows):
+        """``postings`` with ``ids`` taken out of every list and put back
+        from ``rows``, their current state (the visible ones, in id order)."""
+        postings, ids = dict(postings), np.array(ids, dtype=np.int32)
+        for key, posting in postings.items():
+            positions = np.searchsorted(posting, ids)
+            found = positions[posting[np.minimum(positions, len(posting) - 1)] == ids] if len(posting) else positions[:0]
+            if len(found): postings[key] = np.delete(posting, found)
+        lists = defaultdict(list)
+        for row in rows: self.add(lists, *row)
+        for key, added in lists.items():
+            posting = postings.get(key, EMPTY)
+            postings[key] = np.insert(posting, np.searchsorted(posting, added), added)
+        return postings
+
+    @staticmethod
+    def settled_changes(changes, seen):
+        """How far the NewsChange rows ``changes``, in id order, can be taken
+        as read: up to the first one younger than the settle delay."""
+        cutoff = timezone.now() - timedelta(seconds=settings.FEED_INDEX_SETTLE)
+        for pk, news, created_at in changes:
+            if created_at > cutoff: break
+            seen = pk
+        return seen
+
+    def settle(self, settled, rows, high_water):
+        """Adds the leading rows of ``rows`` created before the settle delay to
+        the ``settled`` lists; returns the new high water and the tail left."""
+        cutoff = timezone.now() - timedelta(seconds=settings.FEED_INDEX_SETTLE)
+        rows = iter(rows)
+        for row in rows:
+            if row[4] > cutoff: return high_water, [row, *rows]
+            self.add(settled, *row)
+            high_water = row[0]
+        return high_water, []
+
+    def build(self):
+        # changes made during the scan are read again by the next catch-up
+        cutoff = timezone.now() - timedelta(seconds=settings.FEED_INDEX_SETTLE)
+        changes_seen = NewsChange.objects.filter(created_at__lte=cutoff).aggregate(seen=Max('id'))['seen'] or 0
+        settled = defaultdict(list)
+        high_water, tail = self.settle(settled, self.rows().iterator(chunk_size=10000), 0)
+        settled = {key: np.array(ids, dtype=np.int32) for key, ids in settled.items()}
+        tail_lists = defaultdict(list)
+        for row in tail: self.add(tail_lists, *row)
+        with self.lock:
+            self.settled, self.tail, self.high_water = settled, tail, high_water
+            self.postings, self.selections = self.append(settled, tail_lists), {}
+            self.changes_seen = changes_seen
+            self.built = self.checked = time.monotonic()
+
+    def rebuild(self):
+        try:
+            self.build()
+            # every index built since has read these, or is due a rebuild itself
+            expired = timezone.now() - timedelta(seconds=2 * settings.FEED_INDEX_REBUILD)
+            NewsChange.objects.filter(created_at__lt=expired).delete()
+        finally:
+            self.rebuilding = False
+            connection.close()
+
+    def catch_up(self):
+        rows = list(self.rows(self.high_water))
+        changes = list(NewsChange.objects.filter(id__gt=self.changes_seen).order_by('id').values_list('id', 'news_id', 'created_at'))
+        # newer news are in the tail, which is read again anyway
+        edited = sorted({news for _, news, _ in changes if news <= self.high_water})
+        edited_rows = list(self.rows().filter(pk__in=edited)) if edited else []
+        with self.lock:
+            self.checked = time.monotonic()
+            self.changes_seen = max(self.changes_seen, self.settled_changes(changes, self.changes_seen))
+            # a rebuild may have swapped in newer arrays meanwhile
+            rows = [row for row in rows if row[0] > self.high_water]
+            if rows == self.tail and not edited: return
+            lists = defaultdict(list)
+            high_water, tail = self.settle(lists, rows, self.high_water)
+            settled = self.append(self.replace(self.settled, edited, edited_rows) if edited else self.settled, lists)
+            lists = defaultdict(list)
+            for row in tail: self.add(lists, *row)
+            self.settled, self.tail, self.high_water = settled, tail, high_water
+            self.postings, self.selections = self.append(settled, lists), {}
+
+    def current(self):
+        now = time.monotonic()
+        if self.postings is None: self.build()
+        elif now - self.built > settings.FEED_INDEX_REBUILD:
+            with self.lock:
+                start, self.rebuilding = not self.rebuilding, True
+            if start: threading.Thread(target=self.rebuild, daemon=True).start()
+        elif now - self.checked > settings.FEED_INDEX_REFRESH: self.catch_up()
+        return self.postings, self.selections
+
+    def select(self, independent, categories=None, tags=(), match_all=False):
+        """Ascending ids of visible news with that independent flag, in any of
+        ``categories`` (None for no category filter) and in any of ``tags``,
+        or all of them with ``match_all``."""
+        postings, selections = self.current()
+        key = (independent, None if categories is None else tuple(categories), tuple(tags), match_all)
+        if key in selections: return selections[key]
+
+        posting = lambda *key: postings.get(key, EMPTY)
+        ids = posting('independent', independent)
+        if categories is not None:
+            ids = intersect(ids, union([posting('category', pk) for pk in categories]))
+        if tags:
+            tagged = [posting('tag', pk) for pk in tags]
+            ids = intersect(ids, reduce(intersect, sorted(tagged, key=len)) if match_all else union(tagged))
+
+        # the hot feeds are few; the cache is dropped whenever the arrays change
+        if len(selections) < 256: selections[key] = ids
+        return ids
+
+
+feed_index = FeedIndex()
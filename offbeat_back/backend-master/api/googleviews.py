@@ -1,16 +1,64 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.hashers import make_password
-from rest_framework.utils import json
+from django.core.files.base import ContentFile
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
-import urllib.request, requests
+import requests
+from requests.adapters import HTTPAdapter
 from rest_framework_simplejwt.tokens import RefreshToken
 
 from django.contrib.auth.models import User
+from .images import describe
 from .models import Profile
+from .metrics import cache_lookup
+
+
+class GoogleTokenVerifier:
+    """Resolves a google access token to its userinfo.
+
+    One pooled session is shared by every request of the process and
+    verified tokens are cached under a hash of the token, so repeated
+    logins inside the TTL don't go back to google.
+    """
+
+    def __init__(self, url=None, timeout=None, ttl=None, pool_size=10):
+        self.url = url or settings.GOOGLE_USERINFO_URL
+        self.timeout = timeout or settings.GOOGLE_HTTP_TIMEOUT
+        self.ttl = settings.GOOGLE_TOKEN_CACHE_TTL if ttl is None else ttl
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=1)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def cache_key(self, token):
+        return 'google-token:' + hashlib.sha256(token.encode()).hexdigest()
+
+    def verify(self, token):
+        key = self.cache_key(token)
+        data = cache.get(key)
+        cache_lookup('google_token', data is not None)
+        if data is not None: return data
+
+        try:
+            r = self.session.get(self.url, params={'access_token': token}, timeout=self.timeout)
+            data = r.json()
+        except (requests.RequestException, ValueError) as e:
+            return {'error': str(e)}
+
+        if 'error' not in data and self.ttl: cache.set(key, data, self.ttl)
+        return data
+
+    def fetch(self, url):
+        r = self.session.get(url, timeout=self.timeout)
+        r.raise_for_status()
+        return r.content
 
-from django.core.files import File
 
 class Stats(APIView):
     def get(self, request, format=None):
@@ -19,49 +67,69 @@ class Stats(APIView):
         }
         return Response(response)
 
+
+def google_user(data, version):
+    """The user behind verified google userinfo, created on first login, and
+    whether the app should treat them as new; None for an unverified email."""
+    new_user = False
+
+    # create user if not exist
+    try:
+        user = User.objects.get(email=data.get('email'))
+        if user.profile.version < version: new_user = True
+
+    except User.DoesNotExist:
+
+        if data.get('verified_email') != True or 'email' not in data:
+            return None, False
+
+        user = User()
+        user.username = data.get('id')
+        user.first_name = data.get('given_name', '')
+        user.last_name = data.get('family_name', '')
+        # provider random default password
+        user.password = make_password(BaseUserManager().make_random_password())
+        user.email = data.get('email')
+        user.save()
+
+        new_user = True
+
+    return user, new_user
+
+
+def finish_login(user, new_user, image, version):
+    """Stores the google picture on the profile and returns the login response."""
+    profile = user.profile
+    profile.image.save(user.username+".png", ContentFile(image), save=False)
+    try: describe(profile)
+    # a picture PIL can't read doesn't stop the login, it only goes without a placeholder
+    except (OSError, ValueError): profile.image_width = profile.image_height = profile.image_blurhash = None
+    profile.version = version
+    profile.save()
+
+    token = RefreshToken.for_user(user)  # generate token without username & password
+    response = {}
+    response['new_user'] = new_user
+    response['username'] = user.username
+    response['access_token'] = str(token.access_token)
+    response['refresh_token'] = str(token)
+    return response
+
+
 class GoogleLogin(APIView):
+    verifier = GoogleTokenVerifier()
+
     def post(self, request):
-        payload = {'access_token': request.data.get("token")}  # validate the token
-        r = requests.get('https://www.googleapis.com/oauth2/v2/userinfo', params=payload)
-        data = json.loads(r.text)
+        token = request.data.get("token")
+        data = self.verifier.verify(token) if token else {'error': 'missing token'}  # validate the token
 
         if 'error' in data:
             content = {'message': 'wrong google token / this google token is already expired.'}
             return Response(content)
 
-        new_user = False
+        version = request.data.get("version", 0)
+        user, new_user = google_user(data, version)
+        if user is None: return Response({'message': 'email is not verified'})
 
-        # create user if not exist
-        try:
-            user = User.objects.get(email=data.get('email'))
-            if user.profile.version < request.data.get("version", 0): new_user = True
-
-        except User.DoesNotExist:
-
-            if data.get('verified_email') != True or 'email' not in data:
-                return Response({'message': 'email is not verified'})
-
-            user = User()
-            user.username = data.get('id')
-            user.first_name = data.get('given_name', '')
-            user.last_name = data.get('family_name', '')
-            # provider random default password
-            user.password = make_password(BaseUserManager().make_random_password())
-            user.email = data.get('email')
-            user.save()
-
-            new_user = True
-
-        profile = Profile.objects.get(user = user)
-        image = urllib.request.urlretrieve(data.get('picture'))
-        profile.image.save(user.username+".png", File(open(image[0], 'rb')))
-        profile.version = request.data.get("version", 0)
-        profile.save()
-
-        token = RefreshToken.for_user(user)  # generate token without username & password
-        response = {}
-        response['new_user'] = new_user
-        response['username'] = user.username
-        response['access_token'] = str(token.access_token)
-        response['refresh_token'] = str(token)
-        return Response(response)
+        image = self.verifier.fetch(data.get('picture'))
+        return Response(finish_login(user, new_user, image, version))
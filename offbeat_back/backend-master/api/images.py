@@ -0,0 +1,213 @@
+"""Resized copies ("renditions") of news and profile images, made on first
+request and kept in IMAGE_CACHE_DIR under MEDIA_ROOT, so api.media serves
+them (or hands them to the proxy) like any other media.
+
+Only IMAGE_WIDTHS and FORMATS are made, and never wider than the source.
+A rendition is named after the source file's name, size and mtime: a name
+can come back with new content once django_cleanup has deleted the file
+that had it, and the new file then gets new renditions. One process makes
+a given rendition while the others wait on its shard's flock and then
+find it made. The renditions' total size is kept in one file for every
+process; when it grows past IMAGE_CACHE_MAX_BYTES, the least recently
+served renditions are removed.
+
+Stored images are also described once, at upload: their size and a
+BlurHash placeholder are kept on the row and served with it.
+"""
+import fcntl, hashlib, io, os, tempfile, time
+
+import numpy as np
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.http import Http404, HttpResponseBadRequest
+from PIL import Image, ImageOps
+
+from . import media
+from .metrics import cache_lookup
+from .models import News, Profile
+
+FORMATS = {
+    'jpeg': ('JPEG', 'jpg', {'quality': 85, 'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'png': ('PNG', 'png', {'optimize': True}),
+}
+# how stale a rendition's last use may get before a hit records it
+TOUCH_SECONDS = 3600
+
+BASE83 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+
+
+def source_name(kind, pk):
+    if kind == 'news':
+        names = News.objects.filter(pk=pk, visibility=True).values_list('image_original', 'image').first()
+        return names and (names[0] or names[1])
+    if kind == 'profile':
+        return Profile.objects.filter(pk=pk).values_list('image', flat=True).first()
+    raise Http404
+
+
+def render(source, target, width, fmt):
+    kind, _, options = FORMATS[fmt]
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.width > width: image = image.resize((width, max(image.height * width // image.width, 1)), Image.LANCZOS)
+        if kind == 'JPEG' and image.mode not in ('RGB', 'L'): image = image.convert('RGB')
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(target))
+        try:
+            with os.fdopen(fd, 'wb') as f: image.save(f, kind, **options)
+            os.replace(temporary, target)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+
+class RenditionCache:
+    """Renditions on disk with their total size in ``.size`` at the root,
+    updated under its flock by whichever process adds or removes some; last
+    use is the files' atime, set explicitly since media volumes are often
+    mounted noatime."""
+
+    @property
+    def root(self):
+        return os.path.join(settings.MEDIA_ROOT, settings.IMAGE_CACHE_DIR)
+
+    def files(self):
+        for shard in os.scandir(self.root):
+            if shard.is_dir():
+                yield from (entry for entry in os.scandir(shard.path) if entry.is_file() and entry.name != '.lock')
+
+    def get(self, name, width, fmt):
+        """The rendition's path under MEDIA_ROOT, made if it isn't there yet."""
+        path = media.media_path(name)
+        source = os.stat(path)
+        key = hashlib.sha1(('%s:%d:%d' % (name, source.st_size, source.st_mtime_ns)).encode()).hexdigest()
+        relative = os.path.join(settings.IMAGE_CACHE_DIR, key[:2], '%s-%d.%s' % (key, width, FORMATS[fmt][1]))
+        target = os.path.join(settings.MEDIA_ROOT, relative)
+        try:
+            stat = os.stat(target)
+            cache_lookup('rendition', True)
+            if time.time() - stat.st_atime > TOUCH_SECONDS: os.utime(target, (time.time(), stat.st_mtime))
+            return relative
+        except FileNotFoundError:
+            cache_lookup('rendition', False)
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(os.path.join(os.path.dirname(target), '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # made by whoever held the lock before us
+            if os.path.exists(target): return relative
+            try: render(path, target, width, fmt)
+            except (OSError, ValueError): raise Http404
+        self.added(target)
+        return relative
+
+    def added(self, path):
+        size = os.path.getsize(path)
+        with os.fdopen(os.open(os.path.join(self.root, '.size'), os.O_RDWR | os.O_CREAT), 'r+') as total:
+            fcntl.flock(total, fcntl.LOCK_EX)
+            counted = total.read()
+            # counted for the first time, the new rendition included
+            used = int(counted) + size if counted else sum(entry.stat().st_size for entry in self.files())
+            if used > settings.IMAGE_CACHE_MAX_BYTES: used = self.evict(keep=path)
+            total.seek(0)
+            total.truncate()
+            total.write(str(used))
+
+    def evict(self, keep):
+        """Removes the least recently served renditions but ``keep``, which is
+        about to be served, down to 90% of the budget and returns the size
+        left, measured again on the way."""
+        entries = sorted(((entry.stat(), entry.path) for entry in self.files()), key=lambda e: e[0].st_atime)
+        size, goal = sum(stat.st_size for stat, _ in entries), settings.IMAGE_CACHE_MAX_BYTES * 0.9
+        for stat, path in entries:
+            if size <= goal: break
+            if path == keep: continue
+            try: os.remove(path)
+            except FileNotFoundError: pass
+            size -= stat.st_size
+        return size
+
+
+renditions = RenditionCache()
+
+
+def rendition(request, kind, pk):
+    try: width = int(request.GET.get('w', ''))
+    except ValueError: width = None
+    fmt = request.GET.get('fmt', 'jpeg')
+    if width not in settings.IMAGE_WIDTHS or fmt not in FORMATS:
+        return HttpResponseBadRequest("w must be one of %s and fmt one of %s" % (
+            ', '.join(map(str, settings.IMAGE_WIDTHS)), ', '.join(FORMATS)))
+
+    name = source_name(kind, pk)
+    if not name: raise Http404
+    # the url stays when the picture is replaced; the rendition's ETag doesn't
+    return media.serve(request, renditions.get(name, width, fmt))
+
+
+def save_original(field, path, name):
+    """Stores the image at ``path`` in ``field`` as ``name``, no wider than
+    NEWS_IMAGE_MAX_WIDTH, as the source for its renditions."""
+    with Image.open(path) as image:
+        kind = image.format if image.format in ('JPEG', 'PNG', 'WEBP') else 'PNG'
+        image = ImageOps.exif_transpose(image)
+        width = settings.NEWS_IMAGE_MAX_WIDTH
+        if image.width > width: image = image.resize((width, max(image.height * width // image.width, 1)), Image.LANCZOS)
+        if kind == 'JPEG' and image.mode not in ('RGB', 'L'): image = image.convert('RGB')
+        buffer = io.BytesIO()
+        image.save(buffer, kind, **FORMATS[kind.lower()][2])
+    field.save('%s.%s' % (name, FORMATS[kind.lower()][1]), ContentFile(buffer.getvalue()), save=False)
+
+
+def base83(value, length):
+    return ''.join(BASE83[value // 83 ** (length - i - 1) % 83] for i in range(length))
+
+
+def blurhash(image, x=4, y=3):
+    """The BlurHash (blurha.sh) of a PIL image with ``x`` by ``y`` components,
+    worked out on a 32px copy."""
+    small = image.convert('RGB')
+    small.thumbnail((32, 32))
+    rgb = np.asarray(small, dtype=np.float64) / 255
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    height, width = linear.shape[:2]
+
+    factors = []
+    for j in range(y):
+        for i in range(x):
+            basis = np.outer(np.cos(np.pi * j * np.arange(height) / height), np.cos(np.pi * i * np.arange(width) / width))
+            scale = 1 if i == j == 0 else 2
+            factors.append(scale * (basis[..., None] * linear).sum(axis=(0, 1)) / (width * height))
+    dc, ac = factors[0], np.array(factors[1:])
+
+    def srgb(value):
+        value = min(max(value, 0), 1)
+        return int(value * 12.92 * 255 + 0.5) if value <= 0.0031308 else int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+    hash = base83((x - 1) + (y - 1) * 9, 1)
+    quantised = int(max(0, min(82, np.floor(np.abs(ac).max() * 166 - 0.5)))) if len(ac) else 0
+    hash += base83(quantised, 1)
+    hash += base83((srgb(dc[0]) << 16) + (srgb(dc[1]) << 8) + srgb(dc[2]), 4)
+    maximum = (quantised + 1) / 166
+    for factor in ac:
+        r, g, b = (int(max(0, min(18, np.floor(np.copysign(abs(v / maximum) ** 0.5, v) * 9 + 9.5)))) for v in factor)
+        hash += base83(r * 19 * 19 + g * 19 + b, 2)
+    return hash
+
+
+def measure(source):
+    """The width, height and BlurHash of the image in ``source``, a path or
+    an open file such as an upload that isn't stored yet."""
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        return image.width, image.height, blurhash(image)
+
+
+def describe(instance):
+    """Fills ``instance``'s image_width, image_height and image_blurhash from its
+    image, so clients can lay out and paint a card before the image loads."""
+    if not instance.image:
+        instance.image_width = instance.image_height = instance.image_blurhash = None
+        return
+    instance.image_width, instance.image_height, instance.image_blurhash = measure(instance.image.path)
@@ -0,0 +1,80 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Min, Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from .metrics import cache_lookup
+from .models import Comp, Event, Organization
+from .pagination import page_number
+from .versions import bump, version
+
+# ?when= for competitions and events: the filter and the order it lists in
+WINDOWS = {
+    'upcoming': (lambda now: Q(start_time__gt=now), 'start_time'),
+    'live': (lambda now: Q(start_time__lte=now, end_time__gt=now), 'end_time'),
+    'past': (lambda now: Q(end_time__lte=now), '-start_time'),
+}
+
+
+def next_change(model, now):
+    """When the next start or end moves a row of ``model`` into another window."""
+    times = model.objects.aggregate(
+        start=Min('start_time', filter=Q(start_time__gt=now)), end=Min('end_time', filter=Q(end_time__gt=now)))
+    return min((t for t in times.values() if t is not None), default=None)
+
+
+def listing(request, name, queryset, serializer_class, participants=None):
+    """``serializer_class`` output for ``queryset`` narrowed to ``?when=`` and
+    ``?page=`` (20 a page). Cached until a competition, event or
+    organization changes, or until the next start or end time when that's
+    sooner.
+
+    With ``participants``, the rows' participants through model, each row
+    also lists its participants' ids. Those change with every registration,
+    so they're cached apart, for LISTING_PARTICIPANTS_TTL seconds, and
+    registrations leave the rest of the listing cached."""
+    when, page = request.GET.get('when'), request.GET.get('page')
+    if when is not None and when not in WINDOWS:
+        raise ValidationError({'when': 'one of %s' % ', '.join(WINDOWS)})
+    if page is not None: page = page_number(page)
+
+    key = 'listing:%s:%s:%s:%s' % (version('listings-version'), name, when, page)
+    data = cache.get(key)
+    cache_lookup('listing', data is not None)
+    if data is None:
+        now = timezone.now()
+        if when is not None:
+            window, order = WINDOWS[when]
+            queryset = queryset.filter(window(now)).order_by(order, 'id')
+        if page is not None: queryset = queryset[(page - 1) * 20:page * 20]
+        data = serializer_class(queryset, many=True).data
+
+        timeout, change = settings.LISTING_CACHE_TTL, next_change(queryset.model, now)
+        if change is not None: timeout = min(timeout, max((change - now).total_seconds(), 1))
+        cache.set(key, data, timeout)
+
+    if participants is None: return data
+    members = cache.get(key + ':participants')
+    cache_lookup('listing_participants', members is not None)
+    if members is None:
+        members = {row['id']: [] for row in data}
+        rows = participants.objects.filter(**{name + '_id__in': members}).order_by('id')
+        for pk, user in rows.values_list(name + '_id', 'user_id'): members[pk].append(user)
+        cache.set(key + ':participants', members, settings.LISTING_PARTICIPANTS_TTL)
+    return [dict(row, participants=members[row['id']]) for row in data]
+
+
+@receiver(post_save, sender=Comp)
+@receiver(post_delete, sender=Comp)
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+@receiver(m2m_changed, sender=Comp.org.through)
+@receiver(m2m_changed, sender=Event.comp.through)
+def drop_listings(sender, **kwargs):
+    # every cached listing goes at once; they are few and cheap to rebuild
+    bump('listings-version')
@@ -0,0 +1,72 @@
+import random, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Sum
+from django.utils import timezone
+
+from api.models import Event, Organization
+from api.registration import register, reshard
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class Command(BaseCommand):
+    help = ("Registers many users for one event at once, with the capacity in one shard and in many, "
+            "and checks that nobody is registered twice and the event isn't overbooked")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=5000)
+        parser.add_argument('--capacity', type=int, default=2000)
+        parser.add_argument('--clients', type=int, default=64, help="concurrent registrations")
+        parser.add_argument('--repeats', type=float, default=0.2, help="share of users who register twice")
+        parser.add_argument('--shards', type=int, nargs='+', default=[1, 16])
+
+    def handle(self, *args, **options):
+        users = User.objects.bulk_create([User(username='bench-registration-%d' % i) for i in range(options['users'])])
+        org = Organization.objects.create(name='bench-registration')
+        now = timezone.now()
+        self.stdout.write("%6s %8s %9s %9s %9s %11s %9s" % ('shards', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'registered', 'left'))
+        try:
+            for shards in options['shards']:
+                event = Event.objects.create(name='bench-registration', org=org, fee=0, capacity=options['capacity'],
+                                             start_time=now + timedelta(days=1), end_time=now + timedelta(days=2))
+                reshard(event, shards)
+                requests = users + random.sample(users, int(len(users) * options['repeats']))
+                random.shuffle(requests)
+                latencies, elapsed = self.load(event, requests, options['clients'])
+
+                registered = event.participants.count()
+                left = event.capacity_shards.aggregate(left=Sum('remaining'))['left']
+                self.stdout.write("%6d %8d %9.0f %9.1f %9.1f %11d %9d" % (
+                    shards, len(requests), len(requests) / elapsed,
+                    percentile(latencies, 50), percentile(latencies, 95), registered, left))
+                if registered != min(options['capacity'], len(users)) or registered + left != options['capacity']:
+                    self.stderr.write("capacity %d doesn't add up" % options['capacity'])
+        finally:
+            Organization.objects.filter(pk=org.pk).delete()
+            User.objects.filter(username__startswith='bench-registration-').delete()
+
+    def load(self, event, requests, clients):
+        latencies, lock = [], threading.Lock()
+        queue = iter(requests)
+
+        def client(i):
+            try:
+                while True:
+                    with lock: user = next(queue, None)
+                    if user is None: return
+                    start = time.perf_counter()
+                    register(event, user)
+                    with lock: latencies.append((time.perf_counter() - start) * 1000)
+            finally: connection.close()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(clients) as pool: list(pool.map(client, range(clients)))
+        return latencies, time.perf_counter() - start
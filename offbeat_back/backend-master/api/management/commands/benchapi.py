@@ -0,0 +1,141 @@
+"""Times the API against a seeded database and compares with a baseline.
+
+benchmarks/baseline.json is a reference run on
+
+    manage.py seed --news 200000 --users 5000 --votes 300000 --saves 300000
+
+and keeps each case's p50, p95 and query count. Query counts carry over
+to any machine; timings don't. To check a change for a slowdown, seed the
+same way, write a baseline of your own from the base commit and compare
+the change against it:
+
+    git checkout <base> && manage.py benchapi --save --baseline /tmp/baseline.json
+    git checkout <change> && manage.py benchapi --baseline /tmp/baseline.json
+
+The run fails when a case's p95 is more than --tolerance slower or it
+runs more queries. Commit a new benchmarks/baseline.json (--save, on the
+reference seed) when a change is meant to move the numbers.
+"""
+import json, os, tempfile, time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from api.models import MyCategory, News, Save, Tag, Vote
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class Command(BaseCommand):
+    help = "Times every NewsView mode plus /save/, /vote/ and ingestion and compares against a baseline"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--only', nargs='*', help="names of the cases to run")
+        parser.add_argument('--baseline', default=os.path.join(settings.BASE_DIR, 'benchmarks', 'baseline.json'))
+        parser.add_argument('--save', action='store_true', help="store this run as the new baseline")
+        parser.add_argument('--tolerance', type=float, default=0.2, help="allowed p95 slowdown, 0.2 = 20%%")
+
+    def handle(self, *args, **options):
+        client = Client(HTTP_HOST='127.0.0.1')
+        results = {}
+        for name, run in self.cases():
+            if options['only'] and name not in options['only']: continue
+            results[name] = self.measure(client, run, options['runs'], options['warmup'])
+            self.stdout.write("%-12s p50 %8.2fms  p95 %8.2fms  queries %4d" % (
+                name, results[name]['p50'], results[name]['p95'], results[name]['queries']))
+
+        if options['save']:
+            os.makedirs(os.path.dirname(options['baseline']), exist_ok=True)
+            with open(options['baseline'], 'w') as f: json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write("baseline written to %s" % options['baseline'])
+        elif os.path.exists(options['baseline']):
+            with open(options['baseline']) as f: baseline = json.load(f)
+            self.compare(results, baseline, options['tolerance'])
+        else:
+            self.stdout.write("no baseline at %s, nothing compared; write one with --save" % options['baseline'])
+
+    def cases(self):
+        news = News.objects.filter(visibility=True, independent=False)
+        anchor = news.order_by('-id').values_list('id', flat=True)[1000:1001].first() or news.values_list('id', flat=True).last()
+        category = news.order_by('-id').values_list('category__name', flat=True).first()
+        word = news.order_by('-id').values_list('headline', flat=True).first()
+        tags = list(Tag.objects.order_by('id').values_list('id', flat=True)[:2])
+        reader = MyCategory.objects.order_by('id').values_list('user_id', flat=True).first()
+        voter = Vote.objects.order_by('-id').values_list('user_id', flat=True).first()
+        saver = Save.objects.order_by('-id').values_list('user_id', flat=True).first()
+        if anchor is None: raise CommandError("no visible news, run `manage.py seed` first")
+
+        def get(path, user=None):
+            headers = {}
+            if user: headers['HTTP_AUTHORIZATION'] = self.token(user)
+            return lambda client: client.get(path, **headers)
+
+        yield 'page', get('/news/?page=3')
+        yield 'card', get('/news/?page=3&view=card')
+        yield 'detail', get('/news/%d/' % anchor)
+        yield 'category', get('/news/?category=%s' % category)
+        if tags: yield 'tag', get('/news/?tag=%s' % ','.join(map(str, tags)))
+        yield 'id', get('/news/?id=%d&next=10&prev=10' % anchor)
+        yield 'trending', get('/news/?category=trending')
+        if reader: yield 'preference', get('/news/?category=preference', reader)
+        if word: yield 'search', get('/news/?search=%s' % word.split()[0])
+        yield 'similar', get('/news/?similar=%d' % anchor)
+        if saver: yield 'save', get('/save/', saver)
+        if voter: yield 'vote', get('/vote/', voter)
+        yield 'ingest', self.ingest
+
+    def token(self, user_id):
+        return 'Bearer %s' % RefreshToken.for_user(User(pk=user_id)).access_token
+
+    def ingest(self, client):
+        from api.dbviews import add_news
+
+        if not hasattr(self, 'image'):
+            fd, self.image = tempfile.mkstemp(suffix='.png')
+            os.close(fd)
+            Image.new('RGB', (1200, 800), (90, 120, 200)).save(self.image)
+            self.ingested = 0
+
+        self.ingested += 1
+        source = 'https://bench.local/ingest/%d/%d' % (os.getpid(), self.ingested)
+        add_news('bench ingest %d' % self.ingested, source, 'file://' + self.image, '', 'Bench',
+                 [], [], timezone.now().isoformat(), 'bench body', None, ['bench'])
+        News.objects.filter(source=source).delete()
+
+    def measure(self, client, run, runs, warmup):
+        for _ in range(warmup): run(client)
+
+        timings, queries = [], 0
+        for _ in range(runs):
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                response = run(client)
+                timings.append((time.perf_counter() - start) * 1000)
+            if response is not None and response.status_code >= 400:
+                raise CommandError("%s returned %d" % (response.request['PATH_INFO'], response.status_code))
+            queries = max(queries, len(captured))
+
+        return {'p50': percentile(timings, 50), 'p95': percentile(timings, 95), 'queries': queries}
+
+    def compare(self, results, baseline, tolerance):
+        regressions = []
+        for name, result in results.items():
+            if name not in baseline: continue
+            before = baseline[name]
+            change = result['p95'] / before['p95'] - 1 if before['p95'] else 0
+            self.stdout.write("%-12s p95 %+6.1f%%  queries %d -> %d" % (name, change * 100, before['queries'], result['queries']))
+            if change > tolerance or result['queries'] > before['queries']: regressions.append(name)
+
+        if regressions: raise CommandError("regressed against baseline: %s" % ", ".join(regressions))
@@ -0,0 +1,134 @@
+import io, json, os, random, subprocess, sys, threading, time, uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+SERVERS = {
+    'sync': ['newscatcher_backend.wsgi'],
+    'async': ['newscatcher_backend.asgi', '-k', 'uvicorn.workers.UvicornWorker'],
+}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def slow_google(delay, users):
+    """A userinfo endpoint and picture host that take ``delay`` seconds to answer."""
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), (200, 80, 40)).save(buffer, 'PNG')
+    picture = buffer.getvalue()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            url = urlsplit(self.path)
+            if url.path == '/picture.png': body, kind = picture, 'image/png'
+            else:
+                n = hash(parse_qs(url.query).get('access_token', [''])[0]) % users
+                body, kind = json.dumps({
+                    'id': 'bench-google-%d' % n, 'email': 'bench-%d@bench.local' % n, 'verified_email': True,
+                    'given_name': 'Bench', 'family_name': str(n),
+                    'picture': 'http://%s:%d/picture.png' % self.server.server_address,
+                }).encode(), 'application/json'
+            self.send_response(200)
+            self.send_header('Content-Type', kind)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Command(BaseCommand):
+    help = ("Serves the api with sync gunicorn workers, then with uvicorn workers and the async views, "
+            "and compares throughput under a mix of feed reads and google logins against a slow google")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2)
+        parser.add_argument('--clients', type=int, default=64, help="concurrent clients")
+        parser.add_argument('--duration', type=float, default=20, help="seconds per server")
+        parser.add_argument('--delay', type=float, default=0.5, help="seconds google takes per call")
+        parser.add_argument('--logins', type=float, default=0.2, help="share of requests that are logins")
+        parser.add_argument('--port', type=int, default=8400)
+        parser.add_argument('--only', choices=sorted(SERVERS))
+
+    def handle(self, *args, **options):
+        google = slow_google(options['delay'], users=20)
+        env = dict(os.environ, GOOGLE_USERINFO_URL='http://%s:%d/userinfo' % google.server_address)
+
+        self.stdout.write("%-6s %-6s %8s %8s %7s %9s %9s" % ('server', 'kind', 'requests', 'req/s', 'errors', 'p50 ms', 'p95 ms'))
+        try:
+            for name, command in SERVERS.items():
+                if options['only'] and name != options['only']: continue
+                env['ASYNC_VIEWS'] = '1' if name == 'async' else '0'
+                base = 'http://127.0.0.1:%d' % options['port']
+                server = subprocess.Popen(
+                    [sys.executable, '-m', 'gunicorn', *command, '-w', str(options['workers']),
+                     '-b', base[len('http://'):], '--timeout', '120'],
+                    cwd=settings.BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                try:
+                    self.wait_for(base, server)
+                    self.report(name, *self.load(base, options))
+                finally:
+                    server.terminate()
+                    server.wait()
+        finally:
+            google.shutdown()
+            # profiles go with their users and django_cleanup removes the pictures
+            User.objects.filter(email__endswith='@bench.local').delete()
+
+    def wait_for(self, base, server, timeout=120):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if server.poll() is not None: raise CommandError("server exited with %d" % server.returncode)
+            try:
+                if requests.get(base + '/category/', timeout=5).ok: return
+            except requests.RequestException:
+                pass
+            time.sleep(0.5)
+        raise CommandError("server didn't come up in %ds" % timeout)
+
+    def load(self, base, options):
+        samples, lock = defaultdict(list), threading.Lock()
+        deadline = time.monotonic() + options['duration']
+
+        def client(i):
+            rng, http = random.Random(i), requests.Session()
+            while time.monotonic() < deadline:
+                if rng.random() < options['logins']:
+                    kind, request = 'login', lambda: http.post(base + '/auth/google/', json={'token': uuid.uuid4().hex}, timeout=60)
+                else:
+                    kind, request = 'feed', lambda: http.get(base + '/news/', params={'page': rng.randint(1, 5)}, timeout=60)
+                start = time.perf_counter()
+                try: ok = request().status_code < 400
+                except requests.RequestException: ok = False
+                with lock: samples[kind].append((time.perf_counter() - start, ok))
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(options['clients']) as pool:
+            list(pool.map(client, range(options['clients'])))
+        return samples, time.monotonic() - start
+
+    def report(self, name, samples, elapsed):
+        for kind, values in sorted(samples.items()) + [('total', sum(samples.values(), []))]:
+            if not values: continue
+            latencies = [v[0] * 1000 for v in values]
+            errors = sum(1 for v in values if not v[1])
+            self.stdout.write("%-6s %-6s %8d %8.1f %6.2f%% %9.1f %9.1f" % (
+                name, kind, len(values), len(values) / elapsed, 100 * errors / len(values),
+                percentile(latencies, 50), percentile(latencies, 95)))
@@ -0,0 +1,49 @@
+from django.contrib.auth.models import User, update_last_login
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+from django.test.utils import CaptureQueriesContext
+
+from api.models import Profile
+
+
+def legacy_profile_sync(sender, instance, created, **kwargs):
+    # what every User.save() used to do before profile writes were tracked
+    instance.profile.save(update_fields=[f.name for f in Profile._meta.concrete_fields if not f.primary_key])
+
+
+class Command(BaseCommand):
+    help = "Counts the queries behind registration, login and a google re-login"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--legacy', action='store_true', help="also measure the old per-save profile sync")
+
+    def handle(self, *args, **options):
+        rows = [('current', self.measure())]
+        if options['legacy']:
+            post_save.connect(legacy_profile_sync, sender=User)
+            try: rows.append(('legacy', self.measure()))
+            finally: post_save.disconnect(legacy_profile_sync, sender=User)
+
+        self.stdout.write("%-8s %12s %6s %14s" % ('', 'registration', 'login', 'google-relogin'))
+        for name, counts in rows:
+            self.stdout.write("%-8s %12d %6d %14d" % (name, *counts))
+
+    def measure(self):
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as register:
+                user = User.objects.create_user('bench-auth-user', 'bench@auth.local', 'x')
+
+            user = User.objects.get(pk=user.pk)
+            with CaptureQueriesContext(connection) as login:
+                update_last_login(None, user)
+
+            user = User.objects.get(pk=user.pk)
+            with CaptureQueriesContext(connection) as relogin:
+                profile = user.profile
+                profile.version = profile.version
+                profile.save()
+
+            transaction.set_rollback(True)
+
+        return len(register), len(login), len(relogin)
@@ -0,0 +1,44 @@
+import json, time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from api.models import News
+from api.serializers import NewsListSerializer, NewsSerializer
+
+
+class Command(BaseCommand):
+    help = "Compares NewsSerializer with NewsListSerializer on the same page of news"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=20, help="news per page")
+        parser.add_argument('--runs', type=int, default=50)
+        parser.add_argument('--user', help="username to serialize for, anonymous when omitted")
+
+    def handle(self, *args, **options):
+        request = Request(APIRequestFactory().get('/news/'))
+        if options['user']: request.user = User.objects.get(username=options['user'])
+
+        page = News.objects.filter(visibility=True).order_by('-id')[:options['size']]
+        if not page: raise CommandError("no visible news, run `manage.py seed` first")
+
+        def model_serializer():
+            queryset = NewsSerializer.setup_eager_loading(page, request)
+            return NewsSerializer(queryset, many=True, context={'request': request}).data
+
+        def list_serializer():
+            return NewsListSerializer(page, request).data
+
+        if json.dumps(model_serializer()) != json.dumps(list_serializer()):
+            raise CommandError("NewsListSerializer output differs from NewsSerializer")
+
+        items = len(page) * options['runs']
+        timings = {}
+        for name, serialize in (('NewsSerializer', model_serializer), ('NewsListSerializer', list_serializer)):
+            start = time.perf_counter()
+            for _ in range(options['runs']): serialize()
+            timings[name] = (time.perf_counter() - start) / items * 1e6
+            self.stdout.write("%-20s %8.1f us/item" % (name, timings[name]))
+        self.stdout.write("speedup %.1fx" % (timings['NewsSerializer'] / timings['NewsListSerializer']))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from api.images import describe
+from api.models import News, Profile
+
+FIELDS = ['image_width', 'image_height', 'image_blurhash']
+
+
+class Command(BaseCommand):
+    help = "Stores the size and blurhash of news and profile images stored before they were computed at upload"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="describe every image again, not only the missing ones")
+        parser.add_argument('--batch', type=int, default=500)
+
+    def handle(self, *args, **options):
+        for model in (News, Profile):
+            rows = model.objects.exclude(image='').exclude(image=None).only('id', 'image', *FIELDS).order_by('id')
+            if not options['all']: rows = rows.filter(image_blurhash=None)
+            described, failed, after = 0, 0, 0
+            while True:
+                batch = list(rows.filter(id__gt=after)[:options['batch']])
+                if not batch: break
+                done = []
+                for instance in batch:
+                    try: describe(instance)
+                    except (OSError, ValueError):
+                        failed += 1
+                        continue
+                    done.append(instance)
+                model.objects.bulk_update(done, FIELDS)
+                described, after = described + len(done), batch[-1].id
+            self.stdout.write("%s: described %d images, %d unreadable" % (model.__name__, described, failed))
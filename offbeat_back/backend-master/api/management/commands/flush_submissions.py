@@ -0,0 +1,28 @@
+import fcntl, os, time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api import submissions
+
+
+class Command(BaseCommand):
+    help = "Moves buffered quiz submissions from SUBMISSION_BUFFER_DIR into the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=float, help="keep flushing, every this many seconds")
+
+    def handle(self, *args, **options):
+        if not settings.SUBMISSION_BUFFER_DIR: raise CommandError("SUBMISSION_BUFFER_DIR isn't set")
+        os.makedirs(settings.SUBMISSION_BUFFER_DIR, exist_ok=True)
+
+        # a second flusher would write the same batches twice
+        with open(os.path.join(settings.SUBMISSION_BUFFER_DIR, 'flush.lock'), 'w') as lock:
+            try: fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError: raise CommandError("another flush_submissions is running")
+            while True:
+                for comp in submissions.buffered():
+                    written = submissions.flush(comp)
+                    if written: self.stdout.write("competition %d: %d submissions" % (comp, written))
+                if options['every'] is None: return
+                time.sleep(options['every'])
@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.competition import changed, competitions
+from api.models import CompSub
+
+
+class Command(BaseCommand):
+    help = "Grades a competition's stored submissions again, after its answers changed or for rows stored ungraded"
+
+    def add_arguments(self, parser):
+        parser.add_argument('comp', type=int)
+        parser.add_argument('--batch', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        comp = competitions.get(options['comp'])
+        if comp is None: raise CommandError("no competition %d" % options['comp'])
+
+        rows = CompSub.objects.filter(comp_id=comp.pk).order_by('id').values_list('id', 'ans')
+        graded, grading, after = 0, 0.0, 0
+        while True:
+            batch = list(rows.filter(id__gt=after)[:options['batch']])
+            if not batch: break
+            start = time.perf_counter()
+            scores = comp.key.grade([ans for _, ans in batch])
+            grading += time.perf_counter() - start
+            CompSub.objects.bulk_update(
+                [CompSub(id=pk, score=score) for (pk, _), score in zip(batch, scores.tolist())], ['score'], batch_size=1000)
+            graded, after = graded + len(batch), batch[-1][0]
+
+        # leaderboards are rebuilt from the new scores
+        changed(comp.pk)
+        self.stdout.write("graded %d submissions against %d answers (%.0f ms grading)" % (graded, comp.key.top, grading * 1000))
@@ -0,0 +1,153 @@
+import json, random, threading, time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from api.models import Category
+
+# what the app does in a session; every step name is a method on VirtualUser
+SESSIONS = {
+    'browse': {'weight': 6, 'steps': ['launch', 'feed', 'scroll', 'scroll', 'scroll', 'scroll']},
+    'engage': {'weight': 3, 'steps': ['launch', 'feed', 'scroll', 'vote', 'scroll', 'save', 'scroll', 'vote']},
+    'search': {'weight': 1, 'steps': ['launch', 'search', 'scroll', 'save']},
+}
+
+WORDS = ['india', 'election', 'market', 'cricket', 'climate', 'health', 'court', 'police']
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class VirtualUser:
+    """One app install: its own connection pool, token and feed position."""
+
+    def __init__(self, base, token, categories, record, think, rng):
+        self.base, self.record, self.think, self.random = base.rstrip('/'), record, think, rng
+        self.categories = categories
+        self.http = requests.Session()
+        self.http.headers['Authorization'] = 'Bearer %s' % token
+        self.items, self.query = [], {}
+
+    def request(self, step, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.http.request(method, self.base + path, timeout=30, **kwargs)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            response, ok = None, False
+        self.record(step, time.perf_counter() - start, ok)
+        if self.think: time.sleep(self.random.expovariate(1 / self.think))
+        return response.json() if ok and response.content else None
+
+    def run(self, steps):
+        for step in steps: getattr(self, step)()
+
+    def launch(self):
+        for path in ('/current_version/', '/category/', '/topic/', '/quote/'):
+            self.request('launch', 'GET', path)
+
+    def show(self, step, query):
+        data = self.request(step, 'GET', '/news/', params=query)
+        if data and data.get('prev'):
+            self.items, self.query = data['prev'], query
+
+    def feed(self):
+        category = self.random.choice(self.categories + ['trending', 'preference'])
+        self.show('feed', {'category': category})
+
+    def search(self):
+        self.show('search', {'search': self.random.choice(WORDS)})
+
+    def scroll(self):
+        if not self.items: return self.feed()
+        query = dict(self.query, id=self.items[-1]['id'], next=0, prev=10)
+        self.show('scroll', query)
+
+    def pick(self):
+        return self.random.choice(self.items) if self.items else None
+
+    def vote(self):
+        news = self.pick()
+        if not news: return
+        if news.get('vote'):
+            self.request('vote', 'PATCH', '/vote/%d/' % news['vote']['id'], json={'polarity': not news['vote']['polarity']})
+        else:
+            data = self.request('vote', 'POST', '/vote/', json={'news': news['id'], 'polarity': self.random.random() < 0.7})
+            if data: news['vote'] = data
+
+    def save(self):
+        news = self.pick()
+        if not news: return
+        if news.get('save'):
+            self.request('save', 'DELETE', '/save/%d/' % news['save']['id'])
+            news['save'] = None
+        else:
+            data = self.request('save', 'POST', '/save/', json={'news': news['id']})
+            if data: news['save'] = data
+
+
+class Command(BaseCommand):
+    help = "Replays weighted mobile-app sessions against a running server with many virtual users"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--users', type=int, default=50, help="concurrent virtual users")
+        parser.add_argument('--duration', type=float, default=60, help="seconds to run")
+        parser.add_argument('--think', type=float, default=0.5, help="mean pause between requests, seconds")
+        parser.add_argument('--sessions', help="json file of {name: {weight, steps}} replacing the built-in mix")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        sessions = SESSIONS
+        if options['sessions']:
+            with open(options['sessions']) as f: sessions = json.load(f)
+        for name, session in sessions.items():
+            unknown = [s for s in session['steps'] if not callable(getattr(VirtualUser, s, None))]
+            if unknown: raise CommandError("session %s has unknown steps: %s" % (name, ", ".join(unknown)))
+
+        # tokens are minted locally so the run needs no login round-trips
+        users = list(User.objects.order_by('?')[:options['users']])
+        if not users: raise CommandError("no users, run `manage.py seed` first")
+        categories = list(Category.objects.values_list('name', flat=True))
+
+        samples, lock = defaultdict(list), threading.Lock()
+
+        def record(step, seconds, ok):
+            with lock: samples[step].append((seconds, ok))
+
+        names = list(sessions)
+        weights = [sessions[n]['weight'] for n in names]
+        deadline = time.monotonic() + options['duration']
+
+        def drive(i):
+            rng = random.Random(options['seed'] + i)
+            user = users[i % len(users)]
+            vu = VirtualUser(options['url'], RefreshToken.for_user(user).access_token, categories, record, options['think'], rng)
+            while time.monotonic() < deadline:
+                vu.run(sessions[rng.choices(names, weights)[0]]['steps'])
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(options['users']) as pool:
+            list(pool.map(drive, range(options['users'])))
+        self.report(samples, time.monotonic() - start)
+
+    def report(self, samples, elapsed):
+        self.stdout.write("%-8s %8s %8s %7s %9s %9s %9s" % ('step', 'requests', 'req/s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+        total = []
+        for step, values in sorted(samples.items()):
+            total += values
+            self.row(step, values, elapsed)
+        if total: self.row('total', total, elapsed)
+
+    def row(self, step, values, elapsed):
+        latencies = [v[0] * 1000 for v in values]
+        errors = sum(1 for v in values if not v[1])
+        self.stdout.write("%-8s %8d %8.1f %6.2f%% %9.1f %9.1f %9.1f" % (
+            step, len(values), len(values) / elapsed, 100 * errors / len(values),
+            percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99)))
@@ -0,0 +1,181 @@
+import random
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from taggit.models import Tag as ETag, TaggedItem
+
+from api.models import Category, MyCategory, News, Profile, Save, Tag, Vote
+
+WORDS = (
+    "government election market court police minister budget climate health school "
+    "city river festival team match player coach record science space research energy "
+    "company startup bank price oil rain flood storm village farmer crop water road "
+    "railway airport bridge hospital doctor vaccine student exam result film music "
+    "artist award book history temple museum forest tiger wildlife ocean island border "
+    "army border trade export import tax reform policy protest strike union worker"
+).split()
+
+
+def zipf_weights(n, s=1.1):
+    return [1 / (rank ** s) for rank in range(1, n + 1)]
+
+
+class Command(BaseCommand):
+    help = "Fills the database with a synthetic feed: users, news, categories, tags, votes and saves"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--news', type=int, default=1000000)
+        parser.add_argument('--users', type=int, default=50000)
+        parser.add_argument('--votes', type=int, default=10000000)
+        parser.add_argument('--saves', type=int, default=10000000)
+        parser.add_argument('--categories', type=int, default=24)
+        parser.add_argument('--tags', type=int, default=400)
+        parser.add_argument('--etags', type=int, default=5000)
+        parser.add_argument('--days', type=int, default=365, help="spread of created_at")
+        parser.add_argument('--batch', type=int, default=10000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.batch = options['batch']
+
+        categories = self.reference(Category, 'category', options['categories'])
+        tags = self.reference(Tag, 'tag', options['tags'])
+        etags = self.etags(options['etags'])
+        users = self.users(options['users'], categories)
+        news = self.news(options['news'], options['days'], users, categories, tags, etags)
+
+        self.relations(Vote, options['votes'], users, news, polarity=True)
+        self.relations(Save, options['saves'], users, news)
+        self.count_votes()
+
+    def log(self, message):
+        self.stdout.write(message)
+        self.stdout.flush()
+
+    def chunks(self, total):
+        for start in range(0, total, self.batch):
+            yield range(start, min(start + self.batch, total))
+
+    def reference(self, model, prefix, n):
+        existing = model.objects.count()
+        model.objects.bulk_create([model(name="%s-%d" % (prefix, i)) for i in range(existing, n)])
+        ids = list(model.objects.order_by('id').values_list('id', flat=True))
+        self.log("%s: %d" % (model.__name__, len(ids)))
+        return ids
+
+    def etags(self, n):
+        existing = ETag.objects.count()
+        ETag.objects.bulk_create([ETag(name="etag-%d" % i, slug="etag-%d" % i) for i in range(existing, n)])
+        ids = list(ETag.objects.order_by('id').values_list('id', flat=True))
+        self.log("etags: %d" % len(ids))
+        return ids
+
+    def users(self, n, categories):
+        password = make_password('seed')
+        start = User.objects.count()
+        for chunk in self.chunks(n):
+            User.objects.bulk_create([
+                User(username="seed-%d" % (start + i), email="seed-%d@seed.local" % (start + i),
+                     first_name=self.random.choice(WORDS).title(), last_name=self.random.choice(WORDS).title(),
+                     password=password)
+                for i in chunk
+            ])
+        ids = list(User.objects.filter(profile__isnull=True).values_list('id', flat=True))
+        for chunk in self.chunks(len(ids)):
+            Profile.objects.bulk_create([Profile(user_id=ids[i], version=1) for i in chunk])
+
+        # a third of the users pick preferred categories
+        picked = ids[::3]
+        MyCategory.objects.bulk_create([MyCategory(user_id=pk) for pk in picked], ignore_conflicts=True)
+        through = MyCategory.categorys.through
+        mine = dict(MyCategory.objects.filter(user_id__in=picked).values_list('user_id', 'id'))
+        weights = zipf_weights(len(categories))
+        rows = []
+        for pk in picked:
+            for cat in set(self.random.choices(categories, weights, k=self.random.randint(1, 4))):
+                rows.append(through(mycategory_id=mine[pk], category_id=cat))
+        through.objects.bulk_create(rows, batch_size=self.batch, ignore_conflicts=True)
+
+        users = list(User.objects.order_by('id').values_list('id', flat=True))
+        self.log("users: %d" % len(users))
+        return users
+
+    def news(self, n, days, users, categories, tags, etags):
+        now = timezone.now()
+        content_type = ContentType.objects.get_for_model(News)
+        category_weights = zipf_weights(len(categories))
+        tag_weights = zipf_weights(len(tags))
+        etag_weights = zipf_weights(len(etags), 1.0)
+
+        for chunk in self.chunks(n):
+            rows = []
+            for i in chunk:
+                created = now - timedelta(seconds=days * 86400 * (n - i) / n)
+                headline = " ".join(self.random.choices(WORDS, k=self.random.randint(6, 12))).capitalize()
+                rows.append(News(
+                    category_ids=list(set(self.random.choices(categories, category_weights, k=self.random.randint(1, 3)))),
+                    tag_ids=list(set(self.random.choices(tags, tag_weights, k=self.random.randint(0, 4)))),
+                    headline=headline[:127],
+                    time=created,
+                    body=" ".join(self.random.choices(WORDS, k=self.random.randint(60, 120))),
+                    image="seed.png",
+                    newsAgency=self.random.choice(['Independent', 'PTI', 'Reuters', 'ANI', 'IANS']),
+                    source="https://seed.local/news/%d" % i,
+                    file_type='VID' if self.random.random() < 0.05 else 'IMG',
+                    user_id=self.random.choice(users) if self.random.random() < 0.1 else None,
+                    visibility=self.random.random() < 0.95,
+                    independent=self.random.random() < 0.1,
+                ))
+            rows = News.objects.bulk_create(rows)
+
+            # auto_now_add ignores what we pass, spread created_at afterwards
+            created = {}
+            news_category, news_tags, tagged = [], [], []
+            for row in rows:
+                created[row.pk] = row.time
+                for cat in row.category_ids:
+                    news_category.append(News.category.through(news_id=row.pk, category_id=cat))
+                for tag in row.tag_ids:
+                    news_tags.append(News.tags.through(news_id=row.pk, tag_id=tag))
+                for tag in set(self.random.choices(etags, etag_weights, k=self.random.randint(2, 6))):
+                    tagged.append(TaggedItem(content_type_id=content_type.pk, object_id=row.pk, tag_id=tag))
+
+            News.category.through.objects.bulk_create(news_category)
+            News.tags.through.objects.bulk_create(news_tags)
+            TaggedItem.objects.bulk_create(tagged)
+            for row in rows: row.created_at = created[row.pk]
+            News.objects.bulk_update(rows, ['created_at'])
+            self.log("news: %d/%d" % (chunk.stop, n))
+
+        return list(News.objects.filter(visibility=True).order_by('id').values_list('id', flat=True))
+
+    def relations(self, model, n, users, news, polarity=False):
+        # active users and recent news get most of the traffic
+        user_weights = zipf_weights(len(users), 0.8)
+        news_cumulative = [i * i for i in range(1, len(news) + 1)]
+        for chunk in self.chunks(n):
+            picked_users = self.random.choices(users, user_weights, k=len(chunk))
+            picked_news = self.random.choices(news, cum_weights=news_cumulative, k=len(chunk))
+            rows = []
+            for user, item in set(zip(picked_users, picked_news)):
+                row = model(user_id=user, news_id=item)
+                if polarity: row.polarity = self.random.random() < 0.7
+                rows.append(row)
+            model.objects.bulk_create(rows, ignore_conflicts=True)
+            self.log("%s: %d/%d" % (model.__name__.lower(), chunk.stop, n))
+
+    def count_votes(self):
+        # bulk_create skips Vote.save(), so recompute the counters in one pass
+        def votes(polarity):
+            count = Vote.objects.filter(news=OuterRef('pk'), polarity=polarity).order_by().values('news')
+            return Coalesce(Subquery(count.annotate(c=Count('*')).values('c'), output_field=IntegerField()), Value(0))
+
+        News.objects.update(pos=votes(True), neg=votes(False))
+        self.log("vote counters updated")
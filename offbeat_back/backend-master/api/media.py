@@ -0,0 +1,101 @@
+"""Uploaded media: news images and videos, profile pictures.
+
+With MEDIA_ACCEL set the front proxy sends the file: nginx through
+X-Accel-Redirect to an internal location mapped onto MEDIA_ROOT, apache or
+lighttpd through X-Sendfile. Otherwise files are served from here with
+ETag and single byte-range support. A name is reused for new content
+once django_cleanup has deleted the file that had it, so responses are
+only cached for MEDIA_CACHE_SECONDS and then revalidated: the ETag is the
+file's size and mtime, which a new file under the old name changes.
+"""
+import mimetypes, os, re
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK = 64 * 1024
+
+
+def media_path(path):
+    try: full = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation: raise Http404
+    if not os.path.isfile(full): raise Http404
+    return full
+
+
+def byte_range(header, size):
+    """``(start, end)`` of a single range, inclusive, None for the whole
+    file (no range or several), or False when it can't be satisfied."""
+    match = RANGE.match(header.strip())
+    if match is None: return None
+    first, last = match.groups()
+    if not first and not last: return None
+    if not first: start, end = max(size - int(last), 0), size - 1
+    else: start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end: return False
+    return start, end
+
+
+def read(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK, length))
+            if not chunk: return
+            length -= len(chunk)
+            yield chunk
+
+
+def cache_headers(response, stat, etag, content_type):
+    response['Content-Type'] = content_type
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Cache-Control'] = 'public, max-age=%d, must-revalidate' % settings.MEDIA_CACHE_SECONDS
+    return response
+
+
+@require_safe
+def serve(request, path):
+    full = media_path(path)
+    stat = os.stat(full)
+    etag = '"%x-%x"' % (stat.st_size, stat.st_mtime_ns)
+    content_type, encoding = mimetypes.guess_type(full)
+    content_type = content_type or 'application/octet-stream'
+
+    if settings.MEDIA_ACCEL == 'nginx':
+        response = HttpResponse()
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_LOCATION + path
+        return cache_headers(response, stat, etag, content_type)
+    if settings.MEDIA_ACCEL == 'sendfile':
+        response = HttpResponse()
+        response['X-Sendfile'] = full
+        return cache_headers(response, stat, etag, content_type)
+
+    if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+        return cache_headers(HttpResponseNotModified(), stat, etag, content_type)
+
+    ranged = request.META.get('HTTP_RANGE', '')
+    # a client resuming from a copy that has since changed gets the whole file
+    if ranged and request.META.get('HTTP_IF_RANGE', etag) != etag: ranged = ''
+    ranged = byte_range(ranged, stat.st_size) if ranged else None
+    if ranged is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % stat.st_size
+        return response
+
+    if ranged is None:
+        # under gunicorn the worker hands the open file to sendfile()
+        response = FileResponse(open(full, 'rb'))
+    else:
+        start, end = ranged
+        response = StreamingHttpResponse(read(full, start, end - start + 1), status=206)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, stat.st_size)
+        response['Content-Length'] = str(end - start + 1)
+    response['Accept-Ranges'] = 'bytes'
+    if encoding: response['Content-Encoding'] = encoding
+    return cache_headers(response, stat, etag, content_type)
@@ -0,0 +1,36 @@
+import os
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+REQUEST_LATENCY = Histogram(
+    'api_request_latency_seconds', 'Time spent serving a request', ['route', 'method'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+REQUEST_QUERIES = Histogram(
+    'api_request_queries', 'Database queries run by a request', ['route'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144),
+)
+CACHE_LOOKUPS = Counter('api_cache_lookups_total', 'Cache lookups by cache and result', ['cache', 'result'])
+
+INGEST_ARTICLES = Counter('api_ingest_articles_total', 'Articles seen by UpdateNews', ['result'])
+INGEST_IMAGE_BYTES = Counter('api_ingest_image_bytes_total', 'Bytes of news images downloaded by UpdateNews')
+
+
+def cache_lookup(cache, hit):
+    CACHE_LOOKUPS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def export(request):
+    token = settings.METRICS_TOKEN
+    if not token or not constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer ' + token):
+        return HttpResponseForbidden()
+    # under gunicorn every worker writes its own files in the multiprocess dir
+    if 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else: registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
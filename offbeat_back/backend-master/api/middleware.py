@@ -0,0 +1,293 @@
+import asyncio, json, logging, random, time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import brotli
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.utils.cache import patch_vary_headers
+from django.utils.decorators import sync_and_async_middleware
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.text import compress_sequence, compress_string
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from .budgets import QUERY_BUDGETS, view_name
+from .dbrouters import pin_to_primary, replicas
+from .metrics import REQUEST_LATENCY, REQUEST_QUERIES
+
+logger = logging.getLogger('api.performance')
+
+_timings = ContextVar('timings', default=None)
+_queries = ContextVar('queries', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """Counts the query for the request being served, whichever thread it
+    runs on: async views query from executor threads, and contextvars
+    follow them there."""
+    timings, queries = _timings.get(), _queries.get()
+    if timings is None and queries is None: return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try: return execute(sql, params, many, context)
+    finally:
+        if queries is not None: queries[0] += 1
+        if timings is not None:
+            timings['db'] += time.perf_counter() - start
+            timings['queries'] += 1
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers: connection.execute_wrappers.append(record_query)
+
+
+class HybridMiddleware:
+    """What a middleware does before and after the rest of the chain:
+    ``start(request)`` returns a state, ``stop(state)`` runs even when the
+    chain raises, ``finish(request, response, state)`` returns the
+    response. ``hybrid`` makes the middleware itself."""
+
+    def __init__(self, get_response):
+        # connections opened before this module was imported missed the signal
+        for connection in connections.all(): install_query_recorder(None, connection)
+
+    def stop(self, state):
+        pass
+
+
+def hybrid(hooks_class):
+    """A middleware factory around ``hooks_class``. In an async chain it
+    returns a coroutine function (Django's sync_and_async_middleware
+    pattern), so under ASGI the async views aren't pushed back onto a
+    thread."""
+
+    @sync_and_async_middleware
+    def factory(get_response):
+        hooks = hooks_class(get_response)
+        if asyncio.iscoroutinefunction(get_response):
+            async def middleware(request):
+                state = hooks.start(request)
+                try: response = await get_response(request)
+                finally: hooks.stop(state)
+                return hooks.finish(request, response, state)
+        else:
+            def middleware(request):
+                state = hooks.start(request)
+                try: response = get_response(request)
+                finally: hooks.stop(state)
+                return hooks.finish(request, response, state)
+        if hasattr(hooks, 'process_template_response'):
+            middleware.process_template_response = hooks.process_template_response
+        return middleware
+
+    return factory
+
+
+@sync_and_async_middleware
+def static_files_middleware(get_response):
+    """WhiteNoiseMiddleware that can sit in an async chain; django_heroku's
+    sync-only one would run every request of an ASGI worker on one thread.
+    Static files are looked up in memory, only the rest of the chain is
+    awaited."""
+    whitenoise = WhiteNoiseMiddleware(get_response, settings)
+    if not asyncio.iscoroutinefunction(get_response): return whitenoise
+
+    async def middleware(request):
+        path = request.path_info
+        static_file = whitenoise.find_file(path) if whitenoise.autorefresh else whitenoise.files.get(path)
+        if static_file is not None: return whitenoise.serve(static_file, request)
+        return await get_response(request)
+
+    return middleware
+
+
+@contextmanager
+def timed(name):
+    """Adds the time spent in the block to the sampled request's timings,
+    less its queries, which are counted under db."""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start, db = time.perf_counter(), timings['db']
+    try: yield
+    finally: timings[name] = timings.get(name, 0) + time.perf_counter() - start - (timings['db'] - db)
+
+
+class PerformanceMiddleware(HybridMiddleware):
+    """Per-request query count, db, serializer and render time. Spans other
+    than total don't overlap: queries run while serializing count as db.
+
+    Sampled requests get a ``Server-Timing`` header and one json line on
+    the ``api.performance`` logger, tagged with the resolved view and the
+    sorted query parameter names. With ``PERF_TIMING`` off the middleware
+    removes itself from the chain.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PERF_TIMING: raise MiddlewareNotUsed
+        super().__init__(get_response)
+        self.sample_rate = settings.PERF_SAMPLE_RATE
+
+    def start(self, request):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate: return None
+        timings = {'db': 0.0, 'queries': 0}
+        return timings, _timings.set(timings), time.perf_counter()
+
+    def stop(self, state):
+        if state: _timings.reset(state[1])
+
+    def finish(self, request, response, state):
+        if state is None: return response
+        timings, _, start = state
+        timings['total'] = time.perf_counter() - start
+
+        match = request.resolver_match
+        line = {
+            'view': match.view_name or match._func_path if match else None,
+            'method': request.method,
+            'params': ','.join(sorted(request.GET)),
+            'status': response.status_code,
+            'queries': timings.pop('queries'),
+        }
+        line.update((k, round(v * 1000, 2)) for k, v in timings.items())
+        budget = QUERY_BUDGETS.get(view_name(match.func)) if match else None
+        if budget is not None and line['queries'] > budget: line['over_budget'] = budget
+        logger.info(json.dumps(line))
+
+        response['Server-Timing'] = ', '.join(
+            '%s;dur=%.2f' % (k, v * 1000) + (';desc="%d queries"' % line['queries'] if k == 'db' else '')
+            for k, v in timings.items()
+        )
+        return response
+
+    def process_template_response(self, request, response):
+        timings = _timings.get()
+        if timings is not None:
+            start = time.perf_counter()
+
+            def rendered(response):
+                timings['render'] = timings.get('render', 0) + time.perf_counter() - start
+
+            response.add_post_render_callback(rendered)
+        return response
+
+
+performance_middleware = hybrid(PerformanceMiddleware)
+
+
+class MetricsMiddleware(HybridMiddleware):
+    """Feeds request latency and query counts per route into ``api.metrics``."""
+
+    def __init__(self, get_response):
+        if not settings.METRICS: raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def start(self, request):
+        queries = [0]
+        return queries, _queries.set(queries), time.perf_counter()
+
+    def stop(self, state):
+        _queries.reset(state[1])
+
+    def finish(self, request, response, state):
+        queries, _, start = state
+        match = request.resolver_match
+        route = match.route if match else 'unmatched'
+        REQUEST_LATENCY.labels(route, request.method).observe(time.perf_counter() - start)
+        REQUEST_QUERIES.labels(route).observe(queries[0])
+        return response
+
+
+metrics_middleware = hybrid(MetricsMiddleware)
+
+
+class PrimaryPinMiddleware(MiddlewareMixin):
+    """After a user's successful write their reads stay on the primary for
+    ``REPLICA_PIN_SECONDS``, so they see it before the replicas do. Not
+    installed when there are no replicas."""
+
+    def __init__(self, get_response):
+        if not replicas(): raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def process_response(self, request, response):
+        # DRF's authentication sets the user on the underlying request too
+        user = getattr(request, 'user', None)
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400 and user and user.is_authenticated:
+            pin_to_primary(user)
+        return response
+
+
+def accepted_encodings(header):
+    """``{'br': 1.0, 'gzip': 0.5, ...}`` from an Accept-Encoding header."""
+    accepted = {}
+    for part in header.split(','):
+        name, _, params = part.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try: q = float(params[2:])
+            except ValueError: q = 0.0
+        accepted[name.strip().lower()] = q
+    return accepted
+
+
+def brotli_sequence(sequence, quality):
+    compressor = brotli.Compressor(quality=quality)
+    for item in sequence:
+        chunk = compressor.process(item)
+        if chunk: yield chunk
+    yield compressor.finish()
+
+
+class CompressionMiddleware(HybridMiddleware):
+    """Brotli or gzip, whichever the client prefers, for responses of at least
+    ``COMPRESS_MIN_SIZE`` bytes. Streaming responses are compressed chunk by
+    chunk; images, video and partial content pass through untouched.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.min_size = settings.COMPRESS_MIN_SIZE
+        self.brotli_quality = settings.COMPRESS_BROTLI_QUALITY
+
+    def start(self, request):
+        pass
+
+    def finish(self, request, response, state):
+        if response.has_header('Content-Encoding') or response.status_code == 206: return response
+        if response.get('Content-Type', '').startswith(('image/', 'video/')): return response
+        if not response.streaming and len(response.content) < self.min_size: return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        accepted = accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        encoding = next((e for e in ('br', 'gzip') if accepted.get(e, 0) > 0), None)
+        if encoding is None: return response
+
+        if response.streaming:
+            if encoding == 'br':
+                response.streaming_content = brotli_sequence(response.streaming_content, self.brotli_quality)
+            else:
+                response.streaming_content = compress_sequence(response.streaming_content)
+            del response['Content-Length']
+        else:
+            if encoding == 'br':
+                compressed = brotli.compress(response.content, quality=self.brotli_quality)
+            else:
+                compressed = compress_string(response.content)
+            if len(compressed) >= len(response.content): return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        # the body changed, so a strong ETag no longer describes it
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'): response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
+        return response
+
+
+compression_middleware = hybrid(CompressionMiddleware)
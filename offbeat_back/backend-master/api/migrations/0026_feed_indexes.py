@@ -0,0 +1,43 @@
+# Generated by Django 3.1.14 on 2026-10-19 14:05
+
+from django.db import migrations, models
+
+# same expression as NewsView's SearchVector('headline', 'body', 'newsAgency', config='english')
+SEARCH_INDEX = """
+CREATE INDEX news_search_idx ON api_news USING gin (to_tsvector('english'::regconfig,
+    COALESCE("headline", '') || ' ' || COALESCE("body", '') || ' ' || COALESCE("newsAgency", '')))
+"""
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(SEARCH_INDEX)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX news_search_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0025_claimsuser'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='news',
+            index=models.Index(condition=models.Q(visibility=True), fields=['independent', '-id'], name='news_feed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='news',
+            index=models.Index(condition=models.Q(visibility=True), fields=['independent', 'created_at'], name='news_recent_idx'),
+        ),
+        # category feeds walk the through table by category, newest news first
+        migrations.RunSQL(
+            'CREATE INDEX news_category_feed_idx ON api_news_category (category_id, news_id DESC)',
+            'DROP INDEX news_category_feed_idx',
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 3.1.14 on 2026-10-19 14:11
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+BACKFILL = """
+UPDATE api_news SET
+    category_ids = COALESCE((SELECT array_agg(category_id ORDER BY id) FROM api_news_category WHERE news_id = api_news.id), '{}'),
+    tag_ids = COALESCE((SELECT array_agg(tag_id ORDER BY id) FROM api_news_tags WHERE news_id = api_news.id), '{}')
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0026_feed_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='news',
+            name='category_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), blank=True, default=list, editable=False, size=None),
+        ),
+        migrations.AddField(
+            model_name='news',
+            name='tag_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), blank=True, default=list, editable=False, size=None),
+        ),
+        # before the indexes, so they are built once over the filled arrays
+        migrations.RunSQL(BACKFILL, migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name='news',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['category_ids'], name='news_category_ids_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='news',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['tag_ids'], name='news_tag_ids_idx'),
+        ),
+        # feeds no longer join the through table
+        migrations.RunSQL(
+            'DROP INDEX news_category_feed_idx',
+            'CREATE INDEX news_category_feed_idx ON api_news_category (category_id, news_id DESC)',
+        ),
+    ]
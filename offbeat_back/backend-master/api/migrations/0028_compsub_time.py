@@ -0,0 +1,19 @@
+# Generated by Django 3.1.14 on 2026-10-19 14:34
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0027_news_relation_ids'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='compsub',
+            name='time',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-19 14:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0028_compsub_time'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compsub',
+            name='score',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
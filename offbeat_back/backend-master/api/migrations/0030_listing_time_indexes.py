@@ -0,0 +1,33 @@
+# Generated by Django 3.1.14 on 2026-10-19 14:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0029_compsub_score'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='comp',
+            name='end_time',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='comp',
+            name='start_time',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='event',
+            name='end_time',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='event',
+            name='start_time',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.1.14 on 2026-10-19 14:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0030_listing_time_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comp',
+            name='capacity',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='capacity',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='CapacityShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('remaining', models.IntegerField()),
+                ('comp', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='capacity_shards', to='api.comp')),
+                ('event', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='capacity_shards', to='api.event')),
+            ],
+        ),
+    ]
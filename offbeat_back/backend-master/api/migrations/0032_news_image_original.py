@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-19 14:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0031_registration_capacity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='news',
+            name='image_original',
+            field=models.ImageField(blank=True, null=True, upload_to=''),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.1.14 on 2026-10-19 14:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0032_news_image_original'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='news',
+            name='image_blurhash',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='news',
+            name='image_height',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='news',
+            name='image_width',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='image_blurhash',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='image_height',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='image_width',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -1,11 +1,14 @@
 import uuid
+from collections import defaultdict
 
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.utils import timezone
 
-from datetime import datetime, timezone
 from taggit.managers import TaggableManager
 
 
@@ -37,6 +40,10 @@ class Profile(models.Model):
 
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     image = models.ImageField(blank=True, null=True)
+    # set by api.images.describe whenever the image is stored
+    image_width = models.IntegerField(blank=True, null=True)
+    image_height = models.IntegerField(blank=True, null=True)
+    image_blurhash = models.CharField(max_length=64, blank=True, null=True)
 
     org = models.ForeignKey(Organization, blank=True, null=True, related_name="organization_users", on_delete=models.CASCADE)
     designation = models.CharField(max_length=127, blank=True, null=True)
@@ -49,11 +56,67 @@ class Profile(models.Model):
     def __str__(self):
         return self.user.email
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded = dict(zip(field_names, values))
+        return instance
+
+    def _field_value(self, field):
+        value = getattr(self, field.attname)
+        return value.name if isinstance(field, models.FileField) else value
+
+    def dirty_fields(self):
+        loaded = getattr(self, '_loaded', None)
+        if loaded is None: return None
+        return [
+            f.name for f in self._meta.concrete_fields
+            if f.attname in loaded and self._field_value(f) != loaded[f.attname]
+        ]
+
+    def save(self, *args, **kwargs):
+        # only write the columns that changed since the row was loaded
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            dirty = self.dirty_fields()
+            if dirty is not None:
+                if not dirty: return
+                kwargs['update_fields'] = dirty
+
+        super().save(*args, **kwargs)
+        # what was written is clean now; other changes still wait for a save
+        written, deferred = kwargs.get('update_fields'), self.get_deferred_fields()
+        if written is None: self._loaded = {}
+        # never loaded, the next plain save writes every column anyway
+        elif not hasattr(self, '_loaded'): return
+        self._loaded.update(
+            (f.attname, self._field_value(f)) for f in self._meta.concrete_fields
+            if f.attname not in deferred and (written is None or f.name in written or f.attname in written)
+        )
+
 @receiver(post_save, sender=User)
-def create_or_update_user_profile(sender, instance, created, **kwargs):
-    if created:
+def create_user_profile(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
         Profile.objects.create(user=instance)
-    instance.profile.save()
+
+
+class ClaimsUser(User):
+    """User built from JWT claims with every column but the pk deferred.
+
+    The first access to any other field fills them all at once from the
+    per-process user cache in ``api.authentication``.
+    """
+
+    class Meta:
+        proxy = True
+
+    def refresh_from_db(self, using=None, fields=None):
+        deferred = self.get_deferred_fields()
+        if fields and deferred.issuperset(fields):
+            from .authentication import user_cache
+            for attname, value in user_cache.get(self.pk).items():
+                if attname in deferred: setattr(self, attname, value)
+            return
+        super().refresh_from_db(using, fields)
 
 
 class Category(models.Model):
@@ -130,6 +193,12 @@ class News(models.Model):
 
     body = models.TextField()
     image = models.ImageField(null=True, blank=True)
+    # the downloaded image at up to NEWS_IMAGE_MAX_WIDTH, which api.images resizes from
+    image_original = models.ImageField(null=True, blank=True)
+    # size and placeholder of image, set by api.images.describe at ingestion
+    image_width = models.IntegerField(null=True, blank=True)
+    image_height = models.IntegerField(null=True, blank=True)
+    image_blurhash = models.CharField(max_length=64, null=True, blank=True)
 
     newsAgency = models.CharField(max_length=512, default='Independent')
     source = models.URLField(max_length=255)
@@ -150,10 +219,88 @@ class News(models.Model):
 
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # copies of the category / tags m2m in through-table order, kept by
+    # sync_news_relations so feeds filter without joins
+    category_ids = ArrayField(models.IntegerField(), default=list, blank=True, editable=False)
+    tag_ids = ArrayField(models.IntegerField(), default=list, blank=True, editable=False)
+
+    class Meta:
+        # NewsView only reads visible news: newest first, and the trending
+        # window on created_at, each split on independent
+        indexes = [
+            models.Index(fields=['independent', '-id'], name='news_feed_idx', condition=models.Q(visibility=True)),
+            models.Index(fields=['independent', 'created_at'], name='news_recent_idx', condition=models.Q(visibility=True)),
+            GinIndex(fields=['category_ids'], name='news_category_ids_idx'),
+            GinIndex(fields=['tag_ids'], name='news_tag_ids_idx'),
+        ]
+
     def __str__(self):
         return self.headline
 
 
+# News m2m -> (array field, through column)
+NEWS_RELATIONS = {
+    News.category.through: ('category_ids', 'category_id'),
+    News.tags.through: ('tag_ids', 'tag_id'),
+}
+
+
+class NewsChange(models.Model):
+    """A news whose visibility, independent flag, categories or tags may
+    have changed, for the feed index of every process to read again
+    (api.feedindex). Kept for twice FEED_INDEX_REBUILD."""
+    news_id = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+def news_changed(news_ids):
+    NewsChange.objects.bulk_create([NewsChange(news_id=pk) for pk in news_ids])
+
+
+def refresh_relation_ids(through, news_ids):
+    """Rewrites the array copy of ``through`` for ``news_ids``; returns {news id: ids}."""
+    field, column = NEWS_RELATIONS[through]
+    ids = defaultdict(list)
+    for news_id, pk in through.objects.filter(news_id__in=news_ids).order_by('id').values_list('news_id', column):
+        ids[news_id].append(pk)
+    for news_id in news_ids:
+        News.objects.filter(pk=news_id).update(**{field: ids[news_id]})
+    news_changed(news_ids)
+    return ids
+
+
+@receiver(post_save, sender=News)
+@receiver(post_delete, sender=News)
+def news_saved(sender, instance, created=False, update_fields=None, **kwargs):
+    # new rows reach the feed index anyway, and votes only touch pos and neg
+    if created or update_fields is not None and not {'visibility', 'independent'}.intersection(update_fields): return
+    news_changed([instance.pk])
+
+
+@receiver(m2m_changed, sender=News.category.through)
+@receiver(m2m_changed, sender=News.tags.through)
+def sync_news_relations(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # category.news_set / tag.news_set: pk_set are news, and clear() doesn't say which
+        if action == 'pre_clear':
+            instance._cleared_news = list(sender.objects.filter(**{NEWS_RELATIONS[sender][1]: instance.pk}).values_list('news_id', flat=True))
+        elif action in ('post_add', 'post_remove', 'post_clear'):
+            news_ids = pk_set if action != 'post_clear' else instance.__dict__.pop('_cleared_news', [])
+            refresh_relation_ids(sender, list(news_ids))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        ids = refresh_relation_ids(sender, [instance.pk])
+        setattr(instance, NEWS_RELATIONS[sender][0], ids[instance.pk])
+
+
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Tag)
+def drop_news_relation_id(sender, instance, **kwargs):
+    # the cascade removes through rows without m2m_changed
+    field = 'category_ids' if sender is Category else 'tag_ids'
+    News.objects.filter(**{field + '__contains': [instance.pk]}).update(
+        **{field: models.Func(models.F(field), models.Value(instance.pk), function='array_remove')})
+
+
 class MyNews(models.Model):
 
     headline = models.CharField(max_length=127)
@@ -227,7 +374,7 @@ class Vote(models.Model):
     class Meta:
         unique_together = ['user', 'news']
 
-    def save(self):
+    def save(self, *args, **kwargs):
 
         if self.pk:
             obj = Vote.objects.values('polarity').get(pk=self.pk)
@@ -238,18 +385,18 @@ class Vote(models.Model):
         if self.polarity: self.news.pos += 1
         else: self.news.neg += 1
 
-        self.news.save()
+        self.news.save(update_fields=['pos', 'neg'])
 
-        super(Vote, self).save()
+        super(Vote, self).save(*args, **kwargs)
 
-    def delete(self):
+    def delete(self, *args, **kwargs):
 
         if self.polarity: self.news.pos -= 1
         else: self.news.neg -= 1
 
-        self.news.save()
+        self.news.save(update_fields=['pos', 'neg'])
 
-        super(Vote, self).delete()
+        return super(Vote, self).delete(*args, **kwargs)
 
 
 class Question(models.Model):
@@ -270,8 +417,11 @@ class Comp(models.Model):
     ques = models.ManyToManyField(Question, blank=True)
     fee = models.JSONField(default=dict)
     participants = models.ManyToManyField(User, related_name="my_quiz", blank=True)
-    start_time = models.DateTimeField()
-    end_time = models.DateTimeField()
+    # None for no limit; the free places are kept in CapacityShard rows
+    capacity = models.IntegerField(blank=True, null=True)
+    # the upcoming / live / past listings filter on these
+    start_time = models.DateTimeField(db_index=True)
+    end_time = models.DateTimeField(db_index=True)
 
     def __str__(self):
         return f"{self.org.name} - {self.name}"
@@ -281,7 +431,10 @@ class CompSub(models.Model):
     comp = models.ForeignKey(Comp, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     ans = models.JSONField(default=dict)
-    time = models.DateTimeField(auto_now_add=True)
+    # when it was submitted, not when a buffered submission reached the table
+    time = models.DateTimeField(default=timezone.now)
+    # correct answers, graded against the competition's answer key when stored
+    score = models.IntegerField(blank=True, null=True)
 
     def __str__(self):
         return f"{self.comp.name} - {self.user.email}"
@@ -294,10 +447,21 @@ class Event(models.Model):
     about = models.JSONField(default=dict)
     comp = models.ManyToManyField(Comp, related_name="event", blank=True)
     participants = models.ManyToManyField(User, related_name="my_event", blank=True)
-    start_time = models.DateTimeField()
-    end_time = models.DateTimeField()
+    capacity = models.IntegerField(blank=True, null=True)
+    # the upcoming / live / past listings filter on these
+    start_time = models.DateTimeField(db_index=True)
+    end_time = models.DateTimeField(db_index=True)
 
     def __str__(self):
         return f"{self.org.name} - {self.name}"
 
 
+class CapacityShard(models.Model):
+    """A share of the free places of a competition or event. Registrations
+    take a place from whichever shard isn't locked, so they don't queue on
+    one counter row (see api.registration)."""
+    comp = models.ForeignKey(Comp, blank=True, null=True, related_name="capacity_shards", on_delete=models.CASCADE)
+    event = models.ForeignKey(Event, blank=True, null=True, related_name="capacity_shards", on_delete=models.CASCADE)
+    remaining = models.IntegerField()
+
+
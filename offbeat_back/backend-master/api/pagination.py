@@ -1,6 +1,15 @@
 from rest_framework import pagination
+from rest_framework.exceptions import ValidationError
 
 class StandardResultsSetPagination(pagination.PageNumberPagination):
     page_size = 10
     page_size_query_param = 'page_size'
-    max_page_size = 100
\ No newline at end of file
+    max_page_size = 100
+
+
+def page_number(value):
+    """``?page=`` as a page number from 1; anything else is a 400."""
+    try: page = int(value)
+    except (TypeError, ValueError): page = 0
+    if page < 1: raise ValidationError({'page': 'a page number from 1'})
+    return page
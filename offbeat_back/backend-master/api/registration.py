@@ -0,0 +1,124 @@
+"""Registration for competitions and events.
+
+A registration inserts its participants row with ON CONFLICT DO NOTHING,
+so repeating one changes nothing. When there's a capacity, the same
+transaction then takes one place out of a CapacityShard. It picks among
+the shards that still have places and aren't locked by another
+registration (SKIP LOCKED); only when all of those are busy does it wait
+on one. The places left always add up to the capacity minus the
+participants, so a flood of registrations neither queues on a single
+counter row nor overbooks.
+
+Registrations write the through tables directly, without m2m signals;
+adds and removes through the ORM (the admin) reshard the capacity instead.
+"""
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+from psycopg2.errorcodes import DEADLOCK_DETECTED
+from django.db.models.signals import m2m_changed, post_save
+from django.dispatch import receiver
+
+from . import competition
+from .models import CapacityShard, Comp, Event
+
+# the column participants rows and shards point at the registration target with
+COLUMNS = {Comp: 'comp_id', Event: 'event_id'}
+
+TAKE_FREE_PLACE = (
+    "UPDATE api_capacityshard SET remaining = remaining - 1 WHERE id = ("
+    "SELECT id FROM api_capacityshard WHERE {column} = %s AND remaining > 0 "
+    "ORDER BY random() LIMIT 1 FOR UPDATE SKIP LOCKED) RETURNING id"
+)
+# waiting on one chosen shard: a locking subquery would keep the locks of
+# shards that emptied while it waited, and waiters holding those deadlock
+PICK_SHARD = "SELECT id FROM api_capacityshard WHERE {column} = %s AND remaining > 0 ORDER BY random() LIMIT 1"
+TAKE_PLACE = "UPDATE api_capacityshard SET remaining = remaining - 1 WHERE id = %s AND remaining > 0 RETURNING id"
+RETURN_PLACE = (
+    "UPDATE api_capacityshard SET remaining = remaining + 1 WHERE id = ("
+    "SELECT id FROM api_capacityshard WHERE {column} = %s ORDER BY random() LIMIT 1 FOR UPDATE)"
+)
+
+
+def participants_changed(instance, user, member):
+    # the quiz endpoints cache competitors; event listings read theirs apart, for a few seconds
+    if isinstance(instance, Comp): competition.joined([(instance.pk, user.pk)], member)
+
+
+def take_place(cursor, column, pk):
+    cursor.execute(TAKE_FREE_PLACE.format(column=column), [pk])
+    if cursor.fetchone() is not None: return True
+    # every shard with a place is taken by another registration; wait on one
+    while True:
+        cursor.execute(PICK_SHARD.format(column=column), [pk])
+        shard = cursor.fetchone()
+        if shard is None: return False
+        cursor.execute(TAKE_PLACE, shard)
+        if cursor.fetchone() is not None: return True
+
+
+def register(instance, user, attempts=3):
+    """Makes ``user`` a participant of the competition or event ``instance``.
+    Returns False when it is full; registering again is a no-op."""
+    column, table = COLUMNS[type(instance)], instance.participants.through._meta.db_table
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO %s (%s, user_id) VALUES (%%s, %%s) ON CONFLICT DO NOTHING RETURNING id" % (table, column),
+                [instance.pk, user.pk])
+            if cursor.fetchone() is None: return True
+            if instance.capacity is not None and not take_place(cursor, column, instance.pk):
+                transaction.set_rollback(True)
+                return False
+            transaction.on_commit(lambda: participants_changed(instance, user, True))
+        return True
+    except OperationalError as e:
+        # SKIP LOCKED can still keep the lock of a shard that emptied under it
+        if getattr(e.__cause__, 'pgcode', None) != DEADLOCK_DETECTED or attempts == 1: raise
+        return register(instance, user, attempts - 1)
+
+
+def unregister(instance, user):
+    column, table = COLUMNS[type(instance)], instance.participants.through._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("DELETE FROM %s WHERE %s = %%s AND user_id = %%s RETURNING id" % (table, column), [instance.pk, user.pk])
+        if cursor.fetchone() is None: return
+        if instance.capacity is not None: cursor.execute(RETURN_PLACE.format(column=column), [instance.pk])
+        transaction.on_commit(lambda: participants_changed(instance, user, False))
+
+
+def reshard(instance, shards=None):
+    """Spreads the places ``instance`` has left over ``shards`` (CAPACITY_SHARDS) shards."""
+    column = COLUMNS[type(instance)]
+    with transaction.atomic():
+        # registrations holding a shard finish first; later ones wait for the new shards
+        current = CapacityShard.objects.select_for_update().filter(**{column: instance.pk})
+        list(current)
+        current.delete()
+        if instance.capacity is None: return
+
+        left = max(instance.capacity - instance.participants.count(), 0)
+        shards = shards or settings.CAPACITY_SHARDS
+        CapacityShard.objects.bulk_create([
+            CapacityShard(**{column: instance.pk}, remaining=left // shards + (i < left % shards)) for i in range(shards)
+        ])
+
+
+@receiver(post_save, sender=Comp)
+@receiver(post_save, sender=Event)
+def capacity_changed(sender, instance, **kwargs):
+    reshard(instance)
+
+
+@receiver(m2m_changed, sender=Comp.participants.through)
+@receiver(m2m_changed, sender=Event.participants.through)
+def participants_edited(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if not reverse:
+        if action.startswith('post_'): reshard(instance)
+    elif action == 'pre_clear':
+        # by post_clear the user's rows are gone
+        target = Comp if sender is Comp.participants.through else Event
+        instance._cleared_registrations = list(target.objects.filter(participants=instance))
+    elif action == 'post_clear':
+        for target in instance._cleared_registrations: reshard(target)
+    elif action.startswith('post_'):
+        for target in model.objects.filter(pk__in=pk_set): reshard(target)
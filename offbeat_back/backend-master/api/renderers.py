@@ -0,0 +1,28 @@
+import msgpack, orjson
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+# datetimes go through DRF's encoder so the output matches JSONRenderer byte for byte
+_default = JSONEncoder().default
+_options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+
+class ORJSONRenderer(JSONRenderer):
+    """``application/json`` through orjson; anything orjson can't encode falls back to DRF's encoder."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None: return b''
+        return orjson.dumps(data, default=_default, option=_options)
+
+
+class MessagePackRenderer(BaseRenderer):
+    """``application/msgpack`` (or ``?format=msgpack``) for clients that decode it natively."""
+
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None: return b''
+        return msgpack.packb(data, default=_default, use_bin_type=True)
@@ -0,0 +1,215 @@
+import collections, random, threading, time
+
+import numpy as np
+import orjson
+from django.conf import settings
+
+from .models import CompSub
+
+
+def canonical(value):
+    return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+
+
+class AnswerKey:
+    """A competition's correct answers compiled once into arrays: question
+    ids to columns, and each column's answer encoded as an int code.
+
+    A batch of submissions is encoded into a (submissions, questions) array
+    of codes, where an answer that isn't any question's correct one gets
+    -2 and a missing answer -1, and scored by comparing it to the key and
+    summing each row. Only questions whose answer is json (lists, objects)
+    compare canonically serialized values.
+    """
+
+    def __init__(self, answers):
+        self.top = len(answers)
+        self.columns, self.codes, self.structured = {}, {}, set()
+        expected = []
+        for column, (pk, value) in enumerate(answers.items()):
+            self.columns[str(pk)] = column
+            # the type keeps 1, 1.0 and true apart
+            try: code = self.codes.setdefault((value.__class__, value), len(self.codes))
+            except TypeError:
+                code = self.codes.setdefault(canonical(value), len(self.codes))
+                self.structured.add(column)
+            expected.append(code)
+        self.expected = np.array(expected, dtype=np.int32)
+
+    def encode(self, column, value):
+        try: return self.codes.get((value.__class__, value), -2)
+        except TypeError:
+            return self.codes.get(canonical(value), -2) if column in self.structured else -2
+
+    def grade(self, submissions):
+        """Scores of a list of ``{question id: answer}`` submissions, as an array."""
+        columns, rows, cols, codes = self.columns, [], [], []
+        for i, ans in enumerate(submissions):
+            for pk, value in ans.items():
+                column = columns.get(pk)
+                if column is not None:
+                    rows.append(i)
+                    cols.append(column)
+                    codes.append(self.encode(column, value))
+        encoded = np.full((len(submissions), self.top), -1, dtype=np.int32)
+        encoded[rows, cols] = codes
+        return (encoded == self.expected).sum(axis=1)
+
+
+class Node:
+    __slots__ = ('key', 'priority', 'left', 'right', 'size')
+
+    def __init__(self, key, priority=None):
+        self.key, self.priority = key, random.random() if priority is None else priority
+        self.left = self.right = None
+        self.size = 1
+
+
+def size(node):
+    return node.size if node is not None else 0
+
+
+def split(node, count):
+    """``node``'s first ``count`` keys and the rest, as two trees."""
+    if node is None: return None, None
+    if size(node.left) < count:
+        left, right = split(node.right, count - size(node.left) - 1)
+        node.right = left
+        node.size = size(node.left) + size(left) + 1
+        return node, right
+    left, right = split(node.left, count)
+    node.left = right
+    node.size = size(right) + size(node.right) + 1
+    return left, node
+
+
+def merge(left, right):
+    """One tree of ``left``'s keys followed by ``right``'s."""
+    if left is None or right is None: return left or right
+    if left.priority > right.priority:
+        left.right = merge(left.right, right)
+        left.size = size(left.left) + size(left.right) + 1
+        return left
+    right.left = merge(left, right.left)
+    right.size = size(right.left) + size(right.right) + 1
+    return right
+
+
+class RankTree:
+    """Distinct keys in order, in a treap whose nodes count their subtree:
+    adding or removing a key, counting the keys below one and finding the
+    key at a position are O(log n) expected."""
+
+    def __init__(self, keys=()):
+        """Built from the sorted ``keys`` in O(n)."""
+        nodes = [Node(key) for key in keys]
+
+        def link(start, stop):
+            if start >= stop: return None
+            middle = (start + stop) // 2
+            node = nodes[middle]
+            node.left, node.right, node.size = link(start, middle), link(middle + 1, stop), stop - start
+            return node
+
+        self.root = link(0, len(nodes))
+        # a parent's priority above its children's, as if inserted one by one
+        queue, priorities = collections.deque([self.root] if nodes else []), sorted((node.priority for node in nodes), reverse=True)
+        for priority in priorities:
+            node = queue.popleft()
+            node.priority = priority
+            queue.extend(child for child in (node.left, node.right) if child is not None)
+
+    def __len__(self):
+        return size(self.root)
+
+    def below(self, key):
+        """How many keys are less than ``key``."""
+        node, count = self.root, 0
+        while node is not None:
+            if node.key < key:
+                count += size(node.left) + 1
+                node = node.right
+            else: node = node.left
+        return count
+
+    def at(self, position):
+        """The key at 0-based ``position``."""
+        node = self.root
+        while True:
+            if position < size(node.left): node = node.left
+            elif position == size(node.left): return node.key
+            else:
+                position -= size(node.left) + 1
+                node = node.right
+
+    def add(self, key):
+        left, right = split(self.root, self.below(key))
+        self.root = merge(merge(left, Node(key)), right)
+
+    def remove(self, key):
+        left, right = split(self.root, self.below(key))
+        self.root = merge(left, split(right, 1)[1])
+
+
+class Leaderboard:
+    """A competition's graded submissions, best score first and earlier
+    submissions first within a score.
+
+    Users are kept in a RankTree by ``(-score, time, user)``, so a user's
+    rank, the user at a position and moving a user are O(log n) however
+    many share a score; the first catch-up builds it in one pass.
+    Submissions stored since the last look are read at most every
+    LEADERBOARD_REFRESH seconds, by id: ``submissions.store`` commits a
+    competition's rows in id order, so none is passed over.
+    """
+
+    def __init__(self, pk, top):
+        self.pk, self.top = pk, top
+        self.lock = threading.Lock()
+        self.tree = RankTree()
+        self.entries = {}
+        self.high_water, self.checked = 0, None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self, user, score, at, tree=True):
+        old = self.entries.get(user)
+        # their newer submission is already in
+        if old is not None and old[1] > at: return
+        if old is not None and tree: self.tree.remove((-old[0], old[1], user))
+        self.entries[user] = (score, at)
+        if tree: self.tree.add((-score, at, user))
+
+    def catch_up(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.checked is not None and now - self.checked < settings.LEADERBOARD_REFRESH: return
+            rows = CompSub.objects.filter(comp_id=self.pk, id__gt=self.high_water, score__isnull=False).order_by('id')
+            # a first look takes everyone in: sorting them once beats adding them one by one
+            first = not self.entries
+            for pk, user, score, at in rows.values_list('id', 'user_id', 'score', 'time').iterator():
+                # a user's newer submission replaces their row, so it comes later
+                self.update(user, min(score, self.top), at, tree=not first)
+                self.high_water = pk
+            if first: self.tree = RankTree(sorted((-score, at, user) for user, (score, at) in self.entries.items()))
+            self.checked = now
+
+    def rank(self, user):
+        """``(rank, score)`` of ``user``, or None. Equal scores share a rank."""
+        self.catch_up()
+        with self.lock:
+            entry = self.entries.get(user)
+            return entry and (self.tree.below((-entry[0],)) + 1, entry[0])
+
+    def page(self, offset, limit):
+        """``(rank, user, score)`` for ``limit`` users from ``offset``."""
+        self.catch_up()
+        rows, ranks = [], {}
+        with self.lock:
+            for position in range(offset, min(offset + limit, len(self.tree))):
+                score, _, user = self.tree.at(position)
+                # (-score,) sorts before every key with that score
+                if score not in ranks: ranks[score] = self.tree.below((score,)) + 1
+                rows.append((ranks[score], user, -score))
+        return rows
@@ -1,7 +1,14 @@
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db.models import Prefetch
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.encoding import filepath_to_uri
 from rest_framework import serializers
 
 from .models import *
+from .metrics import cache_lookup
 
 class SubscriptionPlanSerializer(serializers.ModelSerializer):
     class Meta:
@@ -25,7 +32,7 @@ class ProfileInfoSerializer(serializers.ModelSerializer):
     class Meta:
         model = Profile
         fields = '__all__'
-        read_only_fields = ['plan_type', 'expiry_date', 'version']
+        read_only_fields = ['plan_type', 'expiry_date', 'version', 'image_width', 'image_height', 'image_blurhash']
 
     def to_representation(self, instance):
         response = super().to_representation(instance)
@@ -105,25 +112,160 @@ class VSerializer(serializers.ModelSerializer):
 class NewsSerializer(serializers.ModelSerializer):
     class Meta:
         model = News
-        exclude = ['tags']
+        # image_original is only the source of api.images renditions
+        exclude = ['tags', 'category_ids', 'tag_ids', 'image_original']
+
+    @staticmethod
+    def setup_eager_loading(queryset, request, prefix=''):
+        # everything to_representation touches, fetched once per page
+        queryset = queryset.select_related(prefix + 'user').prefetch_related(prefix + 'category')
+        if request.user.is_authenticated:
+            queryset = queryset.prefetch_related(
+                Prefetch(prefix + 'bookmark', Save.objects.filter(user=request.user), to_attr='user_bookmark'),
+                Prefetch(prefix + 'vote', Vote.objects.filter(user=request.user), to_attr='user_vote'),
+            )
+        return queryset
+
+    def user_relation(self, instance, related, user):
+        i = getattr(instance, 'user_' + related, None)
+        if i is None: i = getattr(instance, related).filter(user=user)
+        return i[0] if i else None
 
     def to_representation(self, instance):
         request = self.context.get("request")
         response = super().to_representation(instance)
-        response["category"] = CategorySerializer(instance.category, many=True).data
+        response["category"] = CategorySerializer(instance.category.all(), many=True).data
         response["username"] = instance.user.get_full_name() if instance.user else None
         response["image"] = request.build_absolute_uri(instance.image.url) if instance.image else None
         if request.user.is_authenticated:
-            i = instance.bookmark.filter(user=request.user)
-            response["save"] = SSerializer(i[0]).data if i else None
-            i = instance.vote.filter(user=request.user)
-            response["vote"] = VSerializer(i[0]).data if i else None
+            i = self.user_relation(instance, 'bookmark', request.user)
+            response["save"] = SSerializer(i).data if i else None
+            i = self.user_relation(instance, 'vote', request.user)
+            response["vote"] = VSerializer(i).data if i else None
         else:
             response["save"] = None
             response["vote"] = None
         return response
 
 
+def category_payloads(refresh=False):
+    """CategorySerializer output for every category, keyed by id."""
+    payloads = None if refresh else cache.get('category-payloads')
+    cache_lookup('category', payloads is not None)
+    if payloads is None:
+        payloads = {c['id']: c for c in CategorySerializer(Category.objects.all(), many=True).data}
+        cache.set('category-payloads', payloads, 300)
+    return payloads
+
+
+def category_ids(names):
+    """Ids of the categories called ``names``, from the cached payloads."""
+    payloads = category_payloads()
+    if not set(names) <= {c['name'] for c in payloads.values()}: payloads = category_payloads(refresh=True)
+    return [pk for pk, c in payloads.items() if c['name'] in names]
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def drop_category_payloads(sender, **kwargs):
+    cache.delete('category-payloads')
+
+
+# what the app needs to draw a feed card, for ?view=card
+CARD_FIELDS = [
+    'id', 'headline', 'time', 'image', 'newsAgency', 'file_type', 'pos', 'neg', 'clickable',
+    'category', 'save', 'vote', 'image_width', 'image_height', 'image_blurhash',
+]
+
+
+class NewsListSerializer:
+    """NewsSerializer for a whole page at once, built from ``.values()`` rows.
+
+    Skips the per-row field machinery and model instances: categories are
+    looked up by ``category_ids`` in the cached reference table, the media
+    url prefix is built once and the caller's saves and votes are one
+    query each. Output is the same json as
+    ``NewsSerializer(queryset, many=True)``.
+
+    ``fields`` narrows both the SELECT and the output to those keys (``id``
+    is always included); callers that already hold the user's saves or
+    votes for these news pass them in, keyed by news id.
+    """
+
+    fields = [f.attname for f in News._meta.concrete_fields
+              if not f.is_relation and f.attname not in ('category_ids', 'tag_ids', 'image_original')]
+    datetime = serializers.DateTimeField()
+
+    def __init__(self, queryset, request, fields=None, saves=None, votes=None):
+        self.queryset, self.request = queryset, request
+        self.only, self.saves, self.votes = fields, saves, votes
+
+    @staticmethod
+    def requested_fields(request):
+        """Keys asked for with ``?fields=a,b`` or ``?view=card``; None is everything."""
+        fields = request.query_params.get('fields')
+        if fields: return {'id'} | set(filter(None, fields.split(',')))
+        if request.query_params.get('view') == 'card': return set(CARD_FIELDS)
+        return None
+
+    def want(self, key):
+        return self.only is None or key in self.only
+
+    @property
+    def data(self):
+        want = self.want
+        columns = [f for f in self.fields if want(f)]
+        extra = ['category_ids'] if want('category') else []
+        if want('user') or want('username'): extra.append('user_id')
+        if want('username'): extra += ['user__first_name', 'user__last_name']
+        rows = list(self.queryset.values(*columns, *extra))
+        ids = [row['id'] for row in rows]
+
+        if want('category'):
+            categories = category_payloads()
+            if any(pk not in categories for row in rows for pk in row['category_ids']):
+                categories = category_payloads(refresh=True)
+
+        saves, votes = self.saves or {}, self.votes or {}
+        user = self.request.user
+        if user.is_authenticated:
+            if self.saves is None and want('save'): saves = self.related(Save, user, ids)
+            if self.votes is None and want('vote'): votes = self.related(Vote, user, ids)
+
+        media = self.request.build_absolute_uri(default_storage.url(''))
+        to_datetime = self.datetime.to_representation
+        data = []
+        for row in rows:
+            item = {field: row[field] for field in columns}
+            if 'time' in item: item['time'] = to_datetime(row['time'])
+            if 'created_at' in item: item['created_at'] = to_datetime(row['created_at'])
+            if 'image' in item: item['image'] = media + filepath_to_uri(row['image']) if row['image'] else None
+            if want('user'): item['user'] = row['user_id']
+            if want('category'): item['category'] = [categories[pk] for pk in row['category_ids'] if pk in categories]
+            if want('username'):
+                item['username'] = ('%s %s' % (row['user__first_name'], row['user__last_name'])).strip() if row['user_id'] else None
+            if want('save'): item['save'] = saves.get(row['id'])
+            if want('vote'): item['vote'] = votes.get(row['id'])
+            data.append(item)
+        return data
+
+    def related(self, model, user, ids):
+        rows = relation_values(model.objects.filter(user=user, news_id__in=ids))
+        return {row['news']: row for row in map(relation_payload, rows)}
+
+
+def relation_values(queryset):
+    """``.values()`` of a Save or Vote queryset, one row per relation_payload."""
+    return queryset.values(*[f.attname for f in queryset.model._meta.concrete_fields])
+
+
+def relation_payload(row):
+    """A Save or Vote row with the same keys and order as SSerializer / VSerializer."""
+    item = {key[:-3] if key.endswith('_id') else key: value for key, value in row.items()}
+    item['created_at'] = NewsListSerializer.datetime.to_representation(item['created_at'])
+    return item
+
+
 class SaveSerializer(serializers.ModelSerializer):
     class Meta:
         model = Save
@@ -144,7 +286,7 @@ class VoteSerializer(serializers.ModelSerializer):
 
     def to_representation(self, instance):
         response = super().to_representation(instance)
-        response["news"] = NewsSerializer(instance.new, context=self.context).data
+        response["news"] = NewsSerializer(instance.news, context=self.context).data
         return response
 
 
@@ -158,17 +300,17 @@ class MyNewsSerializer(serializers.ModelSerializer):
 class QuestionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Question
-        fields = ['question']
+        fields = ['id', 'question']
 
 
 class CompSerializer(serializers.ModelSerializer):
     class Meta:
         model = Comp
-        fields = ['name', 'org', 'type', 'about', 'fee', 'start_time', 'end_time']
+        fields = ['id', 'name', 'org', 'type', 'about', 'fee', 'capacity', 'start_time', 'end_time']
 
     def to_representation(self, instance):
         response = super().to_representation(instance)
-        response["org"] = OrganizationSerializer(instance.org).data
+        response["org"] = OrganizationSerializer(instance.org.all(), many=True).data
         return response
 
 
@@ -188,5 +330,12 @@ class EventSerializer(serializers.ModelSerializer):
     def to_representation(self, instance):
         response = super().to_representation(instance)
         response["org"] = OrganizationSerializer(instance.org).data
-        response["comp"] = OrganizationSerializer(instance.comp, many=True).data
+        response["comp"] = CompSerializer(instance.comp.all(), many=True).data
         return response
+
+
+class EventListingSerializer(EventSerializer):
+    """An event without its participants, which listings add apart."""
+    class Meta(EventSerializer.Meta):
+        fields = None
+        exclude = ['participants']
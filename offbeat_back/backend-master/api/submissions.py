@@ -0,0 +1,135 @@
+"""Quiz submissions. With SUBMISSION_BUFFER_DIR set, a submission is
+appended to its competition's log there and fsynced before the request is
+acknowledged. flush_submissions then moves the logs into CompSub in
+batches. Whichever path a submission takes, each user keeps one CompSub
+per competition: the latest by submission time.
+
+Workers append under a shared flock. The flusher takes the log's exclusive
+lock and renames it to a batch, so a worker that opened the log before the
+rename notices the swap and opens a fresh log. A batch is removed only
+after its rows are committed; a batch left behind by a crash is written
+again on the next flush, and writing it twice changes nothing.
+"""
+import fcntl, glob, logging, os, time
+
+import orjson
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.utils.dateparse import parse_datetime
+
+from .competition import competitions
+from .models import CompSub
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_xact_lock class of the per-competition store lock
+STORE_LOCK = 4401
+
+
+def log_path(comp):
+    return os.path.join(settings.SUBMISSION_BUFFER_DIR, '%d.log' % comp)
+
+
+def sync_directory():
+    # renames and new files are durable only once their directory is
+    fd = os.open(settings.SUBMISSION_BUFFER_DIR, os.O_RDONLY)
+    try: os.fsync(fd)
+    finally: os.close(fd)
+
+
+def submit(comp, user, ans, time):
+    """Records user ``user``'s answers to competition ``comp``. Returns once they are on disk."""
+    if not settings.SUBMISSION_BUFFER_DIR:
+        return store(comp, {user: {'user': user, 'ans': ans, 'time': time}})
+
+    line = orjson.dumps({'user': user, 'ans': ans, 'time': time}) + b'\n'
+    path = log_path(comp)
+    while True:
+        try: fd, created = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0o600), True
+        except FileExistsError: fd, created = os.open(path, os.O_WRONLY | os.O_APPEND), False
+        except FileNotFoundError:
+            os.makedirs(settings.SUBMISSION_BUFFER_DIR, exist_ok=True)
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            try: current = os.stat(path).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError: current = False
+            if current:
+                if os.write(fd, line) != len(line): raise OSError("short write to %s" % path)
+                os.fsync(fd)
+                if created: sync_directory()
+                return
+        finally:
+            # closing drops the lock
+            os.close(fd)
+
+
+def read_batch(path):
+    """``{user: submission}`` with each user's latest submission in the batch."""
+    latest = {}
+    with open(path, 'rb') as f:
+        for n, line in enumerate(f, 1):
+            try: record = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # cut short by a crash before it was fsynced, so never acknowledged
+                logger.warning("skipping unreadable line %d of %s", n, path)
+                continue
+            record['time'] = parse_datetime(record['time'])
+            if record['user'] not in latest or record['time'] >= latest[record['user']]['time']:
+                latest[record['user']] = record
+    return latest
+
+
+def store(comp, latest):
+    """Writes ``{user: submission}`` for competition ``comp``. A user's stored
+    submission is replaced unless it is newer, and graded on the way in.
+    Returns the number of rows written."""
+    entry = competitions.get(comp)
+    # gone since they submitted: nothing to attach the rows to
+    if entry is None: return 0
+    with transaction.atomic():
+        # one store per competition at a time: its rows then get ids in the
+        # order they commit, and a leaderboard reading past the highest id it
+        # has seen can't miss one committed late
+        with connection.cursor() as cursor: cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", [STORE_LOCK, comp])
+        users = set(User.objects.filter(pk__in=latest).values_list('pk', flat=True))
+
+        stored = CompSub.objects.select_for_update().filter(comp_id=comp, user_id__in=users)
+        newer = {user for user, at in stored.values_list('user_id', 'time') if at > latest[user]['time']}
+        stored.exclude(user_id__in=newer).delete()
+        writes = [latest[user] for user in users - newer]
+        scores = entry.key.grade([submission['ans'] for submission in writes])
+        rows = [
+            CompSub(comp_id=comp, user_id=submission['user'], ans=submission['ans'], time=submission['time'], score=score)
+            for submission, score in zip(writes, scores.tolist())
+        ]
+        CompSub.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def flush(comp):
+    """Moves competition ``comp``'s log, and any batch an earlier flush left, into
+    CompSub. Returns the number of rows written. Run one flusher at a time."""
+    path = log_path(comp)
+    try: fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError: pass
+    else:
+        try:
+            # waits out the appends in progress; later ones see the rename
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.rename(path, '%s.%d' % (path, time.time_ns()))
+            sync_directory()
+        finally: os.close(fd)
+
+    written = 0
+    for batch in sorted(glob.glob(glob.escape(path) + '.*')):
+        written += store(comp, read_batch(batch))
+        os.remove(batch)
+    return written
+
+
+def buffered():
+    """Competitions with a log or batch waiting to be flushed."""
+    names = os.listdir(settings.SUBMISSION_BUFFER_DIR) if os.path.isdir(settings.SUBMISSION_BUFFER_DIR) else []
+    return sorted({int(name.split('.')[0]) for name in names if name.split('.')[0].isdigit()})
@@ -1,3 +1,760 @@
-from django.test import TestCase
+import asyncio, json, os, re, shutil, subprocess, sys, tempfile, threading, time
+from contextlib import contextmanager
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from unittest import skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncClient, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLResolver
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIRequestFactory, APITestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from newscatcher_backend import urls
+from .authentication import version_key
+from .budgets import QUERY_BUDGETS, view_name
+from .dbrouters import ReplicaRouter, pin_to_primary, pinned, primary_reads, replica_reads
+from .feedindex import feed_index
+from .googleviews import GoogleLogin, GoogleTokenVerifier, finish_login
+from . import submissions
+from .competition import competitions
+from .images import BASE83, RenditionCache, describe, save_original
+from .scoring import AnswerKey, Leaderboard
+from .versions import bump, version
+from .models import (
+    CapacityShard, Category, Comp, CompSub, Event, MyCategory, MyNews, MyTag, News, Organization, Profile, Question, Quote,
+    Save, Tag, Topic, Vote,
+)
+
+def setUpModule():
+    # a 'shared' cache of the run's own, so a running app's isn't touched
+    # and ids starting over can't meet a previous run's entries
+    global shared_location, test_caches
+    shared_location = tempfile.mkdtemp()
+    test_caches = override_settings(CACHES=dict(settings.CACHES, shared={
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': shared_location,
+    }))
+    test_caches.enable()
+
+
+def tearDownModule():
+    test_caches.disable()
+    shutil.rmtree(shared_location)
+
+
+@contextmanager
+def committed():
+    """Runs the on_commit callbacks registered inside the block, which a
+    TestCase's transaction would never run."""
+    start = len(connection.run_on_commit)
+    yield
+    callbacks = connection.run_on_commit[start:]
+    del connection.run_on_commit[start:]
+    for _, callback in callbacks: callback()
+
+
+# admin, allauth and docs pages aren't ours; un/ pulls from google sheets
+SKIP = ('admin/', 'rest-auth/', 'un/', 'openapi/', 'swagger-ui/', 'current_version/')
+
+
+class GoogleStub(BaseHTTPRequestHandler):
+    """userinfo for the token 'good', google's error for any other, and a picture."""
+    hits = []
+
+    def do_GET(self):
+        port = self.server.server_address[1]
+        if self.path.startswith('/picture'):
+            buffer = BytesIO()
+            Image.new('RGB', (8, 8), (10, 20, 30)).save(buffer, 'PNG')
+            status, body, kind = 200, buffer.getvalue(), 'image/png'
+        else:
+            self.hits.append(self.path)
+            good = self.path.endswith('access_token=good')
+            status, kind = (200 if good else 401), 'application/json'
+            body = json.dumps({
+                'id': 'stub', 'email': 'stub@test.local', 'verified_email': True,
+                'picture': 'http://127.0.0.1:%d/picture.png' % port,
+            } if good else {'error': {'code': 401, 'message': 'Invalid Credentials'}}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', kind)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(DATABASE_ROUTERS=[], FEED_INDEX=False)
+class PerformanceTimingTests(APITestCase):
+
+    def test_sampled_request(self):
+        news = News.objects.create(headline='h', time=timezone.now(), body='b', source='https://test.local/', visibility=True)
+        news.category.add(Category.objects.create(name='world'))
+        with self.settings(PERF_TIMING=True, PERF_SAMPLE_RATE=1), self.assertLogs('api.performance', 'INFO') as logs:
+            response = self.client.get('/news/', {'page': 1})
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((line['method'], line['params'], line['status']), ('GET', 'page', 200))
+        self.assertGreater(line['queries'], 0)
+        spans = dict(re.findall(r'(\w+);dur=([\d.]+)', response['Server-Timing']))
+        self.assertEqual(set(spans), {'db', 'serialize', 'render', 'total'})
+        self.assertIn('desc="%d queries"' % line['queries'], response['Server-Timing'])
+        # only total overlaps the others
+        self.assertLessEqual(sum(float(spans[k]) for k in ('db', 'serialize', 'render')), float(spans['total']) + 0.01)
+
+
+class MetricsTests(SimpleTestCase):
+
+    def test_token(self):
+        with self.settings(METRICS_TOKEN='scrape'):
+            self.assertEqual(self.client.get('/metrics/').status_code, 403)
+            self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            response = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer scrape')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'api_request_latency_seconds', response.content)
+        with self.settings(METRICS_TOKEN=None):
+            self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class StatelessJWTTests(APITestCase):
+
+    def test_refused_users(self):
+        user = User.objects.create_user('holder')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer %s' % RefreshToken.for_user(user).access_token)
+        self.assertEqual(self.client.get('/profile-info/').status_code, 200)
+
+        user.is_active = False
+        user.save()
+        self.assertEqual(self.client.get('/profile-info/').status_code, 401)
+
+        # another worker's save: only the token in the shared cache changes here
+        User.objects.filter(pk=user.pk).update(is_active=True)
+        bump(version_key(user.pk))
+        self.assertEqual(self.client.get('/profile-info/').status_code, 200)
+
+        user.delete()
+        self.assertEqual(self.client.post('/save/', {'news': 1}).status_code, 401)
+
+
+class ProfileSaveTests(APITestCase):
+
+    def updated_columns(self, profile, **kwargs):
+        with CaptureQueriesContext(connection) as captured: profile.save(**kwargs)
+        updates = [q['sql'] for q in captured if q['sql'].startswith('UPDATE')]
+        return [sorted(re.findall(r'"(\w+)" = ', sql.split(' WHERE ')[0])) for sql in updates]
+
+    def test_dirty_fields(self):
+        profile = Profile.objects.get(user=User.objects.create_user('profile'))
+        profile.designation = 'editor'
+        self.assertEqual(self.updated_columns(profile), [['designation']])
+        self.assertEqual(self.updated_columns(profile), [])
+
+        # a change left out of update_fields is written by the next save
+        profile.designation, profile.version = 'writer', 2
+        self.assertEqual(self.updated_columns(profile, update_fields=['version']), [['version']])
+        self.assertEqual(self.updated_columns(profile), [['designation']])
+        self.assertEqual(Profile.objects.values_list('designation', 'version').get(pk=profile.pk), ('writer', 2))
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class GoogleLoginTests(APITestCase):
+
+    def test_stub_server(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), GoogleStub)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        url = 'http://127.0.0.1:%d/userinfo' % server.server_address[1]
+        view = GoogleLogin.as_view(verifier=GoogleTokenVerifier(url=url, ttl=60))
+        verifier = view.view_initkwargs['verifier']
+        cache.delete_many([verifier.cache_key('good'), verifier.cache_key('bad')])
+        GoogleStub.hits.clear()
+
+        with tempfile.TemporaryDirectory() as media, self.settings(MEDIA_ROOT=media):
+            logins = [view(APIRequestFactory().post('/auth/google/', {'token': 'good'})).data for _ in range(2)]
+        self.assertEqual([login['username'] for login in logins], ['stub', 'stub'])
+        self.assertTrue(logins[0]['new_user'])
+        # the second login is answered from the cache
+        self.assertEqual(len(GoogleStub.hits), 1)
+
+        for _ in range(2):
+            response = view(APIRequestFactory().post('/auth/google/', {'token': 'bad'}))
+            self.assertIn('wrong google token', response.data['message'])
+        # errors aren't cached
+        self.assertEqual(len(GoogleStub.hits), 3)
+
+        # and a google that can't be reached is an error too
+        server.shutdown()
+        server.server_close()
+        self.assertIn('error', GoogleTokenVerifier(url=url).verify('unreachable'))
+
+
+# the feed index and leaderboards catch up on a timer, which would make
+# query counts flaky; replica connections can't see the test's transaction
+@override_settings(FEED_INDEX=False, LEADERBOARD_REFRESH=3600, DATABASE_ROUTERS=[])
+class QueryBudgetTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('reader', 'reader@test.local', 'x')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer %s' % RefreshToken.for_user(self.user).access_token)
+
+        self.org = Organization.objects.create(name='org')
+        self.category = Category.objects.create(name='world')
+        self.tag = Tag.objects.create(name='world')
+        MyTag.objects.create(user=self.user).tags.add(self.tag)
+        MyCategory.objects.create(user=self.user).categorys.add(self.category)
+        self.rows = 0
+        self.add_rows(2)
+
+    def add_rows(self, n):
+        now = timezone.now()
+        for i in range(self.rows, self.rows + n):
+            author = User.objects.create_user('author-%d' % i, first_name='Author', last_name=str(i))
+            category = Category.objects.create(name='category-%d' % i)
+            Tag.objects.create(name='tag-%d' % i)
+            Topic.objects.create(name='topic-%d' % i)
+            Quote.objects.create(author='author', body='quote %d' % i, period='now', visibility=True)
+
+            news = News.objects.create(
+                headline='headline %d' % i, time=now, body='body', source='https://test.local/%d' % i,
+                image='news.png', user=author, visibility=True,
+            )
+            news.category.add(self.category, category)
+            news.tags.add(self.tag)
+            news.etags.add('etag', 'etag-%d' % i)
+            Save.objects.create(user=self.user, news=news)
+            Vote(user=self.user, news=news, polarity=True).save()
+            MyNews.objects.create(headline='mine %d' % i, body='body', source='https://test.local/%d' % i, user=self.user)
+
+            org = Organization.objects.create(name='org-%d' % i)
+            comp = Comp.objects.create(name='comp-%d' % i, start_time=now, end_time=now + timedelta(hours=1))
+            comp.org.add(self.org, org)
+            event = Event.objects.create(name='event-%d' % i, org=org, fee=0, start_time=now, end_time=now)
+            event.comp.add(comp)
+        self.rows += n
+
+    def detail_pks(self):
+        # keyed by router basename, which defaults to the queryset's model
+        return {
+            'mytag': MyTag.objects.get(user=self.user).pk,
+            'mycategory': MyCategory.objects.get(user=self.user).pk,
+            'mynews': MyNews.objects.filter(user=self.user).first().pk,
+            'save': Save.objects.filter(user=self.user).first().pk,
+            'vote': Vote.objects.filter(user=self.user).first().pk,
+            'organization': self.org.pk,
+            'user': self.user.pk,
+            'profile': self.user.profile.pk,
+            'comp': Comp.objects.first().pk,
+            'news': News.objects.first().pk,
+        }
+
+    def endpoints(self):
+        pks = self.detail_pks()
+        for pattern in urls.urlpatterns:
+            if not isinstance(pattern, URLResolver):
+                if not str(pattern.pattern).startswith(SKIP):
+                    yield '/' + str(pattern.pattern).replace('<int:pk>', str(pks['news'])), pattern.callback
+            elif pattern.urlconf_name is urls.router.urls:
+                for route in pattern.url_patterns:
+                    regex = str(route.pattern)
+                    if '(?P<format>' in regex: continue
+                    basename = route.name.rsplit('-', 1)[0]
+                    path = re.sub(r'\(\?P<pk>[^)]*\)', str(pks.get(basename, 0)), regex)
+                    yield '/' + path.strip('^$'), route.callback
+
+    def measure(self):
+        counts = {}
+        for path, callback in self.endpoints():
+            with CaptureQueriesContext(connection) as captured:
+                response = self.client.get(path, {'page_size': 100})
+            self.assertLess(response.status_code, 500, path)
+            counts[path] = (view_name(callback), len(captured))
+        return counts
+
+    def test_query_budgets(self):
+        # each pass runs twice so reference caches are filled before counting
+        self.measure()
+        small = self.measure()
+        self.add_rows(10)
+        self.measure()
+        large = self.measure()
+
+        for path, (view, queries) in large.items():
+            with self.subTest(path=path, view=view):
+                self.assertIn(view, QUERY_BUDGETS, "add a query budget for %s" % view)
+                self.assertLessEqual(queries, QUERY_BUDGETS[view])
+                self.assertLessEqual(queries, small[path][1], "query count grows with the number of rows")
+
+
+@skipUnless(connection.vendor == 'postgresql', "EXPLAIN plans need PostgreSQL")
+@override_settings(FEED_INDEX=False, DATABASE_ROUTERS=[])
+class FeedIndexTests(APITestCase):
+    """Every NewsView query shape is answered from an index.
+
+    Plans are taken with enable_seqscan off, so the planner only falls back
+    to a seq scan of api_news or its through tables when no index fits.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('seed', news=3000, users=30, votes=300, saves=300, categories=8, tags=20, etags=50, days=30, stdout=StringIO())
+        with connection.cursor() as cursor: cursor.execute('ANALYZE')
+
+    def setUp(self):
+        reader = MyCategory.objects.values_list('user_id', flat=True).first()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer %s' % RefreshToken.for_user(User(pk=reader)).access_token)
+
+    def plans(self, path):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200, path)
+
+        plans = []
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            for query in captured:
+                if 'api_news' not in query['sql'] or not query['sql'].startswith(('SELECT', 'WITH')): continue
+                cursor.execute('EXPLAIN ' + query['sql'])
+                plans.append('\n'.join(row[0] for row in cursor.fetchall()))
+        return '\n'.join(plans)
+
+    def test_feed_indexes(self):
+        anchor = News.objects.filter(visibility=True, independent=False).order_by('-id').values_list('id', flat=True)[500]
+        category = Category.objects.values_list('name', flat=True).first()
+        word = News.objects.values_list('headline', flat=True).first().split()[0]
+        tags = Tag.objects.order_by('id').values_list('id', flat=True)
+
+        # path, index the plan must use (None: any index will do)
+        shapes = [
+            ('/news/?page=3', None),
+            ('/news/?category=independent', 'news_feed_idx'),
+            ('/news/?category=%s' % category, None),
+            ('/news/?category=preference', None),
+            ('/news/?category=trending', 'news_recent_idx'),
+            ('/news/?id=%d&next=10&prev=10' % anchor, None),
+            ('/news/?category=trending&id=%d&next=5&prev=5' % anchor, 'news_recent_idx'),
+            ('/news/?search=%s' % word, 'news_search_idx'),
+            ('/news/?tag=%d,%d&tag_mode=all' % (tags[0], tags[1]), None),
+        ]
+        for path, index in shapes:
+            with self.subTest(path=path):
+                plans = self.plans(path)
+                self.assertNotIn('Seq Scan on api_news', plans)
+                if index: self.assertIn(index, plans)
+
+
+@skipUnless(connection.vendor == 'postgresql', "id array filters need PostgreSQL")
+@override_settings(DATABASE_ROUTERS=[])
+class PostingIndexTests(APITestCase):
+    """Feeds answered from the feed index match the database's answer."""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('seed', news=2000, users=10, votes=0, saves=0, categories=6, tags=12, etags=20, stdout=StringIO())
+
+    def test_same_feeds(self):
+        tags = Tag.objects.order_by('id').values_list('id', flat=True)
+        categories = Category.objects.order_by('id').values_list('name', flat=True)
+        anchor = News.objects.order_by('id').values_list('id', flat=True)[1000]
+        queries = [
+            {'tag': tags[0]},
+            {'tag': '%d,%d' % (tags[0], tags[1])},
+            {'tag': '%d,%d' % (tags[0], tags[1]), 'tag_mode': 'all'},
+            {'category': categories[0], 'tag': tags[2]},
+            {'category': 'independent,%s,%s' % (categories[1], categories[2]), 'page': 2},
+            {'category': 'unknown'},
+            {'page': 4},
+            {'tag': tags[0], 'id': anchor, 'next': 10, 'prev': 10},
+            {'category': categories[3], 'id': anchor, 'next': 0, 'prev': 15},
+        ]
+        feed_index.build()
+        for query in queries:
+            with self.subTest(**query):
+                with self.settings(FEED_INDEX=False): expected = self.client.get('/news/', query).json()
+                self.assertEqual(self.client.get('/news/', query).json(), expected)
+
+        # newer news are appended on the next refresh, without a rebuild
+        news = News.objects.create(headline='new', time=timezone.now(), body='body', source='https://test.local/new',
+                                   image='news.png', visibility=True)
+        news.tags.add(tags[0])
+        feed_index.checked = 0
+        self.assertEqual(self.client.get('/news/', {'tag': tags[0]}).json()['next'][0]['id'], news.pk)
+
+    def test_tags_added_after_catch_up(self):
+        tag = Tag.objects.order_by('id').first()
+        feed_index.build()
+        # add_news saves the row before its tags; a catch-up can fall in between
+        news = News.objects.create(headline='new', time=timezone.now(), body='body', source='https://test.local/new',
+                                   image='news.png', visibility=True)
+        feed_index.checked = 0
+        self.assertNotEqual(self.client.get('/news/', {'tag': tag.pk}).json()['next'][0]['id'], news.pk)
+        news.tags.add(tag)
+        feed_index.checked = 0
+        self.assertEqual(self.client.get('/news/', {'tag': tag.pk}).json()['next'][0]['id'], news.pk)
+
+        # once settled it stays, and the tail is no longer read again
+        News.objects.filter(pk=news.pk).update(created_at=timezone.now() - timedelta(hours=1))
+        News.objects.exclude(pk=news.pk).update(created_at=timezone.now() - timedelta(hours=2))
+        feed_index.checked = 0
+        self.assertEqual(self.client.get('/news/', {'tag': tag.pk}).json()['next'][0]['id'], news.pk)
+        self.assertEqual((feed_index.high_water, feed_index.tail), (news.pk, []))
+
+    def test_settled_edits(self):
+        News.objects.update(created_at=timezone.now() - timedelta(hours=2))
+        feed_index.build()
+        tag = Tag.objects.order_by('id').first()
+        tagged = lambda news: news.pk in feed_index.select(news.independent, None, (tag.pk,))
+        news = News.objects.get(pk=feed_index.select(False, None, (tag.pk,))[-1])
+        hidden = News.objects.filter(visibility=True, independent=False).exclude(pk=news.pk).order_by('-id')[5]
+
+        # as another process would, without touching this one's index
+        news.tags.remove(tag)
+        hidden.visibility = False
+        hidden.save()
+        feed_index.checked = 0
+        self.assertFalse(tagged(news))
+        self.assertNotIn(hidden.pk, feed_index.select(False))
+        news.tags.add(tag)
+        feed_index.checked = 0
+        self.assertTrue(tagged(news))
+
+        # the same arrays a rebuild makes
+        caught_up = feed_index.postings
+        feed_index.build()
+        for key in set(caught_up) | set(feed_index.postings):
+            self.assertEqual(list(caught_up.get(key, ())), list(feed_index.postings.get(key, ())), key)
+
+
+class ReplicaRouterTests(SimpleTestCase):
+
+    @override_settings(REPLICA_MAX_LAG=5, REPLICA_LAG_CHECK=60)
+    def test_lag(self):
+        router = ReplicaRouter()
+        router.replicas = ['replica_0', 'replica_1']
+        # lags measured a moment ago, so the router takes them as they are
+        measured = lambda *lags: {'replica_%d' % i: (time.monotonic(), lag) for i, lag in enumerate(lags)}
+
+        router.lags = measured(1.0, 30.0)
+        self.assertIsNone(router.db_for_read(News))
+        with replica_reads():
+            self.assertEqual({router.db_for_read(News) for _ in range(20)}, {'replica_0'})
+            router.lags = measured(30.0, float('inf'))
+            self.assertEqual(router.db_for_read(News), 'default')
+            router.lags = measured(0.0, 0.0)
+            primary_reads()
+            self.assertIsNone(router.db_for_read(News))
+        self.assertEqual(router.db_for_write(News), 'default')
+
+    def test_pin_reaches_other_workers(self):
+        user = User(pk=987654)
+        self.assertFalse(pinned(user))
+        pin_to_primary(user)
+        self.assertTrue(pinned(user))
+        # another process, as another worker would
+        check = "import django; django.setup(); from django.contrib.auth.models import User; " \
+                "from api.dbrouters import pinned; print(pinned(User(pk=987654)))"
+        env = dict(os.environ, SHARED_CACHE_LOCATION=shared_location)
+        worker = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True, cwd=settings.BASE_DIR, env=env)
+        self.assertEqual(worker.stdout.strip(), 'True', worker.stderr)
+
+
+class AsyncChainTests(SimpleTestCase):
+
+    @override_settings(METRICS_TOKEN='scrape', COMPRESS_MIN_SIZE=0)
+    async def test_async_middleware(self):
+        # an ASGI request goes through the middleware as coroutines
+        handler = AsyncClient().handler
+        handler.load_middleware(is_async=True)
+        self.assertTrue(asyncio.iscoroutinefunction(handler._middleware_chain))
+        # django 3.1's AsyncClient takes headers by their http names
+        headers = {'authorization': 'Bearer scrape', 'accept-encoding': 'gzip'}
+        response = await AsyncClient().get('/metrics/', **headers)
+        self.assertEqual((response.status_code, response['Content-Encoding']), (200, 'gzip'))
+
+
+@override_settings(DATABASE_ROUTERS=[], QUIZ_QUESTIONS=5)
+class CompetitionTests(APITestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        self.comp = Comp.objects.create(name='quiz', start_time=now - timedelta(hours=1), end_time=now + timedelta(hours=1))
+        category = Category.objects.create(name='quiz')
+        self.comp.ques.add(*[Question.objects.create(category=category, question={'q': i}) for i in range(12)])
+        self.participant, self.outsider = User.objects.create_user('participant'), User.objects.create_user('outsider')
+        self.comp.participants.add(self.participant)
+
+    def questions(self, user):
+        self.client.force_authenticate(user)
+        return self.client.post('/competition/%d/questions/' % self.comp.pk).json()
+
+    def test_participants_only(self):
+        picked = self.questions(self.participant)
+        self.assertEqual(len(picked), 5)
+        self.assertEqual(len({question['id'] for question in picked}), 5)
+        # the same set on every request, as on every worker
+        self.assertEqual(self.questions(self.participant), picked)
+        self.assertEqual(self.questions(self.outsider), [])
+
+        self.comp.participants.add(self.outsider)
+        self.assertEqual(len(self.questions(self.outsider)), 5)
+
+    def test_registration_keeps_entry(self):
+        self.questions(self.participant)
+        entry = competitions.entries[self.comp.pk]
+        url = '/competition/%d/register/' % self.comp.pk
+        self.client.force_authenticate(self.outsider)
+        with committed(): self.assertEqual(self.client.post(url).json(), {'success': True})
+        self.assertEqual(len(self.questions(self.outsider)), 5)
+        with committed(): self.client.delete(url)
+        self.assertEqual(self.questions(self.outsider), [])
+        self.comp.participants.clear()
+        self.assertEqual(self.questions(self.participant), [])
+        # joining and leaving didn't reload the pool or the leaderboard
+        self.assertIs(competitions.entries[self.comp.pk], entry)
+
+    def test_window(self):
+        now = timezone.now()
+        for start, end, served in [(-1, 1, True), (1, 2, False), (-2, -1, False)]:
+            with self.subTest(start=start, end=end):
+                self.comp.start_time, self.comp.end_time = now + timedelta(hours=start), now + timedelta(hours=end)
+                self.comp.save()
+                self.assertEqual(len(self.questions(self.participant)), 5 if served else 0)
+                answer = self.client.post('/competition/%d/submission/' % self.comp.pk, {'1': 'A'}, format='json')
+                self.assertEqual(answer.json()['success'], served)
+
+    def test_leaderboard(self):
+        self.comp.ques.filter(question__q__lt=3).update(answer='A')
+        now, users = timezone.now(), [User.objects.create_user('ranked%d' % i) for i in range(4)]
+        CompSub.objects.bulk_create(
+            CompSub(comp=self.comp, user=user, score=score, time=now + timedelta(seconds=i))
+            for i, (user, score) in enumerate(zip(users, [3, 1, 3, 2])))
+        self.client.force_authenticate(users[3])
+        url = '/competition/%d/leaderboard/' % self.comp.pk
+        board = self.client.get(url).json()
+        self.assertEqual([(row['rank'], row['user'], row['score']) for row in board['results']],
+                         [(1, users[0].pk, 3), (1, users[2].pk, 3), (3, users[3].pk, 2), (4, users[1].pk, 1)])
+        self.assertEqual(board['me'], {'rank': 3, 'score': 2})
+        self.assertEqual(self.client.get(url, {'page': 2}).json()['results'], [])
+
+        for page in ('x', '0', '-1'):
+            self.assertEqual(self.client.get(url, {'page': page}).status_code, 400)
+        self.assertEqual(self.client.get('/competition/x/leaderboard/').status_code, 404)
+        self.assertEqual(self.client.post('/competition/x/questions/').status_code, 404)
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class SubmissionBufferTests(APITestCase):
+    """Buffered submissions reach CompSub once flushed, each user's latest winning."""
+
+    def test_latest_submission_wins(self):
+        now = timezone.now()
+        comp = Comp.objects.create(name='quiz', start_time=now - timedelta(hours=1), end_time=now + timedelta(hours=1))
+        first, second = User.objects.create_user('first'), User.objects.create_user('second')
+        comp.participants.add(first, second)
+        CompSub.objects.create(comp=comp, user=second, ans={'1': 'stored'}, time=now + timedelta(seconds=5))
+
+        with tempfile.TemporaryDirectory() as buffer, self.settings(SUBMISSION_BUFFER_DIR=buffer):
+            self.client.force_authenticate(first)
+            for answer in 'abc':
+                self.assertEqual(self.client.post('/competition/%d/submission/' % comp.pk, {'1': answer}, format='json').json(), {'success': True})
+            submissions.submit(comp.pk, second.pk, {'1': 'older'}, now)
+            self.assertFalse(CompSub.objects.filter(user=first).exists())
+
+            # a torn last line, and a batch an interrupted flush left behind
+            with open(submissions.log_path(comp.pk), 'ab') as log: log.write(b'{"user": 1')
+            with open(submissions.log_path(comp.pk) + '.1', 'w') as batch:
+                batch.write('{"user": %d, "ans": {"1": "left"}, "time": "%s"}\n' % (first.pk, (now - timedelta(hours=1)).isoformat()))
+
+            with self.assertLogs('api.submissions', 'WARNING'): self.assertEqual(submissions.flush(comp.pk), 2)
+            self.assertEqual(submissions.buffered(), [])
+        self.assertEqual(dict(CompSub.objects.values_list('user__username', 'ans')), {'first': {'1': 'c'}, 'second': {'1': 'stored'}})
+
+
+class ScoringTests(SimpleTestCase):
+
+    def test_grading(self):
+        key = AnswerKey({1: 'A', 2: 1, 3: ['a', 'b'], 5: {'x': 1}})
+        scores = key.grade([
+            {'1': 'A', '2': 1, '3': ['a', 'b'], '5': {'x': 1}},
+            {'1': 'a', '2': True, '3': ['b', 'a'], '4': 'A', '5': {'x': 1.0}},
+            # another question's answer, and json where a plain value is expected
+            {'1': 1, '2': ['a', 'b'], '3': 'A', '5': {'x': 1}},
+            {},
+        ])
+        self.assertEqual(scores.tolist(), [4, 0, 1, 0])
+
+    def test_leaderboard_matches_sort(self):
+        board, expected = Leaderboard(1, 10), {}
+        board.checked = float('inf')
+        now = timezone.now()
+        for i in range(500):
+            user, score, at = i * 7 % 97, i * 13 % 11, now + timedelta(seconds=i)
+            board.update(user, score, at)
+            expected[user] = (score, at)
+
+        order = sorted(expected, key=lambda user: (-expected[user][0], expected[user][1]))
+        for offset in (0, 5, 60, 90):
+            page = board.page(offset, 20)
+            self.assertEqual([user for _, user, _ in page], order[offset:offset + 20])
+            for rank, user, score in page:
+                self.assertEqual(rank, 1 + sum(1 for other, _ in expected.values() if other > score))
+                self.assertEqual(board.rank(user), (rank, score))
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class ListingTests(APITestCase):
+
+    def test_listing(self):
+        now = timezone.now()
+        Comp.objects.create(name='live', start_time=now - timedelta(hours=1), end_time=now + timedelta(hours=1))
+        self.assertEqual([comp['name'] for comp in self.client.get('/competition/', {'when': 'live'}).json()], ['live'])
+        # a change drops the cached listing
+        Comp.objects.create(name='next', start_time=now + timedelta(hours=1), end_time=now + timedelta(hours=2))
+        self.assertEqual(len(self.client.get('/competition/', {'when': 'upcoming', 'page': 1}).json()), 1)
+        self.assertEqual(len(self.client.get('/competition/').json()), 2)
+
+        self.assertEqual(self.client.get('/competition/', {'page': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get('/competition/', {'when': 'soon'}).status_code, 400)
+
+    @override_settings(LISTING_PARTICIPANTS_TTL=0)
+    def test_participants_apart(self):
+        now, user = timezone.now(), User.objects.create_user('registered')
+        event = Event.objects.create(name='event', org=Organization.objects.create(name='org'), fee=0,
+                                     start_time=now + timedelta(days=1), end_time=now + timedelta(days=2))
+        self.assertEqual(self.client.get('/event/').json()[0]['participants'], [])
+        listed = version('listings-version')
+
+        self.client.force_authenticate(user)
+        with committed(): self.client.post('/event/%d/register/' % event.pk)
+        # the listing stays cached; only its participants are read again
+        self.assertEqual(version('listings-version'), listed)
+        self.assertEqual(self.client.get('/event/').json()[0]['participants'], [user.pk])
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class RegistrationTests(APITestCase):
+
+    def test_capacity(self):
+        now = timezone.now()
+        event = Event.objects.create(name='event', org=Organization.objects.create(name='org'), fee=0, capacity=2,
+                                     start_time=now + timedelta(days=1), end_time=now + timedelta(days=2))
+        users = [User.objects.create_user('user-%d' % i) for i in range(3)]
+        results = []
+        for user in users + users[:1]:
+            self.client.force_authenticate(user)
+            results.append(self.client.post('/event/%d/register/' % event.pk).status_code)
+        self.assertEqual(results, [200, 200, 409, 200])
+        self.assertEqual(event.participants.count(), 2)
+
+        # a place given back goes to the next one, and an admin edit reshards
+        self.client.force_authenticate(users[0])
+        self.client.delete('/event/%d/register/' % event.pk)
+        self.client.force_authenticate(users[2])
+        self.assertEqual(self.client.post('/event/%d/register/' % event.pk).status_code, 200)
+        event.participants.add(users[0])
+        self.assertEqual(sum(CapacityShard.objects.filter(event=event).values_list('remaining', flat=True)), 0)
+        self.assertEqual(event.participants.count(), 3)
+
+
+class MediaTests(SimpleTestCase):
+
+    def test_ranges_and_etags(self):
+        with tempfile.TemporaryDirectory() as media, self.settings(MEDIA_ROOT=media, MEDIA_ACCEL=None):
+            with open(os.path.join(media, 'clip.mp4'), 'wb') as f: f.write(bytes(range(256)) * 4)
+
+            whole = self.client.get('/media/clip.mp4')
+            self.assertEqual(len(b''.join(whole.streaming_content)), 1024)
+            self.assertEqual(whole['Cache-Control'], 'public, max-age=3600, must-revalidate')
+
+            part = self.client.get('/media/clip.mp4', HTTP_RANGE='bytes=256-259')
+            self.assertEqual((part.status_code, part['Content-Range']), (206, 'bytes 256-259/1024'))
+            self.assertEqual(b''.join(part.streaming_content), bytes(range(4)))
+
+            self.assertEqual(self.client.get('/media/clip.mp4', HTTP_RANGE='bytes=2000-').status_code, 416)
+            self.assertEqual(self.client.get('/media/clip.mp4', HTTP_IF_NONE_MATCH=whole['ETag']).status_code, 304)
+            # the name back with other content, as after django_cleanup
+            with open(os.path.join(media, 'clip.mp4'), 'wb') as f: f.write(bytes(range(255)) * 4)
+            self.assertEqual(self.client.get('/media/clip.mp4', HTTP_IF_NONE_MATCH=whole['ETag']).status_code, 200)
+            self.assertEqual(self.client.get('/media/../clip.mp4').status_code, 404)
+
+
+@override_settings(DATABASE_ROUTERS=[])
+class RenditionTests(APITestCase):
+
+    def test_renditions(self):
+        with tempfile.TemporaryDirectory() as media, self.settings(MEDIA_ROOT=media, MEDIA_ACCEL=None):
+            source = os.path.join(media, 'source.jpg')
+            Image.new('RGB', (1600, 900)).save(source)
+            news = News.objects.create(headline='h', time=timezone.now(), body='b', source='https://test.local/', visibility=True)
+            save_original(news.image_original, source, 'news')
+            news.save()
+
+            for width, fmt, size in [(300, 'webp', (300, 168)), (1080, 'jpeg', (1080, 607))]:
+                response = self.client.get('/image/news/%d/' % news.pk, {'w': width, 'fmt': fmt})
+                self.assertEqual(response['Content-Type'], 'image/' + fmt)
+                self.assertEqual(Image.open(BytesIO(b''.join(response.streaming_content))).size, size)
+            self.assertEqual(self.client.get('/image/news/%d/' % news.pk, {'w': 301}).status_code, 400)
+
+            # the stored name back with another picture, as after django_cleanup
+            Image.new('RGB', (600, 600)).save(news.image_original.path)
+            response = self.client.get('/image/news/%d/' % news.pk, {'w': 300, 'fmt': 'webp'})
+            self.assertEqual(Image.open(BytesIO(b''.join(response.streaming_content))).size, (300, 300))
+
+    def test_shared_budget(self):
+        with tempfile.TemporaryDirectory() as media, self.settings(MEDIA_ROOT=media, IMAGE_CACHE_MAX_BYTES=6000):
+            for i in range(8):
+                Image.effect_noise((40, 40), 64).save(os.path.join(media, '%d.png' % i))
+            # caches of two workers adding to the same directory
+            workers = [RenditionCache(), RenditionCache()]
+            made = [workers[i % 2].get('%d.png' % i, 120, 'png') for i in range(8)]
+            self.assertTrue(os.path.exists(os.path.join(media, made[-1])))
+            on_disk = sum(entry.stat().st_size for entry in workers[0].files())
+            with open(os.path.join(workers[0].root, '.size')) as total: self.assertEqual(int(total.read()), on_disk)
+            self.assertLessEqual(on_disk, 6000)
+
+    def test_placeholder(self):
+        with tempfile.TemporaryDirectory() as media, self.settings(MEDIA_ROOT=media):
+            news = News.objects.create(headline='h', time=timezone.now(), body='b', source='https://test.local/', visibility=True)
+            buffer = BytesIO()
+            Image.new('RGB', (300, 200), (200, 40, 40)).save(buffer, 'PNG')
+            news.image.save('news.png', ContentFile(buffer.getvalue()), save=False)
+            describe(news)
+            news.save()
+
+            data = self.client.get('/news/%d/' % news.pk, {'view': 'card'}).json()
+            self.assertEqual((data['image_width'], data['image_height']), (300, 200))
+            # 4x3 components, after the size, the maximum and the average colour
+            self.assertEqual(len(data['image_blurhash']), 28)
+            average = sum(BASE83.index(c) * 83 ** (3 - i) for i, c in enumerate(data['image_blurhash'][2:6]))
+            self.assertEqual((average >> 16, average >> 8 & 255, average & 255), (200, 40, 40))
+
+    def test_profile_placeholder(self):
+        user = User.objects.create_user('pictured')
+        with tempfile.TemporaryDirectory() as media, self.settings(MEDIA_ROOT=media):
+            # google's picture unreadable: logged in all the same
+            self.assertIn('access_token', finish_login(user, False, b'not an image', 0))
+            self.assertIsNone(Profile.objects.get(user=user).image_blurhash)
+
+            buffer = BytesIO()
+            Image.new('RGB', (40, 20), (255, 255, 0)).save(buffer, 'PNG')
+            self.client.force_authenticate(user)
+            upload = SimpleUploadedFile('me.png', buffer.getvalue(), 'image/png')
+            with CaptureQueriesContext(connection) as queries:
+                data = self.client.patch('/profile-info/%d/' % user.profile.pk, {'image': upload}, format='multipart').json()
+            self.assertEqual((data['image_width'], data['image_height'], len(data['image_blurhash'])), (40, 20, 28))
+            # described before the image is stored, in one write with it
+            updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "api_profile"')]
+            self.assertEqual(len(updates), 1)
+            self.assertIn('"image_blurhash"', updates[0])
+            with Image.open(Profile.objects.get(user=user).image.path) as stored: self.assertEqual(stored.size, (40, 20))
@@ -0,0 +1,20 @@
+"""Version tokens in the 'shared' cache. Entries cached under a token's
+current value, in the cache or in a process, are dropped for every worker
+at once by replacing the token."""
+import uuid
+
+from django.core.cache import caches
+
+
+def version(key):
+    cache = caches['shared']
+    token = cache.get(key)
+    if token is None:
+        # whoever adds first wins; everyone then reads the same token
+        cache.add(key, uuid.uuid4().hex, None)
+        token = cache.get(key)
+    return token
+
+
+def bump(*keys):
+    caches['shared'].set_many({key: uuid.uuid4().hex for key in keys}, None)
@@ -1,34 +1,64 @@
 from datetime import datetime, timedelta
-from django.http import Http404
+from django.conf import settings
+from django.core.exceptions import EmptyResultSet
+from django.http import Http404, HttpResponse
 from django.shortcuts import render, get_object_or_404
 from rest_framework import response, views, generics, viewsets, permissions, decorators
-from django.contrib.postgres.search import SearchVector
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connections
 from django.utils import timezone
 
-from django.db.models import F, Q
+from django.contrib.postgres.fields import ArrayField
+from django.db.models import F, Q, Case, Func, When, IntegerField, Subquery
+from django.db.models.expressions import RawSQL
 from django.db.models.functions import Extract
-from django.core.paginator import Paginator
 
 from .models import *
 from .serializers import *
 from .pagination import *
-
-class CategoryView(generics.ListAPIView):
+from .authentication import StatelessJWTAuthentication
+from .competition import competitions
+from .images import measure
+from .listings import listing
+from .registration import register, unregister
+from . import submissions
+from .dbrouters import pinned, primary_reads, replica_reads
+from .feedindex import around, feed_index
+from .middleware import timed
+
+class ReplicaReadsMixin:
+    """Safe requests read from a replica (see ``api.dbrouters``) unless the
+    user wrote in the last ``REPLICA_PIN_SECONDS``."""
+
+    def dispatch(self, request, *args, **kwargs):
+        with replica_reads(request.method in permissions.SAFE_METHODS):
+            return super().dispatch(request, *args, **kwargs)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if pinned(request.user): primary_reads()
+
+
+class CategoryView(ReplicaReadsMixin, generics.ListAPIView):
+    authentication_classes = [StatelessJWTAuthentication]
     queryset = Category.objects.all().order_by('name')
     serializer_class = CategorySerializer
 
 
-class TagView(generics.ListAPIView):
+class TagView(ReplicaReadsMixin, generics.ListAPIView):
+    authentication_classes = [StatelessJWTAuthentication]
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
 
 
-class TopicView(generics.ListAPIView):
+class TopicView(ReplicaReadsMixin, generics.ListAPIView):
+    authentication_classes = [StatelessJWTAuthentication]
     queryset = Topic.objects.all().order_by('priority')
     serializer_class = TopicSerializer
 
 
-class QuoteView(generics.ListAPIView):
+class QuoteView(ReplicaReadsMixin, generics.ListAPIView):
+    authentication_classes = [StatelessJWTAuthentication]
     queryset = Quote.objects.filter(visibility = True)
     serializer_class = QuoteSerializer
 
@@ -39,7 +69,7 @@ class MyTagViewSet(viewsets.ModelViewSet):
     serializer_class = MyTagSerializer
 
     def get_queryset(self):
-        return MyTag.objects.filter(user = self.request.user)
+        return MyTag.objects.filter(user = self.request.user).prefetch_related('tags')
 
     def perform_create(self, serializer):
         serializer.save(user = self.request.user)
@@ -56,7 +86,7 @@ class MyCategoryViewSet(viewsets.ModelViewSet):
     serializer_class = MyCategorySerializer
 
     def get_queryset(self):
-        return MyCategory.objects.filter(user = self.request.user)
+        return MyCategory.objects.filter(user = self.request.user).prefetch_related('categorys')
 
     def update(self, request, *args, **kwargs):
         try: super().update(request, *args, **kwargs)
@@ -84,7 +114,52 @@ class MyNewsViewSet(viewsets.ModelViewSet):
         return super(MyNewsViewSet, self).perform_create(serializer)
 
 
-class NewsView(views.APIView):
+def feed_window(news, anchor, before, after):
+    """The news up to ``before`` places ahead of the anchor id in the feed's
+    order and ``after`` places behind it, as ``(queryset, offset)`` where
+    ``offset(id)`` is negative ahead of the anchor and positive behind it.
+
+    Feeds ordered by ``-id`` select both keyset slices in one UNION ALL
+    subquery of the returned queryset, so the anchor doesn't have to be in
+    the feed and no extra round-trip is made. Any other ordering numbers
+    the feed with ROW_NUMBER() and fetches the anchor's neighbours first.
+    """
+    ordering = news.query.order_by
+
+    def sql(queryset):
+        return queryset.query.get_compiler(news.db).as_sql()
+
+    try:
+        if ordering[0] == '-id':
+            halves = [(before, news.filter(id__gt = anchor).order_by('id')), (after, news.filter(id__lt = anchor).order_by('-id'))]
+            parts, params = [], ()
+            for size, half in halves:
+                if not size: continue
+                part, part_params = sql(half.values('id')[:size])
+                parts.append('SELECT h.id FROM (%s) h' % part)
+                params += tuple(part_params)
+            if not parts: return News.objects.none(), None
+            return News.objects.filter(id__in = RawSQL(' UNION ALL '.join(parts), params)), lambda pk: anchor - pk
+
+        key = ordering[0].lstrip('-')
+        feed, params = sql(news.order_by().values_list('id', key))
+    except EmptyResultSet:
+        return News.objects.none(), None
+
+    connection = connections[news.db]
+    query = (
+        'WITH w AS (SELECT q.id, ROW_NUMBER() OVER (ORDER BY q.{key} {direction}, q.id DESC) AS n FROM (%s) q) '
+        'SELECT w.id, w.n - a.n FROM w JOIN w a ON a.id = %%s '
+        'WHERE w.n BETWEEN a.n - %%s AND a.n + %%s AND w.id <> a.id'
+    ).format(key = connection.ops.quote_name(key), direction = 'DESC' if ordering[0].startswith('-') else 'ASC') % feed
+    with connection.cursor() as cursor:
+        cursor.execute(query, tuple(params) + (anchor, before, after))
+        offsets = dict(cursor.fetchall())
+    return News.objects.filter(id__in = list(offsets)), offsets.get
+
+
+class NewsView(ReplicaReadsMixin, views.APIView):
+    authentication_classes = [StatelessJWTAuthentication]
 
     def get(self, request, format = None):
         id = self.request.query_params.get('id', None)
@@ -95,6 +170,7 @@ class NewsView(views.APIView):
         tag = list(map(int,
             filter(None, self.request.query_params.get(
                 'tag', '').split(","))))
+        match_all = self.request.query_params.get('tag_mode') == 'all'
 
         search = self.request.query_params.get('search', None)
         similar = self.request.query_params.get('similar', None)
@@ -103,32 +179,48 @@ class NewsView(views.APIView):
         prev = self.request.query_params.get('prev', None)
 
         page = self.request.query_params.get('page', 1)
+        fields = NewsListSerializer.requested_fields(request)
 
         news = News.objects.filter(visibility = True).order_by('-id')
-
+        independent, categories = False, None
 
         if search:
-            news = news.annotate(
-                search = SearchVector(
-                    'headline', 'body', 'newsAgency', 'category__name', 'tags__name'),
-            ).filter(search = search)
-
-        if similar: news = news.get(id = similar).etags.similar_objects()
+            # own text through news_search_idx, category and tag names through
+            # their small tables; a join-wide vector can't use any index.
+            # Ranking reads only the headline, a body tsvector per match is too slow
+            query = SearchQuery(search, config = 'english')
+            text = SearchVector('headline', 'body', 'newsAgency', config = 'english')
+            labels = lambda model: Func(
+                Subquery(model.objects.annotate(label = SearchVector('name', config = 'english')).filter(label = query).values('id')),
+                function = 'ARRAY', output_field = ArrayField(IntegerField()))
+            matches = News.objects.annotate(document = text).filter(document = query).values('id').union(
+                News.objects.filter(Q(category_ids__overlap = labels(Category)) | Q(tag_ids__overlap = labels(Tag))).values('id'))
+            news = news.filter(id__in = matches).annotate(
+                rank = SearchRank(SearchVector('headline', config = 'english'), query),
+            ).order_by('-rank', '-id')
+
+        if similar:
+            ids = [i.pk for i in news.get(id = similar).etags.similar_objects()]
+            news = news.filter(id__in = ids).annotate(
+                similarity = Case(*[When(id = pk, then = i) for i, pk in enumerate(ids)], output_field = IntegerField()),
+            ).order_by('similarity')
 
         if category:
 
             if "independent" in category:
                 news = news.filter(independent = True)
+                independent = True
                 category.remove("independent")
             else: news = news.filter(independent = False)
 
             if "preference" in category:
                 if request.user.is_authenticated:
-                    mycategory = MyCategory.objects.filter(user = request.user)
+                    mine = list(MyCategory.categorys.through.objects.filter(
+                        mycategory__user = request.user).values_list('category_id', flat = True))
 
-                    if mycategory:
-                        cats = MyCategorySerializer(mycategory[0]).data["categorys"]
-                        news = news.filter(category__in = cats)
+                    if mine:
+                        news = news.filter(category_ids__overlap = mine)
+                        categories = mine
                     else: category.append("trending")
 
                 else: return response.Response({"message": "User is not Authenticated"})
@@ -142,43 +234,84 @@ class NewsView(views.APIView):
                 news = news.filter(created_at__gt = time_threshold).annotate(
                     popularity = (F('pos') - F('neg') + 0.01)/(
                         (iso[0] - Extract(F('created_at'), 'iso_year')) * 364 * 24 + (iso[1] - Extract(F('created_at'), 'week')) * 7 * 24 + (iso[2] - Extract(F('created_at'), 'week_day') % 7 - 1) * 24 + hr - Extract(F('created_at'), 'hour') + 1.01)
-                ).order_by('-popularity')
+                ).order_by('-popularity', '-id')
 
                 category.remove("trending")
 
-            elif category: news = news.filter(category__name__in = category)
+            elif category:
+                categories = category_ids(category)
+                news = news.filter(category_ids__overlap = categories)
         else: news = news.filter(independent=False)
 
-        data = {}
+        if tag: news = news.filter(tag_ids__contains = tag) if match_all else news.filter(tag_ids__overlap = tag)
+
+        # plain newest-first feeds come out of the in-memory posting lists,
+        # leaving one primary key fetch; ranked feeds stay in the database
+        indexed = None
+        if settings.FEED_INDEX and news.query.order_by == ('-id',):
+            indexed = feed_index.select(independent, categories, tag, match_all)
 
-        news = news.distinct()
+        data = {}
 
         if id:
-            if next and next != "0":
-                news1 = news.filter(id__gt = int(id)).order_by('id')[0:int(next)]
-                serializer = NewsSerializer(news1, many = True, context = {'request': request})
-                data['next'] = serializer.data
-
-            if prev and prev != "0":
-                news2 = news.filter(id__lt = int(id)).order_by('-id')[0:int(prev)]
-                serializer = NewsSerializer(news2, many = True, context = {'request': request})
-                data['prev'] = serializer.data
-                if not next or next == "0": data['next'] = data['prev']
-            else: data['prev'] = data['next']
+            before, after = int(next or 0), int(prev or 0)
+            if indexed is None: window, offset = feed_window(news, int(id), before, after)
+            else:
+                anchor = int(id)
+                window = News.objects.filter(id__in = around(indexed, anchor, before, after).tolist(), visibility = True)
+                offset = lambda pk: anchor - pk
+            serializer = NewsListSerializer(window, request, fields)
+            with timed('serialize'): rows = serializer.data
+            rows.sort(key = lambda row: abs(offset(row['id'])))
+            data['next'] = [row for row in rows if offset(row['id']) < 0]
+            data['prev'] = [row for row in rows if offset(row['id']) > 0]
+            if not before: data['next'] = data['prev']
+            elif not after: data['prev'] = data['next']
         else:
-            serializer = NewsSerializer(Paginator(news, 20).page(page), many = True, context = {'request': request})
-            data['next'] =  data['prev'] = serializer.data
+            page = max(int(page), 1)
+            if indexed is None: news = news[(page - 1) * 20:page * 20]
+            else: news = News.objects.filter(id__in = indexed[::-1][(page - 1) * 20:page * 20].tolist(), visibility = True).order_by('-id')
+            serializer = NewsListSerializer(news, request, fields)
+            with timed('serialize'): data['next'] =  data['prev'] = serializer.data
         return response.Response(data)
 
 
-class SaveViewSet(viewsets.ModelViewSet):
+class NewsDetailView(ReplicaReadsMixin, views.APIView):
+    authentication_classes = [StatelessJWTAuthentication]
+
+    def get(self, request, pk, format = None):
+        news = News.objects.filter(pk = pk, visibility = True)
+        data = NewsListSerializer(news, request, NewsListSerializer.requested_fields(request)).data
+        if not data: raise Http404
+        return response.Response(data[0])
+
+
+class RelatedNewsListMixin:
+    """list() for the user's saves or votes, with each ``news`` built by
+    NewsListSerializer so ``?fields=`` and ``?view=card`` apply to it.
+    ``relation`` names the NewsListSerializer argument the rows fill in."""
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.queryset.model.objects.filter(user = request.user).order_by('-created_at')
+        rows = [relation_payload(row) for row in self.paginate_queryset(relation_values(queryset))]
+
+        known = {self.relation: {row['news']: row for row in rows}}
+        news = News.objects.filter(id__in = [row['news'] for row in rows])
+        serializer = NewsListSerializer(news, request, NewsListSerializer.requested_fields(request), **known)
+        with timed('serialize'): news = {item['id']: item for item in serializer.data}
+        return self.get_paginated_response([dict(row, news = news[row['news']]) for row in rows])
+
+
+class SaveViewSet(RelatedNewsListMixin, viewsets.ModelViewSet):
     queryset = Save.objects.order_by('-created_at')
+    relation = 'saves'
     pagination_class = StandardResultsSetPagination
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = SaveSerializer
 
     def get_queryset(self, *args, **kwargs):
-        return Save.objects.filter(user = self.request.user).order_by('-created_at')
+        queryset = Save.objects.filter(user = self.request.user).order_by('-created_at')
+        return NewsSerializer.setup_eager_loading(queryset, self.request, 'news__')
 
     def get_serializer_context(self):
         context = super(SaveViewSet, self).get_serializer_context()
@@ -194,14 +327,16 @@ class SaveViewSet(viewsets.ModelViewSet):
         return super(SaveViewSet, self).perform_update(serializer)
 
 
-class VoteViewSet(viewsets.ModelViewSet):
+class VoteViewSet(RelatedNewsListMixin, viewsets.ModelViewSet):
     queryset = Vote.objects.order_by('-created_at')
+    relation = 'votes'
     pagination_class = StandardResultsSetPagination
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = VoteSerializer
 
     def get_queryset(self, *args, **kwargs):
-        return Vote.objects.filter(user = self.request.user).order_by('-created_at')
+        queryset = Vote.objects.filter(user = self.request.user).order_by('-created_at')
+        return NewsSerializer.setup_eager_loading(queryset, self.request, 'news__')
 
     def get_serializer_context(self):
         context = super(VoteViewSet, self).get_serializer_context()
@@ -231,7 +366,7 @@ class ProfileViewSet(viewsets.ModelViewSet):
     http_method_names = ['get', 'put', 'patch', 'head']
 
     def get_queryset(self, *args, **kwargs):
-        return User.objects.filter(id = self.request.user.id)
+        return User.objects.filter(id = self.request.user.id).select_related('profile__org', 'profile__plan_type')
 
 
 class ProfileInfoViewSet(viewsets.ModelViewSet):
@@ -241,18 +376,38 @@ class ProfileInfoViewSet(viewsets.ModelViewSet):
     http_method_names = ['get', 'put', 'patch', 'head']
 
     def get_queryset(self, *args, **kwargs):
-        return Profile.objects.filter(user = self.request.user)
+        return Profile.objects.filter(user = self.request.user).select_related('org', 'plan_type')
+
+    def described(self, serializer):
+        """The size and placeholder of an uploaded image, measured before the
+        upload is stored so they're written in the same query as the image."""
+        if 'image' not in serializer.validated_data: return {}
+        upload, fields = serializer.validated_data['image'], dict.fromkeys(['image_width', 'image_height', 'image_blurhash'])
+        if upload:
+            upload.seek(0)
+            try: fields['image_width'], fields['image_height'], fields['image_blurhash'] = measure(upload)
+            except (OSError, ValueError): pass
+            upload.seek(0)
+        return fields
+
+    def perform_create(self, serializer):
+        serializer.save(**self.described(serializer))
+
+    def perform_update(self, serializer):
+        serializer.save(**self.described(serializer))
 
 
-class CompViewSet(viewsets.ViewSet):
+class CompViewSet(ReplicaReadsMixin, viewsets.ViewSet):
     queryset = Comp.objects.all().order_by('-start_time')
+    # the actions take pk as an int; anything else isn't a competition
+    lookup_value_regex = r'\d+'
 
     def list(self, request):
-        queryset = Comp.objects.all().order_by('-start_time')
-        return response.Response(CompSerializer(queryset, many=True).data)
+        queryset = Comp.objects.all().order_by('-start_time').prefetch_related('org')
+        return response.Response(listing(request, 'comp', queryset, CompSerializer))
 
     def retrieve(self, request, pk=None):
-        queryset = Comp.objects.all()
+        queryset = Comp.objects.all().prefetch_related('org')
         user = get_object_or_404(queryset, pk=pk)
         serializer = CompSerializer(user)
         return response.Response(serializer.data)
@@ -261,24 +416,71 @@ class CompViewSet(viewsets.ViewSet):
         detail=True, methods=["post"], permission_classes=[permissions.IsAuthenticated]
     )
     def questions(self, request, pk=None):
-        instance = Comp.objects.filter(id=pk, participants=request.user, start_time__gte=timezone.now(), end_time__lte=timezone.now())
-        if instance.exists():
-            ques = instance.questions.order_by('-created_at')[:40]
-            return response.Response(QuestionSerializer(random.sample(ques, 15)).data)
+        comp = competitions.get(int(pk))
+        if comp is not None and comp.admits(request.user, timezone.now()):
+            return HttpResponse(comp.questions_for(request.user), content_type='application/json')
         return response.Response([])
 
     @decorators.action(
         detail=True, methods=["post"], permission_classes=[permissions.IsAuthenticated]
     )
     def submission(self, request, pk=None):
-        instance = Comp.objects.filter(id=pk, participants=request.user, start_time__gte=timezone.now(), end_time__lte=timezone.now())
-        if instance.exists():
-            ans = json.loads(request.body.decode('utf-8'))
-            CompSub.objects.create(comp=pk, user=request.user, ans=ans)
+        comp = competitions.get(int(pk))
+        now = timezone.now()
+        if comp is not None and comp.admits(request.user, now) and isinstance(request.data, dict):
+            submissions.submit(comp.pk, request.user.pk, request.data, now)
             return response.Response({'success': True})
         return response.Response({'success': False})
 
+    @decorators.action(
+        detail=True, methods=["post", "delete"], permission_classes=[permissions.IsAuthenticated]
+    )
+    def register(self, request, pk=None):
+        return registration(request, get_object_or_404(Comp, pk=pk))
+
+    @decorators.action(detail=True)
+    def leaderboard(self, request, pk=None):
+        comp = competitions.get(int(pk))
+        if comp is None: raise Http404
+        page = page_number(request.GET.get("page", 1))
+        rows = comp.leaderboard.page((page - 1) * 20, 20)
+        names = {}
+        if rows:
+            users = User.objects.filter(pk__in=[user for _, user, _ in rows]).values_list('pk', 'first_name', 'last_name')
+            names = {user: ('%s %s' % (first, last)).strip() for user, first, last in users}
+        mine = comp.leaderboard.rank(request.user.pk) if request.user.is_authenticated else None
+        return response.Response({
+            'count': len(comp.leaderboard),
+            'results': [{'rank': rank, 'user': user, 'name': names.get(user, ''), 'score': score} for rank, user, score in rows],
+            'me': mine and {'rank': mine[0], 'score': mine[1]},
+        })
+
+
+def registration(request, instance):
+    if instance.end_time <= timezone.now():
+        return response.Response({'success': False, 'detail': 'registration is closed'}, status=400)
+    if request.method == 'DELETE':
+        unregister(instance, request.user)
+        return response.Response({'success': True})
+    if register(instance, request.user): return response.Response({'success': True})
+    return response.Response({'success': False, 'detail': 'no places left'}, status=409)
+
+
+class EventRegister(views.APIView):
+    authentication_classes = [StatelessJWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, pk):
+        return registration(request, get_object_or_404(Event, pk=pk))
+
+    delete = post
+
+
+class EventView(ReplicaReadsMixin, generics.ListAPIView):
+    authentication_classes = [StatelessJWTAuthentication]
+    queryset = Event.objects.all().order_by('-start_time').select_related('org').prefetch_related('comp__org')
+    serializer_class = EventListingSerializer
 
-class EventView(generics.ListAPIView):
-    queryset = Event.objects.all().order_by('-start_time')
-    serializer_class = EventSerializer
+    def list(self, request, *args, **kwargs):
+        return response.Response(listing(request, 'event', self.get_queryset(), self.serializer_class,
+                                         Event.participants.through))
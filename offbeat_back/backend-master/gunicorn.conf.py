@@ -0,0 +1,27 @@
+# Picked up by gunicorn from the working directory.
+#
+# The Procfile runs sync workers. For the async views (api.asyncviews) run
+#   ASYNC_VIEWS=1 gunicorn newscatcher_backend.asgi -k uvicorn.workers.UvicornWorker
+# instead: each worker then serves requests on an event loop, sync views on
+# threads, and a slow google or image host no longer holds a whole worker.
+import os, shutil
+
+# prometheus_client keeps per-worker metric files here; /metrics/ merges them
+metrics_dir = os.environ.setdefault('prometheus_multiproc_dir', '/tmp/offbeat-metrics')
+
+
+def on_starting(server):
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    # fill the feed index before the worker takes traffic
+    from django.conf import settings
+    from api.feedindex import feed_index
+    if settings.FEED_INDEX: feed_index.build()
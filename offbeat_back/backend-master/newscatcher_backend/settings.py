@@ -11,7 +11,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os, socket
-import django_heroku
+import dj_database_url, django_heroku
 
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -63,11 +63,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.metrics_middleware',
+    'api.middleware.performance_middleware',
     'django.middleware.security.SecurityMiddleware',
+    'api.middleware.compression_middleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'api.middleware.PrimaryPinMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -107,6 +111,39 @@ DATABASES = {
     }
 }
 
+# Read replicas, as comma separated database urls (a second local postgres
+# works for trying it out); under test they mirror default
+for i, url in enumerate(filter(None, os.environ.get('REPLICA_DATABASE_URLS', '').split(','))):
+    DATABASES['replica_%d' % i] = dict(dj_database_url.parse(url), TEST={'MIRROR': 'default'})
+
+DATABASE_ROUTERS = ['api.dbrouters.ReplicaRouter']
+
+# Replicas further behind than REPLICA_MAX_LAG seconds are skipped, lag is
+# measured every REPLICA_LAG_CHECK seconds, and a user's reads stay on the
+# primary for REPLICA_PIN_SECONDS after they write, on any worker (the pin
+# is kept in the 'shared' cache below)
+REPLICA_MAX_LAG = 5
+REPLICA_LAG_CHECK = 5
+REPLICA_PIN_SECONDS = 10
+
+# The default cache is each worker's own memory. What every worker has to
+# see at once (replica pins and the version tokens that tell workers a
+# competition or listing changed) goes to the small 'shared' cache: files
+# under SHARED_CACHE_LOCATION for the workers of one machine, or memcached
+# (SHARED_CACHE_BACKEND=...MemcachedCache, SHARED_CACHE_LOCATION=host:port)
+# when the app runs on several
+SHARED_CACHE_BACKEND = os.environ.get('SHARED_CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': SHARED_CACHE_BACKEND,
+        'LOCATION': os.environ.get('SHARED_CACHE_LOCATION', '/tmp/offbeat-shared'),
+    },
+}
+if SHARED_CACHE_BACKEND.endswith('FileBasedCache'): CACHES['shared']['OPTIONS'] = {'MAX_ENTRIES': 20000}
+
 # DATABASES = {
 #     'default': {
 #         'ENGINE': 'django.db.backends.sqlite3',
@@ -140,6 +177,12 @@ SIMPLE_JWT = {
     'REFRESH_TOKEN_LIFETIME': timedelta(days=366)
 }
 
+# Google sign-in: userinfo endpoint, (connect, read) timeouts and how long
+# a verified token is trusted before asking google again
+GOOGLE_USERINFO_URL = os.environ.get('GOOGLE_USERINFO_URL', 'https://www.googleapis.com/oauth2/v2/userinfo')
+GOOGLE_HTTP_TIMEOUT = (3.05, 10)
+GOOGLE_TOKEN_CACHE_TTL = 300
+
 REST_AUTH_SERIALIZERS = {
     'USER_DETAILS_SERIALIZER': 'api.serializers.ProfileSerializer'
 }
@@ -170,6 +213,27 @@ MEDIA_ROOT = os.path.join(BASE_DIR,STATIC_ROOT,'media')
 
 MEDIA_URL = '/media/'
 
+# Who sends media files (api.media): 'nginx' answers with X-Accel-Redirect
+# to MEDIA_ACCEL_LOCATION, an internal location aliased to MEDIA_ROOT;
+# 'sendfile' with X-Sendfile (apache mod_xsendfile, lighttpd); unset, the
+# worker streams them with range and ETag support. A stored name can come
+# back with new content (django_cleanup deletes a replaced file, and the
+# next file saved under that name gets it), so clients keep media for
+# MEDIA_CACHE_SECONDS and then revalidate it by its ETag
+MEDIA_ACCEL = os.environ.get('MEDIA_ACCEL') or None
+MEDIA_ACCEL_LOCATION = '/protected-media/'
+MEDIA_CACHE_SECONDS = 3600
+
+# image/<news|profile>/<pk>/?w=&fmt= renditions (api.images): the widths
+# made, where they're kept under MEDIA_ROOT and how much disk they may
+# take, all workers together; ingestion keeps news images at up to
+# NEWS_IMAGE_MAX_WIDTH to make them from. They're cached by clients like
+# other media, for MEDIA_CACHE_SECONDS
+IMAGE_WIDTHS = (120, 300, 480, 720, 1080)
+IMAGE_CACHE_DIR = 'renditions'
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+NEWS_IMAGE_MAX_WIDTH = 1080
+
 
 LOGIN_REDIRECT_URL = '/news'
 
@@ -178,12 +242,84 @@ SITE_ID = 7
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-	'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'api.authentication.StatelessJWTAuthentication',
         'rest_framework.authentication.BasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.ORJSONRenderer',
+        'api.renderers.MessagePackRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
+# Responses smaller than COMPRESS_MIN_SIZE bytes aren't worth compressing;
+# brotli quality 5 costs about as much cpu as gzip -6 for a smaller body
+COMPRESS_MIN_SIZE = 512
+COMPRESS_BROTLI_QUALITY = 5
+
+# news/, auth/google/ and un/ served by api.asyncviews, which only pays
+# under an ASGI worker (gunicorn.conf.py); INGEST_CONCURRENCY caps the
+# image downloads the async ingestion keeps in flight
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS', '0') == '1'
+INGEST_CONCURRENCY = 16
+
+# Newest-first feed filters (independent, category, tag) are answered from
+# per-process posting lists (api.feedindex): new news show up within
+# FEED_INDEX_REFRESH seconds, and their categories and tags are read again
+# until they're FEED_INDEX_SETTLE seconds old. After that, edits to a news'
+# visibility, categories or tags are logged (NewsChange) and applied by the
+# same refresh. Each process still rebuilds its index every
+# FEED_INDEX_REBUILD seconds, for changes made past the ORM's signals
+FEED_INDEX = os.environ.get('FEED_INDEX', '1') == '1'
+FEED_INDEX_REFRESH = 5
+FEED_INDEX_SETTLE = 60
+FEED_INDEX_REBUILD = 3600
+
+# A competition's quiz draws QUIZ_QUESTIONS questions per participant out of
+# its QUIZ_POOL_SIZE newest; pools and participants are cached per process
+# (api.competition) until the competition or its questions change, which
+# every worker learns through the shared cache, and for at most
+# COMPETITION_CACHE_TTL seconds, which also rebuilds its leaderboard.
+# Participants joining or leaving are added to that in the shared cache,
+# per user, without a reload
+QUIZ_POOL_SIZE = 40
+QUIZ_QUESTIONS = 15
+COMPETITION_CACHE_TTL = 300
+
+# Leaderboards (api.scoring) pick up newly stored submissions at most every
+# LEADERBOARD_REFRESH seconds
+LEADERBOARD_REFRESH = 2
+
+# Competition and event listings (api.listings) are cached for up to
+# LISTING_CACHE_TTL seconds; any change to a competition, event or
+# organization drops them, and so does the next start or end time. Event
+# participants, which every registration changes, are cached apart for
+# LISTING_PARTICIPANTS_TTL seconds
+LISTING_CACHE_TTL = 300
+LISTING_PARTICIPANTS_TTL = 5
+
+# Free places of a competition or event with a capacity are split over
+# CAPACITY_SHARDS rows, so that many registrations can take one at once
+CAPACITY_SHARDS = 16
+
+# Quiz submissions are appended and fsynced to a log per competition in
+# SUBMISSION_BUFFER_DIR before they're acknowledged, and flush_submissions
+# moves them into the database in batches. Unset, each one is written to the
+# database in the request; the buffer needs a disk that outlives the dyno
+SUBMISSION_BUFFER_DIR = os.environ.get('SUBMISSION_BUFFER_DIR')
+
+# Per-request timings (Server-Timing header + 'api.performance' log line)
+# for a PERF_SAMPLE_RATE fraction of requests; off means no middleware at all
+PERF_TIMING = os.environ.get('PERF_TIMING', '0') == '1'
+PERF_SAMPLE_RATE = float(os.environ.get('PERF_SAMPLE_RATE', '1'))
+
+# Prometheus request/db/cache/ingestion metrics served at /metrics/ to
+# scrapers sending 'Authorization: Bearer <METRICS_TOKEN>'; without a
+# token set, nobody can read them
+METRICS = os.environ.get('METRICS', '1') == '1'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
 # EMAIL_BACKEND so allauth can proceed to send confirmation emails
 # ONLY for development/testing use console 
 EMAIL_BACKEND='django.core.mail.backends.console.EmailBackend'
@@ -204,3 +340,13 @@ EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 
 django_heroku.settings(locals())
+
+# django_heroku puts in whitenoise's middleware, which can't run async
+MIDDLEWARE = [
+    'api.middleware.static_files_middleware' if m == 'whitenoise.middleware.WhiteNoiseMiddleware' else m for m in MIDDLEWARE
+]
+
+# django_heroku replaces LOGGING, so our loggers are added after it
+LOGGING['formatters']['message'] = {'format': '%(message)s'}
+LOGGING['handlers']['json'] = {'class': 'logging.StreamHandler', 'formatter': 'message'}
+LOGGING['loggers']['api.performance'] = {'handlers': ['json'], 'level': 'INFO', 'propagate': False}
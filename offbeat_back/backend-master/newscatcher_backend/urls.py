@@ -18,11 +18,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
-from django.conf.urls.static import static
 from django.views.generic import TemplateView
 from django.http import JsonResponse
 
-from api import views, googleviews, socialviews, dbviews
+from api import views, asyncviews, googleviews, socialviews, dbviews, images, media, metrics
 
 from rest_framework_simplejwt import views as jwt_views
 from rest_framework.routers import DefaultRouter
@@ -43,8 +42,8 @@ router.register(r'competition', views.CompViewSet)
 
 urlpatterns = [
     path('stats/', googleviews.Stats.as_view(), name='app_stats'),
-    path('un/', dbviews.UpdateNews.as_view(), name='update_news'),
-    path('auth/google/', googleviews.GoogleLogin.as_view(), name='goggle_login'),
+    path('un/', asyncviews.update_news if settings.ASYNC_VIEWS else dbviews.UpdateNews.as_view(), name='update_news'),
+    path('auth/google/', asyncviews.google_login if settings.ASYNC_VIEWS else googleviews.GoogleLogin.as_view(), name='goggle_login'),
     path('auth/facebook/', socialviews.FacebookLogin.as_view(), name='fb_connect'),
     path('auth/twitter/', socialviews.TwitterLogin.as_view(), name='twitter_connect'),
     path('auth/github/', socialviews.GithubLogin.as_view(), name='github_connect'),
@@ -54,8 +53,11 @@ urlpatterns = [
     path('tag/', views.TagView.as_view()),
     path('topic/', views.TopicView.as_view()),
     path('quote/', views.QuoteView.as_view()),
-    path('news/', views.NewsView.as_view()),
+    path('news/', asyncviews.news if settings.ASYNC_VIEWS else views.NewsView.as_view()),
+    path('news/<int:pk>/', views.NewsDetailView.as_view()),
+    path('image/<str:kind>/<int:pk>/', images.rendition),
     path('event/', views.EventView.as_view()),
+    path('event/<int:pk>/register/', views.EventRegister.as_view()),
     path('rest-auth/', include('rest_auth.urls')),
     path('rest-auth/registration/', include('rest_auth.registration.urls')),
     path('', include(router.urls)),
@@ -68,5 +70,7 @@ urlpatterns = [
         template_name='swagger-ui.html',
         extra_context={'schema_url':'openapi-schema'}
     ), name='swagger-ui'),
-    path('current_version/', lambda x: JsonResponse({'version': 1}))
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    path('current_version/', lambda x: JsonResponse({'version': 1})),
+    path('metrics/', metrics.export, name='metrics'),
+    path(settings.MEDIA_URL.lstrip('/') + '<path:path>', media.serve),
+]